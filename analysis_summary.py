@@ -1,30 +1,72 @@
-import pandas as pd
-import seaborn as sns
+import argparse
+import hashlib
+import inspect
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import pandas as pd
 from tabulate import tabulate
 
 gpt4_evaluation = "results/gpt4_evaluation.csv"
 true_count = "FSC147_384_V2/300_image_labels.csv"
 human_data = "results/human_evaluation.csv"
-
-true_data = pd.read_csv(true_count)
-human_data = pd.read_csv(human_data)
-gpt_data = pd.read_csv(gpt4_evaluation)
-
-def true_count_boxplot():
+plots_path = "plots"
+figure_cache_path = "plots/.figure_cache.json"
+# The *_small figures leave out the images with more true objects than this (5 of the 300, all above 400), so the
+# other points are not squeezed into the corner.
+SMALL_MAX_COUNT = 300
+
+
+@lru_cache(maxsize=None)
+def load_csv(path, columns=None):
+    """
+    Reads a CSV on first use, only the given columns if any. Callers must not modify the returned DataFrame.
+
+    Parameters:
+    path (str): The path to the CSV file.
+    columns (tuple): Optional; the columns to read.
+
+    Returns:
+    DataFrame: The data.
+    """
+    return pd.read_csv(path, usecols=list(columns) if columns else None)
+
+
+# Answer series that can be compared against the true count: (csv, column, color, alpha, legend label).
+Series = namedtuple('Series', ['csv', 'column', 'color', 'alpha', 'label'])
+SERIES = {
+    'human': Series(human_data, 'human', 'orange', 0.5, 'Human'),
+    'vanilla': Series(gpt4_evaluation, 'gpt_4_initial_answer', 'blue', 0.3, 'GPT4: Vanilla'),
+    'allinfo': Series(gpt4_evaluation, 'response_desc_true_direct_true_indirect_true', 'green', 0.3, 'GPT4: all info'),
+    'descrip': Series(gpt4_evaluation, 'response_desc_true_direct_false_indirect_false', 'red', 0.3,
+                      'GPT4: Description Only'),
+    'direct': Series(gpt4_evaluation, 'response_desc_false_direct_true_indirect_false', 'yellow', 0.3,
+                     'GPT4: Direct Hint Only'),
+    'indirect': Series(gpt4_evaluation, 'response_desc_false_direct_false_indirect_true', 'pink', 0.3,
+                       'GPT4: Indirect Hint Only'),
+}
+
+
+def true_count_boxplot(output_path):
+    true_data = load_csv(true_count, ('object_count',))
     plt.figure(figsize=(10, 4))  # Adjust the figure size as needed
     plt.boxplot(true_data['object_count'], patch_artist=True, vert=False)  # Create a boxplot
 
     plt.title('Distribution of the Ture Object Count')
     plt.xlabel('Object Count')
     plt.grid(True)
-    plt.savefig('plots/true_count_boxplot.png', format='png', dpi=300)  # Specify the path, format, and DPI
-    plt.show()
+    plt.savefig(output_path, format='png', dpi=300)  # Specify the path, format, and DPI
+    plt.close()
 
 
-def scatter_plot():
+def scatter_plot(output_path):
 
-    df = true_data
+    df = load_csv(true_count, ('class', 'object_count')).copy()
     fig, ax = plt.subplots(figsize=(12, 4))
     classes = pd.Categorical(df['class'])
     df['class_code'] = classes.codes
@@ -43,13 +85,14 @@ def scatter_plot():
     # Adding a horizontal color bar
     cbar = plt.colorbar(scatter, orientation='vertical')
 
-    plt.show()
+    plt.savefig(output_path, format='png', dpi=300)
+    plt.close()
 
 
-def human_performance():
+def human_performance(output_path, max_count=800):
 
-    df = human_data
-    df = df[df['object_count'] <= 800]
+    df = load_csv(human_data, ('object_count', 'human'))
+    df = df[df['object_count'] <= max_count]
     # Create a scatter plot
     plt.figure(figsize=(8, 6))
     plt.scatter(df['object_count'], df['human'], color='blue', alpha=0.6, edgecolor='black')
@@ -63,29 +106,33 @@ def human_performance():
     plt.title('Comparison of Human Count vs. True Count')
     plt.grid(True)
 
-    # Add annotations for clarity
-    # for i, row in df.iterrows():
-    #     plt.annotate(row['filename'], (row['object_count'] + 0.5, row['human']), textcoords="offset points", xytext=(0,10), ha='center')
+    plt.savefig(output_path, format='png')
+    plt.close()
 
-    plt.show()
 
-def gpt_performance():
+def gpt_performance(output_path, series=('human', 'vanilla', 'allinfo'), max_count=None):
+    """
+    Scatter plot of the answers of several series against the true count.
 
-    df = gpt_data
-    human_df=human_data
-    # Create a scatter plot
+    Parameters:
+    output_path (str): The path of the PNG to write.
+    series (tuple): Keys of SERIES to plot, in drawing order.
+    max_count (int): Optional; only images with at most this many true objects are plotted.
+    """
     marker_size = 20  # Adjust this value as needed, smaller numbers mean smaller dots
     plt.figure(figsize=(8, 6))
 
-    plt.scatter(human_df['object_count'], human_df['human'], color='orange', alpha=0.5, s=marker_size, label='Human')
-    plt.scatter(df['object_count'], df['gpt_4_initial_answer'], color='blue', alpha=0.3, s=marker_size, label='GPT4: Vanilla ')
-    plt.scatter(df['object_count'], df['response_desc_true_direct_true_indirect_true'], color='green', alpha=0.3, s=marker_size, label='GPT4: all info')
-    # plt.scatter(df['object_count'], df['response_desc_true_direct_false_indirect_false'], color='red', alpha=0.3, s=marker_size, label='GPT4: Description Only')
-    # plt.scatter(df['object_count'], df['response_desc_false_direct_true_indirect_false'], color='yellow', alpha=0.3, s=marker_size, label='GPT4: Direct Hint Only')
-    # plt.scatter(df['object_count'], df['response_desc_false_direct_false_indirect_true'], color='pink', alpha=0.3, s=marker_size, label='GPT4: Indirect Hint Only')
+    low, high = float('inf'), float('-inf')
+    for key in series:
+        s = SERIES[key]
+        df = load_csv(s.csv, ('object_count', s.column))
+        if max_count is not None:
+            df = df[df['object_count'] <= max_count]
+        plt.scatter(df['object_count'], df[s.column], color=s.color, alpha=s.alpha, s=marker_size, label=s.label)
+        low, high = min(low, df['object_count'].min()), max(high, df['object_count'].max())
 
     # Add a line of perfect agreement
-    plt.plot([min(df['object_count']), max(df['object_count'])], [min(df['object_count']), max(df['object_count'])], color='red', linestyle='--')
+    plt.plot([low, high], [low, high], color='red', linestyle='--')
 
     # Labeling the plot
     plt.xlabel('True Count')
@@ -94,16 +141,101 @@ def gpt_performance():
     plt.grid(True)
     plt.legend()  # This will display the legend
 
-    plt.show()
+    plt.savefig(output_path, format='png')
+    plt.close()
+
+
+# Each figure: its drawing function, the parameters it is called with, and the (csv, columns) it reads.
+Figure = namedtuple('Figure', ['draw', 'params', 'inputs'])
+
+
+def comparison_figure(series, max_count=None):
+    inputs = [(SERIES[key].csv, ('object_count', SERIES[key].column)) for key in series]
+    return Figure(gpt_performance, {'series': tuple(series), 'max_count': max_count}, inputs)
+
+
+# Keyed on the file names in plots/ (note human_vs_descript_small next to human_vs_descrip).
+FIGURES = {
+    'true_count_boxplot': Figure(true_count_boxplot, {}, [(true_count, ('object_count',))]),
+    'count_and_class_scatter': Figure(scatter_plot, {}, [(true_count, ('class', 'object_count'))]),
+    'human_vs_true': Figure(human_performance, {'max_count': 800}, [(human_data, ('object_count', 'human'))]),
+    'human_vs_true_small': Figure(human_performance, {'max_count': SMALL_MAX_COUNT},
+                                  [(human_data, ('object_count', 'human'))]),
+}
+for name, small_name, series in [
+        ('all_gpt_performance', 'all_gpt_performance_small', ['vanilla', 'allinfo', 'descrip', 'direct', 'indirect']),
+        ('human_vs_vanilla_vs_allinfo', 'human_vs_vanilla_vs_allinfo_small', ['human', 'vanilla', 'allinfo']),
+        ('vanilla_vs_all_info', 'vanilla_vs_all_info_small', ['vanilla', 'allinfo']),
+        ('human_vs_vanilla', 'human_vs_vanilla_small', ['human', 'vanilla']),
+        ('human_vs_allinfo', 'human_vs_allinfo_small', ['human', 'allinfo']),
+        ('human_vs_descrip', 'human_vs_descript_small', ['human', 'descrip']),
+        ('human_vs_direct', 'human_vs_direct_small', ['human', 'direct']),
+        ('human_vs_indirect', 'human_vs_indirect_small', ['human', 'indirect'])]:
+    FIGURES[name] = comparison_figure(series)
+    FIGURES[small_name] = comparison_figure(series, max_count=SMALL_MAX_COUNT)
+
+
+def figure_key(name):
+    """
+    Hashes everything a figure depends on: its drawing code, its parameters and the contents of its input
+    columns.
+    """
+    figure = FIGURES[name]
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'name': name, 'params': figure.params}, sort_keys=True).encode('utf-8'))
+    digest.update(inspect.getsource(figure.draw).encode('utf-8'))
+    for path, columns in figure.inputs:
+        digest.update(pd.util.hash_pandas_object(load_csv(path, columns), index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def render(name):
+    figure = FIGURES[name]
+    figure.draw(os.path.join(plots_path, name + '.png'), **figure.params)
+    return name
+
+
+def regenerate(names=None, force=False, workers=None):
+    """
+    Regenerates figures in a process pool, skipping those whose inputs, parameters and code are unchanged
+    since they were last written.
+
+    Parameters:
+    names (list): Optional; the figures to regenerate. Defaults to all of FIGURES.
+    force (bool): If True, regenerate even unchanged figures.
+    workers (int): Optional; the number of worker processes. Defaults to the number of cores.
+
+    Returns:
+    list: The names of the regenerated figures.
+    """
+    names = list(FIGURES) if not names else names
+    cache = {}
+    if os.path.exists(figure_cache_path):
+        with open(figure_cache_path) as file:
+            cache = json.load(file)
+    keys = {name: figure_key(name) for name in names}
+    stale = [name for name in names if force or cache.get(name) != keys[name]
+             or not os.path.exists(os.path.join(plots_path, name + '.png'))]
+    print(f"{len(stale)} of {len(names)} figures to regenerate")
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for name in pool.map(render, stale):
+                cache[name] = keys[name]
+                print(f"Wrote {os.path.join(plots_path, name + '.png')}")
+        with open(figure_cache_path, 'w') as file:
+            json.dump(cache, file, indent=1, sort_keys=True)
+    return stale
+
 
 def count_size():
- 
+
+    true_data = load_csv(true_count)
     count1 = (true_data['object_count'] < 20).sum()
     count2 = ((true_data['object_count'] >= 20) & (true_data['object_count'] < 100)).sum()
     count3 = (true_data['object_count'] >= 100).sum()
     print("Count 1 (object_count < 20):", count1)
     print("Count 2 (20 <= object_count < 100):", count2)
-    print("Count 3 (object_count >= 100):", count3) 
+    print("Count 3 (object_count >= 100):", count3)
 
     unique_categories = true_data['class'].nunique()
     print("Number of unique categories:", unique_categories)
@@ -121,10 +253,10 @@ def count_size():
 
 def csv_to_latex():
     csv_path = "results/rmse_evaluation.csv"
-    df = pd.read_csv(csv_path)  
+    df = pd.read_csv(csv_path)
 
     latex_table = tabulate(df, tablefmt="latex", headers="keys", showindex="never")
-    
+
     output_file_path = 'results/rmse_latex.txt'
 
     with open(output_file_path, 'w') as file:
@@ -133,12 +265,27 @@ def csv_to_latex():
 
 
 def main():
-    # true_count_boxplot()
-    # scatter_plot()
-    # human_performance()
-    gpt_performance()
-    # count_size()
-    # csv_to_latex()
+    parser = argparse.ArgumentParser(description="Regenerate the figures in plots/ and the summary tables.")
+    parser.add_argument("figures", nargs="*", help="figures to regenerate (default: all); see --list")
+    parser.add_argument("--force", action="store_true", help="regenerate figures even if unchanged")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--list", action="store_true", help="list the figures and exit")
+    parser.add_argument("--stats", action="store_true", help="print the count statistics of the dataset")
+    parser.add_argument("--latex", action="store_true", help="write the RMSE table as LaTeX")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(FIGURES))
+        return
+    unknown = [name for name in args.figures if name not in FIGURES]
+    if unknown:
+        parser.error(f"unknown figures: {', '.join(unknown)}")
+    if args.stats:
+        count_size()
+    if args.latex:
+        csv_to_latex()
+    if args.figures or not (args.stats or args.latex):
+        regenerate(args.figures, force=args.force, workers=args.workers)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
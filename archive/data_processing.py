@@ -1,10 +1,19 @@
 # Process data
-from PIL import Image
+from PIL import Image, ImageOps
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import math
 import os
+import time
+import uuid
 
 def rename_images_in_folder(folder_path, min_range, max_range):
     """
     Renames all images in a folder to match the specified range (e.g., 001.jpg, 002.jpg, etc.).
+    Files are first moved to temporary names, so a target name that is still taken by another file
+    (e.g. 002.jpg -> 001.jpg while 001.jpg -> 000.jpg) never overwrites it. A name taken by a file outside the
+    range raises FileExistsError before any file is moved, and a failed move puts every file back.
     
     Parameters:
     folder_path (str): The path to the folder containing the images.
@@ -18,14 +27,74 @@ def rename_images_in_folder(folder_path, min_range, max_range):
     
     # Get a list of files in the folder
     files = sorted(os.listdir(folder_path))  # Assuming sorting is needed
+    if len(files) < len(new_filenames):
+        raise ValueError(f"{folder_path} has {len(files)} files, fewer than the {len(new_filenames)} names to assign")
 
-    # Rename files to match the range
-    for i, new_name in enumerate(new_filenames):
-        old_path = os.path.join(folder_path, files[i])
-        new_path = os.path.join(folder_path, new_name)
-        os.rename(old_path, new_path)
+    # A target name held by a file outside the renamed range would be overwritten; check before moving anything
+    renamed = files[:len(new_filenames)]
+    taken = sorted(set(new_filenames) & (set(files) - set(renamed)))
+    if taken:
+        raise FileExistsError(f"{', '.join(taken)} in {folder_path} taken by files outside the renamed range")
+
+    # Move the files out of the way first, then to their new names
+    staged = []
+    done = []
+    tag = uuid.uuid4().hex[:8]
+    try:
+        for i, new_name in enumerate(new_filenames):
+            old_path = os.path.join(folder_path, renamed[i])
+            temp_path = os.path.join(folder_path, f".rename-{tag}-{i}")
+            os.rename(old_path, temp_path)
+            staged.append((old_path, temp_path, os.path.join(folder_path, new_name)))
+        for old_path, temp_path, new_path in staged:
+            os.rename(temp_path, new_path)
+            done.append((old_path, temp_path, new_path))
+    except OSError:
+        # Put every file back under its original name
+        for old_path, temp_path, new_path in reversed(done):
+            os.rename(new_path, temp_path)
+        for old_path, temp_path, new_path in staged:
+            os.rename(temp_path, old_path)
+        raise
+    for old_path, temp_path, new_path in done:
         print(f"Renamed: {old_path} -> {new_path}")
 
+def crop_image_to_square(img):
+    """
+    Crop a loaded image to a square, keeping the horizontal center and the bottom edge.
+
+    Args:
+    img (PIL.Image.Image): The image to crop.
+
+    Returns:
+    PIL.Image.Image: The cropped image.
+    """
+    width, height = img.size
+    # Determine the size of the square and the top left coordinates
+    new_size = min(width, height)
+    left = (width - new_size) // 2
+    right = (width + new_size) // 2
+    top = height - new_size
+    bottom = height
+    return img.crop((left, top, right, bottom))
+
+def scale_to_max_side(img, max_side):
+    """
+    Resize a loaded image so its longer side is at most max_side, keeping the aspect ratio.
+
+    Args:
+    img (PIL.Image.Image): The image to resize.
+    max_side (int): The maximum length of the longer side. Images already within it are returned unchanged.
+
+    Returns:
+    PIL.Image.Image: The resized image.
+    """
+    scale = max_side / max(img.size)
+    if scale >= 1:
+        return img
+    new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(new_size, Image.LANCZOS)
+
 def crop_to_square(image_path, output_path=None):
     """
     Crop an image to a square around the center.
@@ -37,26 +106,8 @@ def crop_to_square(image_path, output_path=None):
     Returns:
     None
     """
-    with Image.open(image_path) as img:
-        # Get dimensions
-        width, height = img.size
-        print(width)
-        print(height)
-        # Determine the size of the square and the top left coordinates
-        new_size = min(width, height)
-        left = (width - new_size) // 2
-        right = (width + new_size) // 2
-        top = height - new_size
-        bottom = height
-
-        # Crop the image
-        img_cropped = img.crop((left, top, right, bottom))
-
-        # Save the cropped image
-        if output_path is None:
-            output_path = image_path
-        img_cropped.save(output_path)
-        print(f"Image saved to {output_path}")
+    transform_image(image_path, output_path or image_path, [('crop',)])
+    print(f"Image saved to {output_path or image_path}")
 
 def resize_image(image_path, output_path=None, new_size=(1080, 1080)):
     """
@@ -71,18 +122,200 @@ def resize_image(image_path, output_path=None, new_size=(1080, 1080)):
     None
     """
     with Image.open(image_path) as img:
-        # Check if the image is square
+        # Check if the image is square (only the header is read)
         if img.width != img.height:
             raise ValueError("Image is not square. Please provide a square image.")
 
-        # Resize the image
-        img_resized = img.resize(new_size, Image.LANCZOS)
+    transform_image(image_path, output_path or image_path, [('resize', *new_size)])
+    print(f"Resized image saved to {output_path or image_path}")
+
+# Batch transforms
+
+# An operation chain is a list of tuples applied in order to the decoded image:
+#   ('orient',)            apply the EXIF orientation
+#   ('crop',)              crop_image_to_square
+#   ('resize', w, h)       resize to exactly (w, h)
+#   ('max_side', n)        scale_to_max_side
+#   ('recompress', q)      save as JPEG with quality q (otherwise the output extension's format and defaults)
+# Bumped when an operation's output changes, so cached outputs are rebuilt.
+TRANSFORM_VERSION = 2
+TRANSFORM_MANIFEST = ".transforms.json"
+
+# EXIF orientations that transpose the image (rotate by 90 or 270 degrees, possibly mirrored).
+TRANSPOSING_ORIENTATIONS = {5, 6, 7, 8}
+ORIENTATION_TAG = 0x0112
+
+def _output_scale(size, ops, orientation=1):
+    """
+    Follows the image size through an operation chain and returns the overall downscale factor (<= 1) and
+    the output size, so the JPEG decoder can be asked for a reduced image up front.
 
-        # Save the resized image
-        if output_path is None:
-            output_path = image_path
-        img_resized.save(output_path)
-        print(f"Resized image saved to {output_path}")
+    Args:
+        size (tuple): The (width, height) of the stored image.
+        ops (list): The operation chain.
+        orientation (int): The EXIF orientation of the image, applied by an 'orient' operation.
+    """
+    width, height = size
+    scale = 1.0
+    for op in ops:
+        if op[0] == 'orient':
+            # A transposing orientation swaps the axes that later operations are scaled on
+            if orientation in TRANSPOSING_ORIENTATIONS:
+                width, height = height, width
+        elif op[0] == 'crop':
+            width = height = min(width, height)
+        elif op[0] == 'resize':
+            step = max(op[1] / width, op[2] / height)
+            scale *= min(1.0, step)
+            width, height = op[1], op[2]
+        elif op[0] == 'max_side':
+            step = min(1.0, op[1] / max(width, height))
+            scale *= step
+            width, height = max(1, round(width * step)), max(1, round(height * step))
+    return scale, (width, height)
+
+def _apply(img, op):
+    if op[0] == 'orient':
+        return ImageOps.exif_transpose(img)
+    if op[0] == 'crop':
+        return crop_image_to_square(img)
+    if op[0] == 'resize':
+        return img.resize((op[1], op[2]), Image.LANCZOS)
+    if op[0] == 'max_side':
+        return scale_to_max_side(img, op[1])
+    if op[0] == 'recompress':
+        return img
+    raise ValueError(f"Unknown operation {op[0]!r}")
+
+def transform_key(data, ops):
+    """
+    Returns the cache key of an output: the hash of the input bytes, the operation chain and TRANSFORM_VERSION.
+    """
+    digest = hashlib.sha256(data)
+    digest.update(json.dumps([TRANSFORM_VERSION, [list(op) for op in ops]]).encode('utf-8'))
+    return digest.hexdigest()
+
+def transform_image(image_path, output_path, ops, previous_key=None):
+    """
+    Decodes an image once, applies an operation chain and writes the result atomically (to a temporary file
+    that is renamed over output_path). JPEG inputs are decoded in draft mode at the smallest DCT scale that is
+    still at least as large as the chain needs, which makes downscaling much cheaper than a full decode.
+
+    Args:
+    image_path (str): The path to the input image.
+    output_path (str): The path of the output image; may be image_path.
+    ops (list): The operation chain, see above.
+    previous_key (str): Optional; the key of the existing output. If it matches, nothing is written.
+
+    Returns:
+    dict: The paths, the key, whether the output was skipped, and the seconds spent in each stage.
+    """
+    timings = {}
+    start = time.perf_counter()
+    with open(image_path, 'rb') as file:
+        data = file.read()
+    key = transform_key(data, ops)
+    timings['read'] = time.perf_counter() - start
+    if key == previous_key and os.path.exists(output_path):
+        return {'image_path': image_path, 'output_path': output_path, 'key': key, 'skipped': True, **timings}
+
+    start = time.perf_counter()
+    with Image.open(image_path) as img:
+        scale, _ = _output_scale(img.size, ops, img.getexif().get(ORIENTATION_TAG, 1))
+        if img.format == 'JPEG' and scale < 1:
+            img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img.load()
+        exif = img.info.get('exif')
+        timings['decode'] = time.perf_counter() - start
+        for op in ops:
+            start = time.perf_counter()
+            img = _apply(img, op)
+            timings[op[0]] = timings.get(op[0], 0.0) + time.perf_counter() - start
+
+        start = time.perf_counter()
+        quality = [op[1] for op in ops if op[0] == 'recompress']
+        if quality:
+            save_args = {'format': 'JPEG', 'quality': quality[-1], 'optimize': True}
+        else:
+            save_args = {'format': Image.registered_extensions().get(os.path.splitext(output_path)[1].lower(), 'JPEG')}
+        if save_args['format'] == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        # The orientation was applied to the pixels, so the EXIF is only kept when it was not
+        if exif and not any(op[0] == 'orient' for op in ops):
+            save_args['exif'] = exif
+        directory = os.path.dirname(output_path)
+        temp_path = os.path.join(directory, f".{os.path.basename(output_path)}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            img.save(temp_path, **save_args)
+            timings['encode'] = time.perf_counter() - start
+            start = time.perf_counter()
+            os.replace(temp_path, output_path)
+            timings['write'] = time.perf_counter() - start
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return {'image_path': image_path, 'output_path': output_path, 'key': key, 'skipped': False, **timings}
+
+def _transform_job(job):
+    return transform_image(*job)
+
+def folder_manifest(input_folder, output_folder):
+    """
+    Pairs every image of input_folder with the same file name in output_folder.
+    """
+    return [(os.path.join(input_folder, name), os.path.join(output_folder, name))
+            for name in sorted(os.listdir(input_folder)) if name.lower().endswith(('.jpg', '.jpeg', '.png'))]
+
+def batch_transform(manifest, ops, workers=None, force=False):
+    """
+    Applies an operation chain to many images across a process pool. Outputs whose input bytes and chain are
+    unchanged since they were written are skipped; the keys are kept in a .transforms.json file per output folder.
+
+    Args:
+    manifest (list): (input path, output path) pairs, e.g. from folder_manifest.
+    ops (list): The operation chain, see above.
+    workers (int): Optional; the number of worker processes. Defaults to the number of cores.
+    force (bool): If True, rewrite every output.
+
+    Returns:
+    list: One dict per image with its key, whether it was skipped and the seconds spent in each stage.
+    """
+    folders = {os.path.dirname(output_path) for _, output_path in manifest}
+    keys = {}
+    for folder in folders:
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, TRANSFORM_MANIFEST)
+        if os.path.exists(path):
+            with open(path) as file:
+                keys[folder] = json.load(file)
+        else:
+            keys[folder] = {}
+
+    jobs = [(image_path, output_path, ops,
+             None if force else keys[os.path.dirname(output_path)].get(os.path.basename(output_path)))
+            for image_path, output_path in manifest]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_transform_job, jobs, chunksize=8))
+    elapsed = time.perf_counter() - start
+
+    for result in results:
+        keys[os.path.dirname(result['output_path'])][os.path.basename(result['output_path'])] = result['key']
+    for folder, folder_keys in keys.items():
+        path = os.path.join(folder, TRANSFORM_MANIFEST)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(folder_keys, file, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    written = [r for r in results if not r['skipped']]
+    print(f"Transformed {len(written)} images, skipped {len(results) - len(written)} unchanged, in {elapsed:.2f}s")
+    stages = ['read', 'decode'] + list(dict.fromkeys(op[0] for op in ops)) + ['encode', 'write']
+    for stage in stages:
+        total = sum(r.get(stage, 0.0) for r in written)
+        if written:
+            print(f"  {stage:<10} total {total:8.3f}s  mean {1000 * total / len(written):8.2f}ms")
+    return results
 
 # Compile dataset
 
@@ -95,6 +328,8 @@ if __name__ == "__main__":
     #image_path = "test_image_result.jpg"  # Replace with the path to your image
     #resize_image(image_path=image_path, output_path="test_resize_result.jpg")
 
+    #batch_transform(folder_manifest("photos", "photos_1080"), [('orient',), ('crop',), ('resize', 1080, 1080)])
+
     folder_path = "photos_to_rename"
     rename_images_in_folder(folder_path, 1, 32)
 
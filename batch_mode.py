@@ -0,0 +1,246 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+"""
+
+import hashlib
+import json
+import os
+import time
+from openai import OpenAI
+import helpers
+import response_parser
+
+# Limits of a single Batch API input file.
+MAX_SHARD_REQUESTS = 50000
+MAX_SHARD_BYTES = 190 * 1024 * 1024
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+STATE_FILE = "batches.json"
+# The state file is renamed to this once its outputs are merged, so a later job in the same directory starts anew.
+DONE_STATE_FILE = "batches.done.json"
+
+
+class BatchRequestError(Exception):
+    """
+    A request that failed inside a batch, recorded under this error class in the call log.
+    """
+
+
+def requests_hash(requests):
+    """
+    Returns a hash of the custom IDs and request bodies (model, prompt, image path, detail and parameters), which
+    ties submitted batches to the requests they were submitted for.
+    """
+    digest = hashlib.sha256()
+    for request in requests:
+        digest.update(json.dumps([request['custom_id'], request.get('model', helpers.MODEL), request['prompt'],
+                                  request.get('image_path'), request.get('detail'), request.get('params', {})],
+                                 sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def write_batch_files(requests, batch_dir, payload_fn=helpers.image_data_url,
+                      max_requests=MAX_SHARD_REQUESTS, max_bytes=MAX_SHARD_BYTES):
+    """
+    Writes requests to sharded JSONL batch input files.
+
+    Parameters:
+    requests (list): Dicts with 'custom_id', 'prompt', 'image_path' and optional 'model' and 'params'.
+    batch_dir (str): The directory to write the shards to.
+    payload_fn (callable): Maps an image path to the image URL sent with the prompt.
+    max_requests (int): The maximum number of requests per shard.
+    max_bytes (int): The maximum size of a shard in bytes.
+
+    Returns:
+    list: The paths of the written shards.
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    paths = []
+    out = None
+    count = size = 0
+    for request in requests:
+        body = {'model': request.get('model', helpers.MODEL),
+                'messages': helpers.build_messages(request['prompt'],
+                                                 payload_fn(request['image_path']) if request.get('image_path') else None,
+                                                 request.get('detail')),
+                **request.get('params', {})}
+        line = (json.dumps({'custom_id': request['custom_id'], 'method': 'POST',
+                            'url': '/v1/chat/completions', 'body': body}) + "\n").encode('utf-8')
+        if out is None or count >= max_requests or size + len(line) > max_bytes:
+            if out is not None:
+                out.close()
+            paths.append(os.path.join(batch_dir, f"shard_{len(paths):04d}.jsonl"))
+            out = open(paths[-1], "wb")
+            count = size = 0
+        out.write(line)
+        count += 1
+        size += len(line)
+    if out is not None:
+        out.close()
+    return paths
+
+
+def submit_batches(client, paths):
+    """
+    Uploads batch input files and creates one batch per file.
+
+    Returns:
+    list: The batch ids.
+    """
+    batch_ids = []
+    for path in paths:
+        with open(path, "rb") as file:
+            input_file = client.files.create(file=file, purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                      completion_window="24h")
+        print(f"Submitted {path} as {batch.id}")
+        batch_ids.append(batch.id)
+    return batch_ids
+
+
+def wait_for_batches(client, batch_ids, poll_interval=30):
+    """
+    Polls batches until all of them reach a terminal status.
+
+    Returns:
+    list: The final batch objects.
+    """
+    while True:
+        batches = [client.batches.retrieve(batch_id) for batch_id in batch_ids]
+        pending = [batch for batch in batches if batch.status not in TERMINAL_STATUSES]
+        if not pending:
+            return batches
+        print(f"{len(pending)} of {len(batches)} batches still running")
+        time.sleep(poll_interval)
+
+
+def read_batch_file(client, file_id):
+    """
+    Returns the records of a batch output or error file, one dict per JSONL line.
+    """
+    return [json.loads(line) for line in client.files.content(file_id).text.splitlines() if line.strip()]
+
+
+def collect_outputs(client, batches, call_log=None, requests=None):
+    """
+    Downloads the outputs and errors of finished batches. Requests that failed inside a batch are listed in its
+    error file; requests in neither file (e.g. of an expired or cancelled batch) are failed as well.
+
+    Parameters:
+    client (OpenAI): The client.
+    batches (list): The finished batches.
+    call_log (CallLog): Optional; the usage and errors of every output and error line are recorded in this
+        instrumentation log, without a latency.
+    requests (dict): Mapping of custom_id to request, used to label the call log records and to find requests
+        without a line.
+
+    Returns:
+    dict: Mapping of custom_id to response text, or None for failed requests.
+    """
+    outputs = {}
+    for batch in batches:
+        if batch.status != 'completed':
+            print(f"Batch {batch.id} ended with status {batch.status}")
+        records = []
+        for file_id in [batch.output_file_id, getattr(batch, 'error_file_id', None)]:
+            if file_id:
+                records += read_batch_file(client, file_id)
+        for record in records:
+            response = record.get('response') or {}
+            failed = record.get('error') or response.get('status_code') != 200
+            if failed:
+                print(f"Error processing {record['custom_id']}: {record.get('error') or response}")
+                outputs[record['custom_id']] = None
+            else:
+                outputs[record['custom_id']] = response_parser.join_samples(
+                    [choice['message']['content'].strip() for choice in response['body']['choices']])
+            if call_log is not None:
+                request = (requests or {}).get(record['custom_id'], {'custom_id': record['custom_id']})
+                error = BatchRequestError(record.get('error') or response.get('status_code')) if failed else None
+                call_log.record(request, None, (response.get('body') or {}).get('usage'), error=error, batch=True)
+    missing = [custom_id for custom_id in (requests or {}) if custom_id not in outputs]
+    if missing:
+        print(f"No output or error line for {len(missing)} requests")
+    for custom_id in missing:
+        outputs[custom_id] = None
+        if call_log is not None:
+            call_log.record(requests[custom_id], None, None, error=BatchRequestError('missing'), batch=True)
+    return outputs
+
+
+def run_requests_batch(requests, batch_dir, client=None, payload_fn=helpers.image_data_url, poll_interval=30,
+                       cache=None, on_result=None, call_log=None, **engine_kwargs):
+    """
+    Runs requests through the Batch API: writes sharded input files, submits them, waits for completion and
+    merges the outputs back by custom_id. Has the same contract as request_engine.run_requests.
+
+    If batch_dir already holds batches submitted for the same requests (e.g. after a crash while polling), they
+    are polled again instead of being resubmitted. Once the outputs are merged the state file is renamed to
+    DONE_STATE_FILE, with the custom IDs of the failed requests, so a later job in the same directory submits its
+    own requests. Failed requests are neither cached nor journaled, so running the job again resubmits only them.
+
+    Parameters:
+    requests (list): Dicts with 'key', 'custom_id', 'prompt', 'image_path' and optional 'model' and 'params'.
+    batch_dir (str): The working directory of this batch job.
+    client (OpenAI): Optional; the client to use. A new one is created if None.
+    payload_fn (callable): Maps an image path to the image URL sent with the prompt.
+    poll_interval (float): Seconds between status polls.
+    cache (ResponseCache): Optional; cached requests are not submitted and new responses are stored.
+    on_result (callable): Optional; called as on_result(key, content) for every request.
+    call_log (CallLog): Optional; the instrumentation log to record the usage of every output in.
+    **engine_kwargs: Options of request_engine.run_requests that do not apply to batches, such as concurrency
+        and the rate limits, so that run_stage can pass the same options to either; they are ignored.
+
+    Returns:
+    dict: Mapping of each request key to the response text or None.
+    """
+    results = {}
+    pending = []
+    for request in requests:
+        content = cache.get(request) if cache is not None else None
+        if content is not None or (cache is not None and cache.offline):
+            results[request['key']] = content
+        else:
+            pending.append(request)
+
+    if pending:
+        client = client or OpenAI()
+        state_path = os.path.join(batch_dir, STATE_FILE)
+        pending_hash = requests_hash(pending)
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as file:
+                state = json.load(file)
+            if state.get('requests_hash') != pending_hash:
+                print(f"Ignoring {state_path}: its batches were submitted for other requests")
+                state = {}
+        if state:
+            batch_ids = state['batch_ids']
+            print(f"Resuming {len(batch_ids)} submitted batches from {state_path}")
+        else:
+            paths = write_batch_files(pending, batch_dir, payload_fn)
+            batch_ids = submit_batches(client, paths)
+            with open(state_path, "w") as file:
+                json.dump({'batch_ids': batch_ids, 'requests_hash': pending_hash}, file)
+        outputs = collect_outputs(client, wait_for_batches(client, batch_ids, poll_interval), call_log,
+                                  {request['custom_id']: request for request in pending})
+        failed = []
+        for request in pending:
+            content = outputs.get(request['custom_id'])
+            if content is None:
+                failed.append(request['custom_id'])
+            if cache is not None:
+                cache.put(request, content)
+            results[request['key']] = content
+        with open(state_path, "w") as file:
+            json.dump({'batch_ids': batch_ids, 'requests_hash': pending_hash, 'failed': failed}, file)
+        os.replace(state_path, os.path.join(batch_dir, DONE_STATE_FILE))
+        if failed:
+            print(f"{len(failed)} requests failed in the batch; run the job again to resubmit them")
+
+    if on_result is not None:
+        for key, content in results.items():
+            on_result(key, content)
+    if call_log is not None:
+        call_log.flush()
+    print(f"Batch job {batch_dir}: {len(results)} results, {len(pending)} sent")
+    return results
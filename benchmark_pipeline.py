@@ -0,0 +1,159 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+End-to-end throughput benchmark of the evaluation pipeline (initial count -> hints -> split -> hint
+ablations -> RMSE) against the local mock server, at several synthetic dataset sizes.
+"""
+
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import gpt4_evaluation
+import mock_openai_server
+import rmse_evaluation
+
+SIZES = [300, 6000, 60000]
+
+
+def make_synthetic_dataset(images_path, labels_csv, n, output_path):
+    """
+    Builds a synthetic dataset of n images by cycling through the labelled images under new names.
+    Images are hardlinked where possible so large datasets take no extra disk space.
+
+    Parameters:
+    images_path (str): The directory containing the labelled images.
+    labels_csv (str): The label CSV with filenames, classes and object counts.
+    n (int): The number of synthetic images.
+    output_path (str): The directory to write the images/ folder and labels.csv to.
+
+    Returns:
+    tuple: (synthetic images directory, synthetic label CSV path).
+    """
+    labels = pd.read_csv(labels_csv)
+    images_out = os.path.join(output_path, "images")
+    os.makedirs(images_out, exist_ok=True)
+    rows = []
+    for i in range(n):
+        source = labels.iloc[i % len(labels)]
+        filename = f"{i:06d}_{source['filename']}"
+        destination = os.path.join(images_out, filename)
+        if not os.path.exists(destination):
+            try:
+                os.link(os.path.join(images_path, source['filename']), destination)
+            except OSError:
+                shutil.copy(os.path.join(images_path, source['filename']), destination)
+        rows.append({'filename': filename, 'class': source['class'], 'object_count': source['object_count']})
+    labels_out = os.path.join(output_path, "labels.csv")
+    pd.DataFrame(rows).to_csv(labels_out, index=False)
+    return images_out, labels_out
+
+
+def _serve(queue, labels_csv, images_path, server_kwargs):
+    server = mock_openai_server.MockOpenAIServer(
+        responder=mock_openai_server.label_responder(labels_csv, images_path), **server_kwargs)
+    queue.put(server.base_url)
+    server.serve_forever()
+
+
+def start_mock_process(labels_csv, images_path, **server_kwargs):
+    """
+    Starts the mock server in a separate process so its CPU time and memory are not counted.
+
+    Returns:
+    tuple: (the server process, its base URL).
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(queue, labels_csv, images_path, server_kwargs),
+                                      daemon=True)
+    process.start()
+    return process, queue.get(timeout=60)
+
+
+def mock_stats(base_url):
+    with urllib.request.urlopen(f"{base_url}/_mock/stats") as response:
+        return json.load(response)
+
+
+def _run_pipeline(images_path, labels_csv, work_path, base_url, engine_kwargs):
+    """
+    Runs the whole pipeline in a fresh process and returns its wall time, CPU time, peak RSS and RMSE.
+    """
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'mock')
+    evaluation_csv = os.path.join(work_path, "gpt4_evaluation.csv")
+    journal_path = os.path.join(work_path, "journal.jsonl")
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    gpt4_evaluation.run_pipeline(images_path, labels_csv, evaluation_csv, journal_path,
+                                 hint_configs=gpt4_evaluation.HINT_CONFIGS, **engine_kwargs)
+    df = pd.read_csv(evaluation_csv)
+    rmse = rmse_evaluation.calculate_rmse_for_ranges(df, 'object_count', 'response_desc_true_direct_true_indirect_true')
+    return {
+        'wall_time_s': time.perf_counter() - wall_start,
+        'cpu_time_s': time.process_time() - cpu_start,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'rmse_all_hints': float(rmse['Overall performance']),
+    }
+
+
+def run_benchmark(sizes=SIZES, images_path="FSC147_384_V2/selected_300_images",
+                  labels_csv="FSC147_384_V2/300_image_labels.csv", work_path="results/benchmark",
+                  latency_median=0.05, latency_sigma=0.5, error_rate=0.0, rate_limit_rate=0.0,
+                  concurrency=64, output_csv=None):
+    """
+    Runs the pipeline against the mock server at each dataset size and reports wall time, CPU time,
+    peak RSS and requests/s.
+
+    Parameters:
+    sizes (list): The synthetic dataset sizes.
+    images_path (str): The directory containing the labelled images.
+    labels_csv (str): The label CSV with filenames, classes and object counts.
+    work_path (str): The directory for the synthetic datasets and pipeline outputs.
+    latency_median (float): The median mock latency in seconds (lognormal).
+    latency_sigma (float): The log-space sigma of the mock latency.
+    error_rate (float): The fraction of injected 500 errors.
+    rate_limit_rate (float): The fraction of injected 429 errors.
+    concurrency (int): The request engine concurrency.
+    output_csv (str): Optional; the path to write the report to.
+
+    Returns:
+    DataFrame: One row per dataset size.
+    """
+    engine_kwargs = {'concurrency': concurrency, 'requests_per_minute': 1e9, 'tokens_per_minute': 1e12}
+    rows = []
+    for size in sizes:
+        size_path = os.path.join(work_path, str(size))
+        synthetic_images, synthetic_labels = make_synthetic_dataset(images_path, labels_csv, size, size_path)
+        process, base_url = start_mock_process(
+            labels_csv, images_path,
+            latency=mock_openai_server.latency_sampler('lognormal', latency_median, latency_sigma),
+            error_rate=error_rate, rate_limit_rate=rate_limit_rate)
+        try:
+            # A fresh process per size keeps peak RSS per run.
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                result = pool.submit(_run_pipeline, synthetic_images, synthetic_labels, size_path, base_url,
+                                     engine_kwargs).result()
+            stats = mock_stats(base_url)
+        finally:
+            process.terminate()
+        rows.append({'images': size, **result, 'requests': stats['requests'],
+                     'requests_per_s': stats['requests'] / result['wall_time_s'],
+                     'errors': stats['errors'], 'rate_limited': stats['rate_limited']})
+        print(rows[-1])
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    if output_csv is not None:
+        report.to_csv(output_csv, index=False)
+    return report
+
+
+if __name__ == "__main__":
+    run_benchmark(output_csv="results/pipeline_benchmark.csv")
@@ -0,0 +1,191 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Bootstrap confidence intervals for the RMSE table and paired bootstrap tests between methods.
+"""
+
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import rmse_evaluation
+
+
+def _resample_rmse(job):
+    """
+    Computes the RMSE of every method in every bin for one chunk of bootstrap resamples.
+
+    The resample indices are drawn as one (resamples, rows) matrix and turned into per-row weights, so the
+    sums of squared errors of all methods are one matrix product per bin.
+    """
+    seed, resamples, squared_error, valid, bin_rows = job
+    n = squared_error.shape[0]
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, n, size=(resamples, n))
+    offsets = np.arange(resamples)[:, None] * n
+    weights = np.bincount((indices + offsets).ravel(), minlength=resamples * n).reshape(resamples, n)
+    rmse = np.empty((resamples, len(bin_rows), squared_error.shape[1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for b, rows in enumerate(bin_rows):
+            bin_weights = weights[:, rows].astype(float)
+            rmse[:, b] = np.sqrt((bin_weights @ squared_error[rows]) / (bin_weights @ valid[rows]))
+    return rmse
+
+
+def bootstrap_rmse(df, correct_counts_column, method_columns, bins=rmse_evaluation.COUNT_BINS, resamples=10000,
+                   seed=0, chunk_size=500, workers=1):
+    """
+    Draws bootstrap resamples of the images and computes the RMSE of every method in every count bin for each.
+
+    All methods are evaluated on the same resamples, so differences between methods are paired. Resamples
+    are processed in chunks of chunk_size, each with its own seed spawned from seed, so the result is the
+    same for any number of workers.
+
+    Parameters:
+    df (DataFrame): The DataFrame containing the correct counts and the method columns.
+    correct_counts_column (str): The column name containing the correct object counts.
+    method_columns (list): The method columns to evaluate.
+    bins (list): The increasing upper edges of the count bins.
+    resamples (int): The number of bootstrap resamples.
+    seed (int): The random seed.
+    chunk_size (int): The number of resamples drawn at once; bounds memory at about chunk_size x rows weights.
+    workers (int): The number of worker processes; None uses all cores.
+
+    Returns:
+    ndarray: RMSE of shape (resamples, bins + 1, methods); the last bin is the overall RMSE.
+    """
+    truth = pd.to_numeric(df[correct_counts_column], errors='coerce').to_numpy(dtype=float)
+    df = df[~np.isnan(truth)]
+    truth = truth[~np.isnan(truth)]
+    predictions = df[list(method_columns)].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    valid = ~np.isnan(predictions)
+    squared_error = np.where(valid, predictions - truth[:, None], 0) ** 2
+    valid = valid.astype(float)
+
+    bin_index = np.searchsorted(np.asarray(bins, dtype=float), truth, side='right')
+    bin_rows = [np.flatnonzero(bin_index == b) for b in range(len(bins) + 1)] + [np.arange(len(truth))]
+
+    sizes = [min(chunk_size, resamples - start) for start in range(0, resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(s, size, squared_error, valid, bin_rows) for s, size in zip(seeds, sizes)]
+    if workers == 1:
+        chunks = [_resample_rmse(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(_resample_rmse, jobs))
+    return np.concatenate(chunks)
+
+
+def confidence_intervals(samples, point, method_names, bins=rmse_evaluation.COUNT_BINS, alpha=0.05):
+    """
+    Percentile bootstrap confidence intervals of the RMSE of each method in each bin.
+
+    Parameters:
+    samples (ndarray): The output of bootstrap_rmse.
+    point (DataFrame): The compute_metrics output for the same methods, for the point estimates.
+    method_names (list): The names of the methods, in the order of the method columns.
+    bins (list): The bin edges used for samples.
+    alpha (float): One minus the confidence level.
+
+    Returns:
+    DataFrame: One row per (method, bin) with RMSE, CI low and CI high.
+    """
+    labels = rmse_evaluation.bin_labels(bins) + ['Overall']
+    low, high = np.nanpercentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return pd.DataFrame({
+        'Method': np.repeat(method_names, len(labels)),
+        'Bin': np.tile(labels, len(method_names)),
+        'RMSE': point['RMSE'].to_numpy(),
+        'CI low': low.T.ravel(),
+        'CI high': high.T.ravel(),
+    })
+
+
+def paired_tests(samples, point, method_names, bins=rmse_evaluation.COUNT_BINS, alpha=0.05, chunk_pairs=64):
+    """
+    Paired bootstrap tests of the RMSE difference of every pair of methods in every bin.
+
+    The p-value tests whether the RMSE difference is zero (two-sided). The resampled differences, centered on
+    the observed difference, approximate its distribution under that null hypothesis; the p-value is the
+    fraction of centered differences at least as large in absolute value as the observed difference.
+
+    Parameters:
+    samples (ndarray): The output of bootstrap_rmse.
+    point (DataFrame): The compute_metrics output for the same methods, for the point estimates.
+    method_names (list): The names of the methods, in the order of the method columns.
+    bins (list): The bin edges used for samples.
+    alpha (float): One minus the confidence level of the difference intervals.
+    chunk_pairs (int): The number of method pairs compared at once, to bound memory.
+
+    Returns:
+    DataFrame: One row per (method A, method B, bin) with the RMSE difference A - B, its CI and p-value.
+    """
+    labels = rmse_evaluation.bin_labels(bins) + ['Overall']
+    point_rmse = point['RMSE'].to_numpy().reshape(len(method_names), len(labels))
+    pairs = np.array(list(itertools.combinations(range(len(method_names)), 2)), dtype=int).reshape(-1, 2)
+    frames = []
+    for start in range(0, len(pairs), chunk_pairs):
+        a, b = pairs[start:start + chunk_pairs].T
+        diff = samples[:, :, a] - samples[:, :, b]
+        observed = (point_rmse[a] - point_rmse[b]).T
+        resampled = (~np.isnan(diff)).sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            extreme = (np.abs(diff - observed) >= np.abs(observed)).sum(axis=0)
+            p_value = np.where(np.isnan(observed), np.nan, extreme / resampled)
+        low, high = np.nanpercentile(diff, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+        frames.append(pd.DataFrame({
+            'Method A': np.repeat(np.asarray(method_names)[a], len(labels)),
+            'Method B': np.repeat(np.asarray(method_names)[b], len(labels)),
+            'Bin': np.tile(labels, len(a)),
+            'RMSE difference': (point_rmse[a] - point_rmse[b]).ravel(),
+            'CI low': low.T.ravel(),
+            'CI high': high.T.ravel(),
+            'p-value': p_value.T.ravel(),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def bootstrap_evaluation(human_file, gpt4_file, intervals_file, tests_file, bins=rmse_evaluation.COUNT_BINS,
+                         resamples=10000, seed=0, alpha=0.05, workers=1):
+    """
+    Writes bootstrap confidence intervals of the RMSE of the human and GPT methods and paired tests between
+    every pair of them. The human answers are joined on filename so all methods share the same resamples.
+
+    Parameters:
+    human_file (str): Path to the CSV file with human evaluation data.
+    gpt4_file (str): Path to the CSV file with GPT evaluation data.
+    intervals_file (str): Path to write the confidence intervals to.
+    tests_file (str): Path to write the paired tests to.
+    bins (list): The increasing upper edges of the count bins.
+    resamples (int): The number of bootstrap resamples.
+    seed (int): The random seed.
+    alpha (float): One minus the confidence level.
+    workers (int): The number of worker processes; None uses all cores.
+
+    Returns:
+    tuple: (confidence intervals DataFrame, paired tests DataFrame).
+    """
+    df = pd.read_csv(gpt4_file).merge(pd.read_csv(human_file)[['filename', 'human']], on='filename', how='left')
+    methods = {'Human': 'human', **rmse_evaluation.GPT_METHODS}
+    columns = list(methods.values())
+
+    point = rmse_evaluation.compute_metrics(df, 'object_count', columns, bins)
+    samples = bootstrap_rmse(df, 'object_count', columns, bins, resamples, seed, workers=workers)
+    intervals = confidence_intervals(samples, point, list(methods), bins, alpha)
+    tests = paired_tests(samples, point, list(methods), bins, alpha)
+
+    intervals.to_csv(intervals_file, index=False)
+    tests.to_csv(tests_file, index=False)
+    print(intervals[intervals['Bin'] == 'Overall'].to_string(index=False))
+    print(tests[tests['Bin'] == 'Overall'].to_string(index=False))
+    return intervals, tests
+
+
+if __name__ == "__main__":
+    human_file = "results/human_evaluation.csv"
+    gpt4_file = "results/gpt4_evaluation.csv"
+
+    bootstrap_evaluation(human_file, gpt4_file, "results/rmse_confidence_intervals.csv",
+                         "results/rmse_paired_tests.csv")
+    # bootstrap_evaluation(human_file, gpt4_file, "results/rmse_confidence_intervals.csv",
+    #                      "results/rmse_paired_tests.csv", workers=None)
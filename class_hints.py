@@ -0,0 +1,289 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Class-level hint cache. The indirect hint (how objects of a class are usually arranged, grouped or packed)
+depends on the object class rather than on the image, so it is generated once per class with a text-only
+request (no image payload) and kept in a CSV cache shared by later runs. Only the per-image fields,
+description and direct hint, go through the vision request of the hint stage.
+"""
+
+import os
+import pandas as pd
+import helpers
+import request_engine
+import gpt4_evaluation
+import response_parser
+import rmse_evaluation
+
+class_hints_path = 'results/class_hints.csv'
+classes_path = 'FSC147_384_V2/ImageClasses_FSC147.txt'
+
+CLASS_HINT_COLUMNS = ['class', 'model', 'indirect_hint', 'full_response']
+
+
+def dataset_classes(path=classes_path):
+    """
+    Returns the distinct object classes of the full FSC147 dataset, read from ImageClasses_FSC147.txt
+    (one "filename<TAB>class" line per image), in order of first appearance.
+    """
+    classes = pd.read_csv(path, sep='\t', header=None, names=['filename', 'class'])['class']
+    return list(classes.drop_duplicates())
+
+
+def load_class_hints(hints_path=class_hints_path, model=helpers.MODEL):
+    """
+    Loads the cached class hints of one model.
+
+    Parameters:
+    hints_path (str): The class hint CSV.
+    model (str): The model the hints were generated with.
+
+    Returns:
+    dict: Mapping of class to indirect hint.
+    """
+    if not os.path.exists(hints_path):
+        return {}
+    hints = pd.read_csv(hints_path, keep_default_na=False)
+    hints = hints[hints['model'] == model]
+    return dict(zip(hints['class'], hints['indirect_hint']))
+
+
+def class_indirect_hint(full_response):
+    """
+    Reads the indirect hint from a class hint response: the "Indirect hint" section if the model kept the
+    heading of the prompt, otherwise the whole response.
+    """
+    if not isinstance(full_response, str):
+        return None
+    indirect_hint = response_parser.parse_side_information(full_response)[2]
+    return indirect_hint or full_response.strip() or None
+
+
+def generate_class_hints(classes, hints_path=class_hints_path, model=helpers.MODEL, max_tokens=None,
+                         **engine_kwargs):
+    """
+    Returns the indirect hint of every class, sending one text-only request per class that is not in the
+    cache yet and appending the new hints to it.
+
+    Parameters:
+    classes (list): The object classes, e.g. the 'class' column of a label CSV or dataset_classes().
+    hints_path (str): The class hint CSV.
+    model (str): The model to generate the hints with.
+    max_tokens (int): Optional; the output token budget per hint.
+    **engine_kwargs: Options passed to gpt4_evaluation.dispatch, e.g. concurrency and rate limits, cache, or
+        batch_dir.
+
+    Returns:
+    tuple: (dict mapping each class to its indirect hint, or None if the request failed, number of classes
+        sent to the model).
+    """
+    hints = load_class_hints(hints_path, model)
+    missing = [c for c in dict.fromkeys(classes) if c not in hints]
+    requests = []
+    for object_name in missing:
+        request = {'key': object_name, 'custom_id': f"{object_name}|class_hint|", 'image_path': None,
+                   'model': model, 'prompt': helpers.class_indirect_hint_prompt(object_name)}
+        if max_tokens is not None:
+            request['params'] = {'max_tokens': max_tokens}
+        requests.append(request)
+    if requests:
+        print(f"Generating class hints: {len(requests)} new classes, {len(hints)} cached")
+        batch_dir = engine_kwargs.pop('batch_dir', None)
+        if batch_dir is not None:
+            batch_dir = os.path.join(batch_dir, "class_hints")
+        results = gpt4_evaluation.dispatch(requests, batch_dir=batch_dir, **engine_kwargs)
+        rows = [(object_name, model, class_indirect_hint(results.get(object_name)), results.get(object_name))
+                for object_name in missing if class_indirect_hint(results.get(object_name))]
+        if rows:
+            directory = os.path.dirname(hints_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            pd.DataFrame(rows, columns=CLASS_HINT_COLUMNS).to_csv(
+                hints_path, mode='a', header=not os.path.exists(hints_path), index=False)
+            hints.update((row[0], row[2]) for row in rows)
+        if len(rows) < len(missing):
+            print(f"Class hints failed for {len(missing) - len(rows)} classes")
+    return {object_name: hints.get(object_name) for object_name in classes}, len(requests)
+
+
+def get_hints(images_path, csv_to_read, csv_to_write, hints_path=class_hints_path, journal=None, max_tokens=None,
+              variant_policy=None, **engine_kwargs):
+    """
+    Counterpart of gpt4_evaluation.get_hints that takes the indirect hint from the class hint cache: the
+    vision request of every image asks only for the description and direct hint, and the columns are split
+    here, so split_response is not needed.
+
+    Parameters:
+    images_path (str): The directory path where images are stored.
+    csv_to_read (str): The path to the CSV file containing image filenames and object names.
+    csv_to_write (str): The path to write the updated CSV file to.
+    hints_path (str): The class hint CSV.
+    journal (RunJournal): Optional; the checkpoint journal to resume the per-image requests from. Use a journal
+        of its own, not the one of a run with per-image indirect hints.
+    max_tokens (int): Optional; the output token budget per response.
+    variant_policy (VariantPolicy): Optional; picks the image variant of each vision request.
+    **engine_kwargs: Options passed to run_stage and dispatch, e.g. concurrency and rate limits, cache, or
+        batch_dir.
+
+    Returns:
+    int: The number of class hints sent to the model (classes not yet in the cache).
+    """
+    df = pd.read_csv(csv_to_read)
+    class_hints, sent = generate_class_hints(df['class'].unique(), hints_path, max_tokens=max_tokens,
+                                             **engine_kwargs)
+
+    params = {'max_tokens': max_tokens} if max_tokens is not None else None
+    results = gpt4_evaluation.run_stage(df, images_path, 'image_hints',
+                                        lambda row: helpers.image_side_information_prompt(row['class']),
+                                        journal=journal, params=params, variant_policy=variant_policy,
+                                        **engine_kwargs)
+    df['full_response'] = pd.Series(results, dtype=object)
+    sections, statistics = response_parser.split_sections(df['full_response'])
+    df['description'] = sections['description']
+    df['direct_hint'] = sections['direct_hint']
+    df['indirect_hint'] = df['class'].map(class_hints)
+
+    print(f"Number of NA's in Description: {df['description'].isna().sum()}")
+    print(f"Number of NA's in Direct Hint: {df['direct_hint'].isna().sum()}")
+    print(f"Number of NA's in Indirect Hint: {df['indirect_hint'].isna().sum()}")
+    print("Heading variants matched:")
+    response_parser.print_variant_statistics(statistics)
+    df.to_csv(csv_to_write, index=False)
+    return sent
+
+
+def _tokens(text):
+    # Same 4 characters per token estimate as request_engine.estimate_tokens
+    return len(text) // 4 if isinstance(text, str) else 0
+
+
+def savings_report(df, baseline_df=None, hints_path=class_hints_path, model=helpers.MODEL, sent=None):
+    """
+    Compares the cost of the hint stage with per-image indirect hints (one vision request per image) and with
+    class-level indirect hints (one vision request per image for the other fields, plus one text-only request
+    per class). Tokens are estimated at 4 characters per token, with request_engine.IMAGE_TOKEN_ESTIMATE per
+    image.
+
+    Parameters:
+    df (DataFrame): The output of get_hints, with 'class' and 'full_response' columns.
+    baseline_df (DataFrame): Optional; an evaluation CSV of a per-image hint run, whose 'full_response'
+        lengths give the baseline completion tokens. Without it they are estimated from the new responses
+        plus the class hints.
+    hints_path (str): The class hint CSV.
+    model (str): The model of the class hints.
+    sent (int): Optional; the number of class hints sent in this run, shown as its own row.
+
+    Returns:
+    DataFrame: Per-image hints, Class hints and Saved per metric.
+    """
+    df = df[df['full_response'].notna()]
+    cached = pd.read_csv(hints_path, keep_default_na=False) if os.path.exists(hints_path) else \
+        pd.DataFrame(columns=CLASS_HINT_COLUMNS)
+    cached = cached[(cached['model'] == model) & cached['class'].isin(df['class'])].drop_duplicates('class')
+    image_tokens = request_engine.IMAGE_TOKEN_ESTIMATE
+
+    baseline_prompt = sum(_tokens(helpers.side_information_prompt(c)) + image_tokens for c in df['class'])
+    if baseline_df is not None:
+        baseline_responses = df['filename'].map(baseline_df.set_index('filename')['full_response'])
+    else:
+        baseline_responses = df['full_response'] + "\n" + df['class'].map(
+            dict(zip(cached['class'], cached['full_response'])))
+    baseline_completion = sum(_tokens(response) for response in baseline_responses)
+
+    class_prompt = sum(_tokens(helpers.image_side_information_prompt(c)) + image_tokens for c in df['class']) + \
+        sum(_tokens(helpers.class_indirect_hint_prompt(c)) for c in cached['class'])
+    class_completion = sum(_tokens(response) for response in df['full_response']) + \
+        sum(_tokens(response) for response in cached['full_response'])
+
+    rows = [('Vision calls', len(df), len(df)),
+            ('Text-only calls', 0, len(cached)),
+            ('Indirect hint generations', len(df), len(cached)),
+            ('Image tokens', len(df) * image_tokens, len(df) * image_tokens),
+            ('Prompt tokens (with image)', baseline_prompt, class_prompt),
+            ('Completion tokens', baseline_completion, class_completion),
+            ('Total tokens', baseline_prompt + baseline_completion, class_prompt + class_completion)]
+    report = pd.DataFrame(rows, columns=['Metric', 'Per-image hints', 'Class hints'])
+    report['Saved'] = report['Per-image hints'] - report['Class hints']
+    if sent is not None:
+        print(f"Class hints sent this run: {sent} (the other {len(cached) - sent} classes came from the cache)")
+    return report
+
+
+def compare_ablation_rmse(baseline_df, df, hint_configs=gpt4_evaluation.HINT_CONFIGS,
+                          bins=rmse_evaluation.COUNT_BINS):
+    """
+    Compares the RMSE of each hint configuration with per-image and with class-level indirect hints.
+
+    Parameters:
+    baseline_df (DataFrame): An evaluation CSV with per-image hints.
+    df (DataFrame): The evaluation CSV with class-level hints.
+    hint_configs (list): The (description, direct, indirect) combinations to compare.
+    bins (list): The increasing upper edges of the count bins.
+
+    Returns:
+    DataFrame: Config, Bin, RMSE per-image hints, RMSE class hints and Change (class minus per-image).
+    """
+    columns = ["response_" + gpt4_evaluation.hint_config_name(*config) for config in hint_configs]
+    columns = [c for c in columns if c in baseline_df.columns and c in df.columns]
+    baseline = rmse_evaluation.compute_metrics(baseline_df, 'object_count', columns, bins)
+    class_level = rmse_evaluation.compute_metrics(df, 'object_count', columns, bins)
+    merged = baseline[['Method', 'Bin', 'RMSE']].merge(class_level[['Method', 'Bin', 'RMSE']], on=['Method', 'Bin'],
+                                                       suffixes=(' per-image hints', ' class hints'))
+    merged['Change'] = merged['RMSE class hints'] - merged['RMSE per-image hints']
+    merged['Method'] = merged['Method'].str[len('response_'):]
+    return merged.rename(columns={'Method': 'Config'})
+
+
+def run_class_hint_evaluation(images_path, csv_to_read, csv_to_write, baseline_csv=None, hints_path=class_hints_path,
+                              hint_configs=gpt4_evaluation.HINT_CONFIGS, report_csv=None, journal=None,
+                              variant_policy=None, **engine_kwargs):
+    """
+    Runs the hint stage with class-level indirect hints and the hint ablations on its output, then reports
+    the calls and tokens saved in the hint stage and the RMSE change of each configuration against a run with
+    per-image hints.
+
+    Parameters:
+    images_path (str): The directory path where images are stored.
+    csv_to_read (str): The label CSV, or an evaluation CSV to keep its initial answers.
+    csv_to_write (str): The path of the evaluation CSV to write.
+    baseline_csv (str): Optional; an evaluation CSV with per-image hints and the same configurations,
+        e.g. results/gpt4_evaluation.csv.
+    hints_path (str): The class hint CSV.
+    hint_configs (list): The (description, direct, indirect) combinations to run.
+    report_csv (str): Optional; the path prefix of the two reports (<prefix>_savings.csv, <prefix>_rmse.csv).
+    journal (RunJournal): Optional; a checkpoint journal of its own for this run.
+    variant_policy (VariantPolicy): Optional; picks the image variant of the hint and ablation requests.
+    **engine_kwargs: Options passed to the stages, e.g. concurrency and rate limits, cache, or payload_fn.
+
+    Returns:
+    tuple: (savings report, RMSE comparison or None without a baseline).
+    """
+    sent = get_hints(images_path, csv_to_read, csv_to_write, hints_path, journal=journal,
+                     variant_policy=variant_policy, **engine_kwargs)
+    gpt4_evaluation.run_hint_ablations(csv_in=csv_to_write, csv_out=csv_to_write, hint_configs=hint_configs,
+                                       images_path=images_path, journal=journal, variant_policy=variant_policy,
+                                       **engine_kwargs)
+    df = pd.read_csv(csv_to_write)
+    baseline_df = pd.read_csv(baseline_csv) if baseline_csv is not None else None
+    savings = savings_report(df, baseline_df, hints_path, sent=sent)
+    print(savings.to_string(index=False))
+    comparison = None
+    if baseline_df is not None:
+        comparison = compare_ablation_rmse(baseline_df, df, hint_configs)
+        print(comparison.to_string(index=False))
+    if report_csv is not None:
+        root, _ = os.path.splitext(report_csv)
+        savings.to_csv(root + "_savings.csv", index=False)
+        if comparison is not None:
+            comparison.to_csv(root + "_rmse.csv", index=False)
+    return savings, comparison
+
+
+if __name__ == "__main__":
+    images_path = "FSC147_384_V2/selected_300_images"
+    csv_path = "FSC147_384_V2/300_image_labels.csv"
+    gpt4_evaluation_csv_path = "results/gpt4_evaluation.csv"
+    class_hint_evaluation_csv_path = "results/gpt4_evaluation_class_hints.csv"
+    run_class_hint_evaluation(images_path, gpt4_evaluation_csv_path, class_hint_evaluation_csv_path,
+                              baseline_csv=gpt4_evaluation_csv_path, report_csv="results/class_hints_report.csv")
+    # generate_class_hints(dataset_classes())
@@ -0,0 +1,379 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Indexed SQLite manifest of the FSC147 dataset (class, point count, exemplar count, image size, split and file
+metadata per image), built once and updated incrementally, with deterministic stratified sampling on top, and
+zero-copy materialization of samples as image directories.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import fsc147_annotations
+import rmse_evaluation
+
+source_folder = 'FSC147_384_V2/images_384_VarV2'
+classes_path = 'FSC147_384_V2/ImageClasses_FSC147.txt'
+split_path = 'FSC147_384_V2/Train_Test_Val_FSC_147.json'
+annotation_json_path = 'FSC147_384_V2/annotation_FSC147_384.json'
+
+# ioctl request that clones a file's extents (a reflink) on filesystems such as Btrfs and XFS.
+FICLONE = 0x40049409
+LINK_MODES = ['hardlink', 'reflink', 'symlink', 'copy']
+
+# An image listed in several splits is assigned the first one in this order.
+SPLIT_ORDER = ['train', 'val', 'test', 'val_coco', 'test_coco']
+
+def read_splits(path=split_path):
+    """
+    Reads the train/val/test split JSON.
+
+    Returns:
+    dict: Mapping of filename to split; an image listed in several splits gets the first one in SPLIT_ORDER.
+    """
+    with open(path) as file:
+        splits = json.load(file)
+    split_of = {}
+    for split in sorted(splits, key=lambda s: SPLIT_ORDER.index(s) if s in SPLIT_ORDER else len(SPLIT_ORDER)):
+        for filename in splits[split]:
+            split_of.setdefault(filename, split)
+    return split_of
+
+class Manifest:
+    """
+    SQLite manifest with one row per image.
+
+    Parameters:
+    path (str): The path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                filename TEXT PRIMARY KEY,
+                class TEXT,
+                object_count INTEGER,
+                exemplar_count INTEGER,
+                height INTEGER,
+                width INTEGER,
+                split TEXT,
+                file_size INTEGER,
+                mtime_ns INTEGER,
+                present INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID""")
+        for column in ['class', 'object_count', 'split']:
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS images_{column} ON images ({column})")
+        # The size and modification time of each source file when it was last loaded.
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sources (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )""")
+        self.conn.commit()
+
+    def _source_changed(self, name, path):
+        stat = os.stat(path)
+        row = self.conn.execute("SELECT size, mtime_ns FROM sources WHERE name = ?", (name,)).fetchone()
+        return row != (stat.st_size, stat.st_mtime_ns)
+
+    def _mark_source(self, name, path):
+        stat = os.stat(path)
+        self.conn.execute("INSERT OR REPLACE INTO sources (name, size, mtime_ns) VALUES (?, ?, ?)",
+                          (name, stat.st_size, stat.st_mtime_ns))
+
+    def _upsert(self, columns, rows):
+        """
+        Inserts rows of (filename, *columns) values, updating only the given columns of existing images.
+        """
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns)
+        self.conn.executemany(
+            f"INSERT INTO images (filename, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))}) "
+            f"ON CONFLICT (filename) DO UPDATE SET {updates}", rows)
+
+    def update(self, images_path=source_folder, classes_path=classes_path, split_path=split_path,
+               annotation_path=annotation_json_path, force=False):
+        """
+        Loads every source whose file changed since the last update, and the metadata of added, changed or
+        removed images. Missing sources are skipped.
+
+        Parameters:
+        images_path (str): The directory containing all images.
+        classes_path (str): The tab-separated filename / class list.
+        split_path (str): The train/val/test split JSON.
+        annotation_path (str): The annotation JSON with the points of each image.
+        force (bool): If True, reload every source.
+
+        Returns:
+        dict: The number of rows updated per source.
+        """
+        updated = {}
+        if os.path.exists(classes_path) and (force or self._source_changed('classes', classes_path)):
+            with open(classes_path) as file:
+                rows = [tuple(line.rstrip('\n').split('\t')[:2]) for line in file if '\t' in line]
+            self._upsert(['class'], rows)
+            self._mark_source('classes', classes_path)
+            updated['classes'] = len(rows)
+
+        if os.path.exists(split_path) and (force or self._source_changed('splits', split_path)):
+            split_of = read_splits(split_path)
+            self._upsert(['split'], list(split_of.items()))
+            self._mark_source('splits', split_path)
+            updated['splits'] = len(split_of)
+
+        if os.path.exists(annotation_path) and (force or self._source_changed('annotations', annotation_path)):
+            summary = fsc147_annotations.extract_annotations(annotation_path)
+            columns = ['object_count', 'exemplar_count', 'height', 'width']
+            self._upsert(columns, summary[['filename'] + columns].itertuples(index=False, name=None))
+            self._mark_source('annotations', annotation_path)
+            updated['annotations'] = len(summary)
+
+        if os.path.isdir(images_path):
+            updated['files'] = self._update_files(images_path)
+        self.conn.commit()
+        print(f"Manifest {self.path} updated: {updated}")
+        return updated
+
+    def _update_files(self, images_path):
+        """
+        Stats the image directory in one scan and updates only the images that were added, changed or removed.
+        """
+        known = {filename: (size, mtime) for filename, size, mtime in
+                 self.conn.execute("SELECT filename, file_size, mtime_ns FROM images WHERE present = 1")}
+        changed = []
+        on_disk = set()
+        with os.scandir(images_path) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(('.jpg', '.jpeg')) or not entry.is_file():
+                    continue
+                on_disk.add(entry.name)
+                stat = entry.stat()
+                if known.get(entry.name) != (stat.st_size, stat.st_mtime_ns):
+                    changed.append((entry.name, stat.st_size, stat.st_mtime_ns, 1))
+        removed = [(filename,) for filename in known if filename not in on_disk]
+        self._upsert(['file_size', 'mtime_ns', 'present'], changed)
+        self.conn.executemany("UPDATE images SET present = 0, file_size = NULL, mtime_ns = NULL WHERE filename = ?",
+                              removed)
+        return len(changed) + len(removed)
+
+    def query(self, split=None, classes=None, min_count=None, max_count=None, present_only=True,
+              columns=('filename', 'class', 'object_count')):
+        """
+        Selects images through the indexes.
+
+        Parameters:
+        split (str or list): Optional; only images in these splits.
+        classes (list): Optional; only images of these classes.
+        min_count (int): Optional; only images with at least this many objects.
+        max_count (int): Optional; only images with fewer than this many objects.
+        present_only (bool): If True, only images present in the image directory.
+        columns (tuple): The columns to return.
+
+        Returns:
+        DataFrame: The matching images, ordered by filename.
+        """
+        conditions = ["class IS NOT NULL", "object_count IS NOT NULL"]
+        params = []
+        if split is not None:
+            split = [split] if isinstance(split, str) else list(split)
+            conditions.append(f"split IN ({', '.join('?' * len(split))})")
+            params += split
+        if classes is not None:
+            conditions.append(f"class IN ({', '.join('?' * len(classes))})")
+            params += list(classes)
+        if min_count is not None:
+            conditions.append("object_count >= ?")
+            params.append(min_count)
+        if max_count is not None:
+            conditions.append("object_count < ?")
+            params.append(max_count)
+        if present_only:
+            conditions.append("present = 1")
+        sql = f"SELECT {', '.join(columns)} FROM images WHERE {' AND '.join(conditions)} ORDER BY filename"
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def sample(self, n, seed=0, stratify=('count_bin',), bins=rmse_evaluation.COUNT_BINS, **filters):
+        """
+        Draws a deterministic sample of n images, stratified by count bin and/or class.
+
+        The sample is split across the strata of the first stratify level in proportion to their sizes, then
+        across the next level within each of those, so the first level's proportions are matched exactly.
+        Draws use a generator seeded from seed, so the same arguments always give the same sample. n larger
+        than the candidates returns all of them.
+
+        Parameters:
+        n (int): The sample size, e.g. 300, or None for every matching image.
+        seed (int): The random seed.
+        stratify (tuple): Any of 'count_bin' and 'class'; empty for a simple random sample.
+        bins (list): The count bin edges used for 'count_bin'.
+        **filters: Passed to query, e.g. split='test'.
+
+        Returns:
+        DataFrame: filename, class and object_count of the sample, ordered by filename.
+        """
+        candidates = self.query(**filters)
+        if n is None or n >= len(candidates):
+            return candidates
+        candidates['count_bin'] = np.searchsorted(np.asarray(bins), candidates['object_count'], side='right')
+        rng = np.random.default_rng(seed)
+        if not stratify:
+            chosen = np.sort(rng.choice(len(candidates), n, replace=False))
+            return candidates.iloc[chosen][['filename', 'class', 'object_count']].reset_index(drop=True)
+
+        chosen = _allocate(candidates, np.arange(len(candidates)), n, list(stratify), rng)
+        return candidates.iloc[np.sort(chosen)][['filename', 'class', 'object_count']].reset_index(drop=True)
+
+    def close(self):
+        self.conn.close()
+
+
+def _allocate(candidates, rows, n, levels, rng):
+    """
+    Draws n of rows, split across the strata of levels[0] in proportion to their sizes (largest remainders,
+    ties broken at random), then recursively across the remaining levels within each stratum.
+    """
+    if not levels:
+        return rng.choice(rows, n, replace=False)
+    groups = list(candidates.iloc[rows].groupby(levels[0], sort=True).indices.values())
+    sizes = np.array([len(group) for group in groups])
+    quotas = n * sizes / sizes.sum()
+    allocation = np.floor(quotas).astype(int)
+    order = rng.permutation(len(groups))
+    order = order[np.argsort(-(quotas - allocation)[order], kind='stable')]
+    allocation[order[:n - allocation.sum()]] += 1
+    return np.concatenate([_allocate(candidates, rows[group], k, levels[1:], rng)
+                           for group, k in zip(groups, allocation) if k > 0])
+
+
+def write_labels_csv(sample, csv_path, images_path=None):
+    """
+    Writes a sample in the label CSV format of FSC147_384_V2/300_image_labels.csv.
+
+    Parameters:
+    sample (DataFrame): The sample, e.g. from Manifest.sample.
+    csv_path (str): The path of the CSV to write.
+    images_path (str): Optional; adds an image_path column pointing into this directory, so the evaluation
+        stages read the images in place and no subset directory is needed.
+    """
+    labels = sample[['filename', 'class', 'object_count']]
+    if images_path is not None:
+        labels = labels.assign(image_path=[os.path.join(images_path, f) for f in labels['filename']])
+    labels.to_csv(csv_path, index=False)
+
+
+def _reflink(source, destination):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_file(source, destination, mode='auto'):
+    """
+    Creates destination as a hardlink, reflink, symlink or copy of source.
+
+    Parameters:
+    source (str): The source file.
+    destination (str): The file to create; must not exist.
+    mode (str): One of LINK_MODES, or 'auto' to try them in that order and use the first that works.
+
+    Returns:
+    str: The mode used.
+    """
+    for candidate in (LINK_MODES if mode == 'auto' else [mode]):
+        try:
+            if candidate == 'hardlink':
+                os.link(source, destination)
+            elif candidate == 'reflink':
+                _reflink(source, destination)
+                shutil.copystat(source, destination)
+            elif candidate == 'symlink':
+                os.symlink(os.path.abspath(source), destination)
+            else:
+                shutil.copy2(source, destination)
+            return candidate
+        except OSError:
+            if os.path.lexists(destination):
+                os.remove(destination)
+            if mode != 'auto':
+                raise
+    raise OSError(f"Could not link {source} to {destination}")
+
+
+def _up_to_date(source, destination):
+    """
+    Returns True if destination already is a link to, or an unchanged copy of, source.
+    """
+    if os.path.islink(destination):
+        return os.readlink(destination) == os.path.abspath(source)
+    try:
+        if os.path.samefile(source, destination):
+            return True
+        src, dst = os.stat(source), os.stat(destination)
+    except FileNotFoundError:
+        return False
+    return (src.st_size, src.st_mtime_ns) == (dst.st_size, dst.st_mtime_ns)
+
+
+def materialize_subset(filenames, source_path, destination_path, mode='auto', workers=16):
+    """
+    Syncs destination_path to contain exactly the given images from source_path as links (hardlinks, reflinks
+    or symlinks where the filesystem supports them, copies otherwise). Files already up to date are not
+    touched and files not in the subset are removed, so re-running after a sample changes only the difference.
+
+    Parameters:
+    filenames (iterable): The images of the subset, e.g. Manifest.sample(...)['filename'].
+    source_path (str): The directory containing all images.
+    destination_path (str): The subset directory.
+    mode (str): One of LINK_MODES or 'auto'.
+    workers (int): The number of threads creating links.
+
+    Returns:
+    dict: The number of files linked per mode, unchanged, removed, and missing from source_path.
+    """
+    os.makedirs(destination_path, exist_ok=True)
+    wanted = set(filenames)
+    with os.scandir(destination_path) as entries:
+        existing = {entry.name for entry in entries if entry.is_file() or entry.is_symlink()}
+
+    def sync(filename):
+        source = os.path.join(source_path, filename)
+        destination = os.path.join(destination_path, filename)
+        if not os.path.exists(source):
+            # Keep what is there when the source is unavailable rather than deleting it.
+            return 'unchanged' if filename in existing else 'missing'
+        if filename in existing:
+            if _up_to_date(source, destination):
+                return 'unchanged'
+            os.remove(destination)
+        return link_file(source, destination, mode)
+
+    def remove(filename):
+        os.remove(os.path.join(destination_path, filename))
+        return 'removed'
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        outcomes = list(pool.map(sync, sorted(wanted)))
+        outcomes += list(pool.map(remove, sorted(existing - wanted)))
+    summary = {outcome: outcomes.count(outcome) for outcome in dict.fromkeys(outcomes)}
+    print(f"Synced {destination_path}: {summary}")
+    return summary
+
+
+if __name__ == "__main__":
+    manifest = Manifest("FSC147_384_V2/manifest.sqlite")
+    manifest.update()
+    # write_labels_csv(manifest.sample(300, seed=42, stratify=('count_bin', 'class')), "FSC147_384_V2/300_image_labels_stratified.csv")
+    # write_labels_csv(manifest.sample(1000, seed=0, split='test'), "FSC147_384_V2/1000_test_image_labels.csv")
+    # sample = manifest.sample(1000, seed=0, split='test')
+    # materialize_subset(sample['filename'], source_folder, "FSC147_384_V2/selected_1000_test_images")
+    # write_labels_csv(sample, "FSC147_384_V2/1000_test_image_labels.csv", images_path=source_folder)
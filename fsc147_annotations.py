@@ -0,0 +1,169 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Streaming reader of the FSC147 annotation JSON ({filename: {"H", "W", "points", "box_examples_coordinates",
+...}}). The file is read in chunks and decoded one image entry at a time, so peak memory is bounded by the
+largest single entry instead of the whole file.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class _ChunkReader:
+    """
+    A buffer over a text file that is refilled on demand and drops consumed text.
+    """
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.file.read(size)
+        self.eof = not data
+        self.buffer += data
+        return not self.eof
+
+    def skip(self, characters):
+        """
+        Skips the given characters and returns the next character, or '' at the end of the file.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in characters:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill(self.chunk_size):
+                return ''
+
+    def decode(self):
+        """
+        Decodes the JSON value at the current position, reading more of the file until it is complete.
+        The read size doubles on each retry, so a large value is decoded in amortized linear time.
+        """
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self.fill(size):
+                    raise
+                size *= 2
+                continue
+            # A number at the very end of the buffer may continue in the next chunk.
+            if end == len(self.buffer) and not self.eof and self.fill(size):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_annotations(json_path, chunk_size=1 << 20):
+    """
+    Yields (filename, annotation) for each image of the annotation JSON, decoding one entry at a time.
+
+    Parameters:
+    json_path (str): The path to annotation_FSC147_384.json.
+    chunk_size (int): The number of characters read at a time.
+    """
+    with open(json_path, 'r') as file:
+        reader = _ChunkReader(file, chunk_size)
+        if reader.skip(_WHITESPACE) != '{':
+            raise ValueError(f"{json_path} is not a JSON object")
+        reader.pos += 1
+        while True:
+            character = reader.skip(_WHITESPACE + ',')
+            if character == '}':
+                return
+            if character != '"':
+                raise ValueError(f"Unexpected {character!r} in {json_path}")
+            filename = reader.decode()
+            if reader.skip(_WHITESPACE) != ':':
+                raise ValueError(f"Expected ':' after {filename!r} in {json_path}")
+            reader.pos += 1
+            reader.skip(_WHITESPACE)
+            yield filename, reader.decode()
+
+
+def extract_annotations(json_path, filenames=None, points_path=None, chunk_size=1 << 20):
+    """
+    Extracts the per-image aggregates used by the project in one streaming pass: point count (the object
+    count), exemplar box count and image size. Optionally writes every point to a float32 .npy file of shape
+    (total points, 2), with each image's rows given by point_offset and object_count.
+
+    Parameters:
+    json_path (str): The path to annotation_FSC147_384.json.
+    filenames (iterable): Optional; only these images are kept. Defaults to the full dataset.
+    points_path (str): Optional; the .npy file to write the points to.
+    chunk_size (int): The number of characters read at a time.
+
+    Returns:
+    DataFrame: filename, object_count, exemplar_count, height, width and, with points_path, point_offset.
+    """
+    wanted = set(filenames) if filenames is not None else None
+    rows = []
+    raw_path = points_path + '.part' if points_path is not None else None
+    raw = open(raw_path, 'wb') if raw_path is not None else None
+    offset = 0
+    try:
+        for filename, annotation in iter_annotations(json_path, chunk_size):
+            if wanted is not None and filename not in wanted:
+                continue
+            points = annotation.get('points', [])
+            row = {'filename': filename, 'object_count': len(points),
+                   'exemplar_count': len(annotation.get('box_examples_coordinates', [])),
+                   'height': annotation.get('H'), 'width': annotation.get('W')}
+            if raw is not None:
+                row['point_offset'] = offset
+                raw.write(np.asarray(points, dtype=np.float32).reshape(-1, 2).tobytes())
+                offset += len(points)
+            rows.append(row)
+    finally:
+        if raw is not None:
+            raw.close()
+
+    if raw is not None:
+        # Copy the raw points into a .npy file in blocks, so the points are never all in memory.
+        source = np.memmap(raw_path, dtype=np.float32, mode='r', shape=(offset, 2)) if offset else None
+        target = np.lib.format.open_memmap(points_path, mode='w+', dtype=np.float32, shape=(offset, 2))
+        for start in range(0, offset, 1 << 20):
+            target[start:start + (1 << 20)] = source[start:start + (1 << 20)]
+        target.flush()
+        del source, target
+        os.remove(raw_path)
+    return pd.DataFrame(rows, columns=['filename', 'object_count', 'exemplar_count', 'height', 'width'] +
+                        (['point_offset'] if points_path is not None else []))
+
+
+def load_points(points_path, summary, filename):
+    """
+    Returns the points of one image from a .npy file written by extract_annotations, memory-mapped.
+
+    Parameters:
+    points_path (str): The .npy file.
+    summary (DataFrame): The extract_annotations output with point_offset.
+    filename (str): The image.
+
+    Returns:
+    ndarray: The (object_count, 2) points.
+    """
+    row = summary.loc[summary['filename'] == filename].iloc[0]
+    points = np.load(points_path, mmap_mode='r')
+    return points[row['point_offset']:row['point_offset'] + row['object_count']]
+
+
+if __name__ == "__main__":
+    annotation_json_path = 'FSC147_384_V2/annotation_FSC147_384.json'
+    summary = extract_annotations(annotation_json_path, points_path='FSC147_384_V2/annotation_points.npy')
+    summary.to_csv('FSC147_384_V2/annotation_summary.csv', index=False)
+    print(f"{len(summary)} images, {summary['object_count'].sum()} points")
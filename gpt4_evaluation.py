@@ -7,185 +7,399 @@ Project: Improving Multi-modal Language Model on Object Counting with Self-Gener
 import pandas as pd
 from openai import OpenAI
 import os
+import time
+import itertools
+from functools import lru_cache
 import helpers
+import instrumentation
+import request_engine
+import response_cache
+import payload_store
+import run_journal
+import batch_mode
+import response_parser
+import results_store
+from response_parser import extract_section
 
-client = OpenAI()
+client = None
 
-def count_objects(image_path, object_name):
+# The (description, direct, indirect) hint combinations evaluated in the report.
+HINT_CONFIGS = [(True, True, True), (True, False, False), (False, True, False), (False, False, True)]
+# Every subset of the three hints.
+ALL_HINT_CONFIGS = list(itertools.product([True, False], repeat=3))
+
+# Output token budget of count requests in streaming mode; the answer is a single number.
+COUNT_MAX_TOKENS = 16
+
+# Self-consistency: completions sampled per count request (the n parameter) and their temperature.
+SELF_CONSISTENCY_SAMPLES = 5
+SELF_CONSISTENCY_TEMPERATURE = 0.7
+
+# Output token budget and JSON schema for structured side information.
+HINT_MAX_TOKENS = 400
+SIDE_INFORMATION_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "side_information",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "description": {"type": "string"},
+                "direct_hint": {"type": "string"},
+                "indirect_hint": {"type": "string"},
+            },
+            "required": ["description", "direct_hint", "indirect_hint"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def get_client():
+    """
+    Returns the shared synchronous client, creating it on first use.
+    """
+    global client
+    if client is None:
+        client = OpenAI()
+    return client
+
+
+def send_request(request, cache=None, payload_fn=helpers.image_data_url, call_log=None):
+    """
+    Sends one chat request with an attached image (or text-only), going through the response cache if one is given.
+
+    Parameters:
+    request (dict): A request with 'prompt', 'image_path' (None for a text-only request) and optional 'model',
+        'params' and 'stream'.
+        With 'stream', the response is streamed and the stream is closed once a complete count has arrived.
+    cache (ResponseCache): Optional; the response cache. In offline mode misses return None.
+    payload_fn (callable): Maps an image path to the image URL, e.g. PayloadStore.data_url.
+    call_log (CallLog): Optional; the call is recorded in this instrumentation log (also if it fails).
+
+    Returns:
+    str or None: The stripped response text.
+    """
+    if cache is not None:
+        cached = cache.get(request)
+        if cached is not None or cache.offline:
+            return cached
+    start = time.perf_counter()
+    try:
+        raw = get_client().chat.completions.with_raw_response.create(
+            model=request.get('model', helpers.MODEL),
+            messages=helpers.build_messages(request['prompt'],
+                                            payload_fn(request['image_path']) if request.get('image_path') else None,
+                                            request.get('detail')),
+            stream=bool(request.get('stream')),
+            **request.get('params', {}),
+        )
+    except Exception as e:
+        if call_log is not None:
+            call_log.record(request, time.perf_counter() - start, attempts=instrumentation.attempts_for_error(
+                e, get_client().max_retries), error=e)
+        raise
+    response = raw.parse()
+    usage = None
+    if request.get('stream'):
+        content = ""
+        with response:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content += chunk.choices[0].delta.content
+                    if response_parser.complete_count(content) is not None:
+                        break
+        content = content.strip()
+    else:
+        content = response_parser.join_samples([choice.message.content.strip() for choice in response.choices])
+        usage = response.usage
+    if call_log is not None:
+        call_log.record(request, time.perf_counter() - start, usage, raw.retries_taken + 1)
+    if cache is not None:
+        cache.put(request, content)
+    return content
+
+
+def to_int_count(count, aggregate='median'):
+    """
+    Converts a count response to an integer, or pd.NA if it contains no number.
+    Answers such as "18.", "There are 20" or "twenty" are read with response_parser.extract_count, and the
+    samples of a self-consistency response are combined with the given aggregate ('median', 'mode' or
+    'trimmed_mean').
+    """
+    value = response_parser.aggregate_counts(response_parser.sample_counts(count), aggregate)
+    return pd.NA if value is None else value
+
+
+def set_count(df, index, column, response, aggregate='median'):
+    """
+    Writes the count of a response into df, and the spread of its samples if df has a spread column for it.
+    """
+    df.at[index, column] = to_int_count(response, aggregate)
+    if column + response_parser.SPREAD_SUFFIX in df.columns:
+        df.at[index, column + response_parser.SPREAD_SUFFIX] = response_parser.count_spread(response)
+
+
+def stream_count(request):
+    """
+    Switches a count request to streaming mode with early termination and a COUNT_MAX_TOKENS budget.
+    """
+    request['stream'] = True
+    request['params'] = {'max_tokens': COUNT_MAX_TOKENS, **request.get('params', {})}
+    return request
+
+
+def check_sampling(stream, samples):
+    """
+    Raises ValueError if streaming is combined with self-consistency sampling: streaming reads only the first
+    choice. Checked before any request is sent, so the mistake is not reported as failed requests.
+    """
+    if stream and samples > 1:
+        raise ValueError("Self-consistency sampling cannot be combined with streaming")
+
+
+def self_consistency(request, samples, temperature=SELF_CONSISTENCY_TEMPERATURE):
+    """
+    Asks for several completions of a count request in one call (the n parameter) at the given temperature.
+    Streaming reads only the first choice, so the two cannot be combined.
+    """
+    check_sampling(request.get('stream'), samples)
+    request['params'] = {**request.get('params', {}), 'n': samples, 'temperature': temperature}
+    return request
+
+
+def image_path_for(images_path, row):
+    """
+    Returns the image of a row: its image_path column if the label CSV has one (a subset read in place from the
+    full dataset, see dataset_manifest.write_labels_csv), otherwise images_path/filename.
+    """
+    image_path = row.get('image_path')
+    if isinstance(image_path, str):
+        return image_path
+    return os.path.join(images_path, row['filename'])
+
+
+def dispatch(requests, batch_dir=None, **engine_kwargs):
+    """
+    Sends requests through the request engine, or through the Batch API if batch_dir is given.
+    """
+    if batch_dir is not None:
+        return batch_mode.run_requests_batch(requests, batch_dir, **engine_kwargs)
+    return request_engine.run_requests(requests, **engine_kwargs)
+
+
+def run_stage(df, images_path, stage, build_prompt, config='', journal=None, batch_dir=None, variant_policy=None,
+              params=None, stream=False, samples=1, temperature=SELF_CONSISTENCY_TEMPERATURE, **engine_kwargs):
+    """
+    Sends one request per row of df through the request engine, or through the Batch API.
+
+    With a journal, rows already completed for this (stage, config) are not sent again, and each new
+    response is journaled as it arrives.
+
+    Parameters:
+    df (DataFrame): The rows to process, with 'filename' and 'class' columns.
+    images_path (str): The directory path where images are stored.
+    stage (str): The stage name recorded in the journal.
+    build_prompt (callable): Builds the prompt from a row.
+    config (str): The hint configuration recorded in the journal.
+    journal (RunJournal): Optional; the checkpoint journal to resume from and append to.
+    batch_dir (str): Optional; if given, requests are submitted to the Batch API with this as the root of the
+        batch working directories, and matched back by a custom ID of filename, stage and config.
+    variant_policy (VariantPolicy): Optional; picks the downscaled image variant and detail level of each
+        request (see image_variants).
+    params (dict): Optional; extra request parameters such as max_tokens or response_format.
+    stream (bool): If True, count responses are streamed and cut off as soon as the count is complete.
+    samples (int): With more than one, each request asks for this many completions in a single call.
+    temperature (float): The sampling temperature when samples > 1.
+    **engine_kwargs: Options passed to request_engine.run_requests (or batch_mode.run_requests_batch).
+
+    Returns:
+    dict: Mapping of row index to response text (None for failed requests).
+    """
+    check_sampling(stream, samples)
+    done = journal.responses(stage, config) if journal is not None else {}
+    results = {}
+    requests = []
+    for index, row in df.iterrows():
+        filename = row['filename']
+        if filename in done:
+            results[index] = done[filename]
+            continue
+        image_path = image_path_for(images_path, row)
+        if os.path.exists(image_path):
+            request = {'key': index, 'custom_id': f"{filename}|{stage}|{config}",
+                       'image_path': image_path, 'prompt': build_prompt(row)}
+            if params:
+                request['params'] = params
+            if stream:
+                stream_count(request)
+            if samples > 1:
+                self_consistency(request, samples, temperature)
+            if variant_policy is not None:
+                variant_policy.apply(request, row)
+            requests.append(request)
+        else:
+            print(f"Image {filename} not found at {image_path}")
+    if done:
+        print(f"Resuming {stage} {config}: {len(results)} rows already completed, {len(requests)} to send")
+
+    on_result = None
+    if journal is not None:
+        def on_result(index, content):
+            if content is not None:
+                journal.record(df.at[index, 'filename'], stage, config, content)
+
+    if batch_dir is not None:
+        batch_dir = os.path.join(batch_dir, "_".join(filter(None, [stage, config])))
+    results.update(dispatch(requests, batch_dir=batch_dir, on_result=on_result, **engine_kwargs))
+    if journal is not None:
+        journal.flush()
+    return results
+
+
+def count_objects(image_path, object_name, cache=None, stream=False, samples=1,
+                  temperature=SELF_CONSISTENCY_TEMPERATURE, call_log=None):
     """
     Sends an image to the GPT model to count the number of specific objects visible in the image.
 
     Parameters:
     image_path (str): The path to the image file.
     object_name (str): The name of the object to be counted in the image.
+    cache (ResponseCache): Optional; the response cache to read from and write to.
+    stream (bool): If True, stream the response and stop reading once the count is complete.
+    samples (int): With more than one, sample this many answers in one call; read them with to_int_count.
+    temperature (float): The sampling temperature when samples > 1.
+    call_log (CallLog): Optional; the instrumentation log to record the call in.
 
     Returns:
     str or None: The count of objects as a string if successful, None otherwise.
     """
+    check_sampling(stream, samples)
     try:
-        prompt = helpers.basic_count_prompt(object_name)
-        base64_image = helpers.encode_image(image_path)
-
-        response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": prompt,},
-                {
-                "type": "image_url",
-                "image_url": {"url":  f"data:image/jpeg;base64,{base64_image}"},
-                },
-            ],
-            }
-        ],
-        )
-        content = response.choices[0].message.content
-        return content.strip()
+        request = {'prompt': helpers.basic_count_prompt(object_name), 'image_path': image_path,
+                   'custom_id': f"{os.path.basename(image_path)}|initial_count|"}
+        if stream:
+            stream_count(request)
+        if samples > 1:
+            self_consistency(request, samples, temperature)
+        return send_request(request, cache, call_log=call_log)
     
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
         return None
 
-def get_inital_count(images_path, csv_to_read, csv_to_write):
+def get_inital_count(images_path, csv_to_read, csv_to_write, journal=None, stream=False, samples=1,
+                     temperature=SELF_CONSISTENCY_TEMPERATURE, aggregate='median', **engine_kwargs):
     """
     Processes a CSV file to count objects in each listed image, updating the CSV with these counts.
 
+    Requests are sent concurrently through request_engine.run_requests and written back by row index.
+
     Parameters:
     images_path (str): The directory path where images are stored.
-    csv_path (str): The path to the CSV file containing image filenames and object names.
+    csv_to_read (str): The path to the CSV file containing image filenames and object names.
+    csv_to_write (str): The path to write the updated CSV file to.
+    journal (RunJournal): Optional; the checkpoint journal to resume from and append to.
+    stream (bool): If True, stream each answer and stop reading once the count is complete.
+    samples (int): With more than one, sample this many answers per image in one call, write their aggregate
+        and add a gpt_4_initial_answer_spread column.
+    temperature (float): The sampling temperature when samples > 1.
+    aggregate (str): How samples are combined: 'median', 'mode' or 'trimmed_mean'.
+    **engine_kwargs: Options passed to run_stage, e.g. concurrency and rate limits, cache, or batch_dir.
     """
     df = pd.read_csv(csv_to_read)
     df['gpt_4_initial_answer'] = None
-    
-    for index, row in df.iterrows():
-        filename = row['filename']
-        object_name = row['class']
-        image_path = os.path.join(images_path, filename)
-        
-        if os.path.exists(image_path):
-            # Get the object count from the model
-            count = count_objects(image_path, object_name)
-            try:
-                # Attempt to convert count to an integer
-                int_count = int(count)
-                df.at[index, 'gpt_4_initial_answer'] = int_count
-            except ValueError:
-                # If conversion fails, set the count to pd.NA
-                df.at[index, 'gpt_4_initial_answer'] = pd.NA
-            print("-------------------------")
-            print(count)
-            df.to_csv(csv_to_write, index=False)
-        else:
-            print(f"Image {filename} not found at {image_path}")
-            df.to_csv(csv_to_write, index=False)
+    if samples > 1:
+        df['gpt_4_initial_answer' + response_parser.SPREAD_SUFFIX] = None
+
+    results = run_stage(df, images_path, 'initial_count', lambda row: helpers.basic_count_prompt(row['class']),
+                        journal=journal, stream=stream, samples=samples, temperature=temperature, **engine_kwargs)
+    for index, count in results.items():
+        set_count(df, index, 'gpt_4_initial_answer', count, aggregate)
+    df.to_csv(csv_to_write, index=False)
     
 
-def generate_side_information(image_path, object_name):
-    try:
+def side_information_request(object_name, structured=False, max_tokens=None):
+    """
+    Builds the prompt and request parameters of the side information stage.
+
+    Parameters:
+    object_name (str): The name of the object to be counted.
+    structured (bool): If True, ask for a JSON response with description, direct_hint and indirect_hint fields.
+    max_tokens (int): Optional; the output token budget.
+
+    Returns:
+    tuple: (prompt, params).
+    """
+    params = {}
+    if structured:
+        prompt = helpers.structured_side_information_prompt(object_name)
+        params['response_format'] = SIDE_INFORMATION_FORMAT
+    else:
         prompt = helpers.side_information_prompt(object_name)
-        base64_image = helpers.encode_image(image_path)
-
-        response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": prompt,},
-                {
-                "type": "image_url",
-                "image_url": {"url":  f"data:image/jpeg;base64,{base64_image}"},
-                },
-            ],
-            }
-        ],
-        )
-        content = response.choices[0].message.content
+    if max_tokens is not None:
+        params['max_tokens'] = max_tokens
+    return prompt, params
+
 
-        full_response = content.strip()
-        return full_response
+def generate_side_information(image_path, object_name, cache=None, structured=False, max_tokens=None,
+                              call_log=None):
+    try:
+        prompt, params = side_information_request(object_name, structured, max_tokens)
+        request = {'prompt': prompt, 'image_path': image_path, 'custom_id': f"{os.path.basename(image_path)}|hints|"}
+        if params:
+            request['params'] = params
+        return send_request(request, cache, call_log=call_log)
     
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
         return None
     
 
-def get_hints(images_path, csv_to_read, csv_to_write):
+def get_hints(images_path, csv_to_read, csv_to_write, journal=None, structured=False, max_tokens=None,
+              **engine_kwargs):
+    """
+    Generates side information for every image.
+
+    With structured=True the model returns JSON with description, direct_hint and indirect_hint fields,
+    which are written straight into their columns, so split_response is not needed.
+
+    Parameters:
+    images_path (str): The directory path where images are stored.
+    csv_to_read (str): The path to the CSV file containing image filenames and object names.
+    csv_to_write (str): The path to write the updated CSV file to.
+    journal (RunJournal): Optional; the checkpoint journal to resume from and append to.
+    structured (bool): If True, request JSON-schema structured output.
+    max_tokens (int): Optional; the output token budget per response, e.g. HINT_MAX_TOKENS.
+    **engine_kwargs: Options passed to run_stage, e.g. concurrency and rate limits, cache, or batch_dir.
+    """
     df = pd.read_csv(csv_to_read)
     df['full_response'] = None
     df['description'] = None
     df['direct_hint'] = None
     df['indirect_hint'] = None
-    
-    for index, row in df.iterrows():
-        filename = row['filename']
-        object_name = row['class']
-        image_path = os.path.join(images_path, filename)
-
-        if os.path.exists(image_path):
-            full_response = generate_side_information(image_path, object_name)
-            df.at[index, 'full_response'] = full_response
-
-        else:
-            print(f"Image {filename} not found at {image_path}")
-        df.to_csv(csv_to_write, index=False)
-
 
-def extract_section(full_response, section):
-    # Check if the response exists and is not NaN
-    if pd.isna(full_response):
-        return None
-    
-    # Define possible start and stop strings for each section
-    if section == "description":
-        starts = ["1. **Description:**", "### 1. Description:", "1. **Description**:", 
-                  "### 1. Description:", "1. **Description:**", "1. **Description**:"]
-        stops = ["2. **Direct hint:**", "### 2. Direct Hint:", "2. **Direct hint**:", 
-                 "### 2. Direct hint:", "2. **Direct Hint:**", "2. **Direct Hint**:"]
-    elif section == "direct_hint":
-        starts = ["2. **Direct hint:**", "### 2. Direct Hint:", "2. **Direct hint**:", 
-                  "### 2. Direct hint:", "2. **Direct Hint:**", "2. **Direct Hint**:"]
-        stops = ["3. **Indirect hint:**", "### 3. Indirect Hint:", "3. **Indirect hint**:", 
-                 "### 3. Indirect hint:", "3. **Indirect Hint:**", "3. **Indirect Hint**:"]
-    elif section == "indirect_hint":
-        starts = ["3. **Indirect hint:**", "### 3. Indirect Hint:", "3. **Indirect hint**:", 
-                  "### 3. Indirect hint:", "3. **Indirect Hint:**", "3. **Indirect Hint**:"]
-        stops = [None]  # Last section has no stop
-    
-    # Find the start and stop indices of the sections
-    start_idx = -1
-    stop_idx = len(full_response)
-    for start in starts:
-        index = full_response.find(start)
-        if index != -1:
-            start_idx = index + len(start)
-            break
-    
-    if start_idx == -1:  # No start found
-        return None
-    
-    for stop in stops:
-        if stop is not None:
-            index = full_response.find(stop, start_idx)
-            if index != -1:
-                stop_idx = index
-                break
-    
-    # Extract and return the section, if the start is found
-    return full_response[start_idx:stop_idx].strip()
+    _, params = side_information_request('', structured, max_tokens)
+    if structured:
+        build_prompt = lambda row: helpers.structured_side_information_prompt(row['class'])
+    else:
+        build_prompt = lambda row: helpers.side_information_prompt(row['class'])
+    results = run_stage(df, images_path, 'hints', build_prompt, journal=journal, params=params, **engine_kwargs)
+    for index, full_response in results.items():
+        df.at[index, 'full_response'] = full_response
+    if structured:
+        split_columns(df)
+    df.to_csv(csv_to_write, index=False)
 
 
-def split_response(csv_in, csv_out):
-    df = pd.read_csv(csv_in)
-    df['description'] = df['full_response'].apply(lambda x: extract_section(x, "description"))
-    df['direct_hint'] = df['full_response'].apply(lambda x: extract_section(x, "direct_hint"))
-    df['indirect_hint'] = df['full_response'].apply(lambda x: extract_section(x, "indirect_hint"))
+def split_columns(df):
+    """
+    Splits the 'full_response' column of df into description, direct hint and indirect hint columns in place.
+    """
+    sections, statistics = response_parser.split_sections(df['full_response'])
+    for section in response_parser.SECTIONS:
+        df[section] = sections[section]
 
     # Count NA values in each of the specified columns
     na_description = df['description'].isna().sum()
@@ -195,13 +409,21 @@ def split_response(csv_in, csv_out):
     print(f"Number of NA's in Description: {na_description}")
     print(f"Number of NA's in Direct Hint: {na_direct_hint}")
     print(f"Number of NA's in Indirect Hint: {na_indirect_hint}")
+    print("Heading variants matched:")
+    response_parser.print_variant_statistics(statistics)
+
 
+def split_response(csv_in, csv_out):
+    df = pd.read_csv(csv_in)
+    split_columns(df)
     df.to_csv(csv_out, index=False)
     print("CSV file has been modified and saved.")
 
 
-def get_gpt_response_with_hints(csv_in, csv_out, description, direct, indirect):
-    df = pd.read_csv(csv_in)
+def hint_config_name(description, direct, indirect):
+    """
+    Returns the configuration name of a hint combination, e.g. 'desc_true_direct_false_indirect_true'.
+    """
     parts = []
     if description:
         parts.append("desc_true")
@@ -215,90 +437,270 @@ def get_gpt_response_with_hints(csv_in, csv_out, description, direct, indirect):
         parts.append("indirect_true")
     else:
         parts.append("indirect_false")
-    column_name = "response_" + "_".join(parts)
+    return "_".join(parts)
+
+
+def get_gpt_response_with_hints(csv_in, csv_out, description, direct, indirect,
+                                images_path="FSC147_384_V2/selected_300_images", journal=None, batch_dir=None,
+                                stream=False, samples=1, temperature=SELF_CONSISTENCY_TEMPERATURE,
+                                aggregate='median', **engine_kwargs):
+    df = pd.read_csv(csv_in)
+    config = hint_config_name(description, direct, indirect)
+    column_name = "response_" + config
     df[column_name] = None
-    
+    if samples > 1:
+        df[column_name + response_parser.SPREAD_SUFFIX] = None
+
+    def build_prompt(row):
+        description_text = row['description'] if description else ''
+        direct_text = row['direct_hint'] if direct else ''
+        indirect_text = row['indirect_hint'] if indirect else ''
+        return helpers.count_with_hint_prompt(row['class'], description_text, direct_text, indirect_text)
+
+    results = run_stage(df, images_path, 'count_with_hint', build_prompt, config=config,
+                        journal=journal, batch_dir=batch_dir, stream=stream, samples=samples,
+                        temperature=temperature, **engine_kwargs)
+    for index, count in results.items():
+        set_count(df, index, column_name, count, aggregate)
+    df.to_csv(csv_out, index=False)
+
+
+def run_hint_ablations(csv_in, csv_out, hint_configs=ALL_HINT_CONFIGS,
+                       images_path="FSC147_384_V2/selected_300_images", journal=None, batch_dir=None,
+                       stream=False, samples=1, temperature=SELF_CONSISTENCY_TEMPERATURE, aggregate='median',
+                       variant_policy=None, **engine_kwargs):
+    """
+    Runs every hint configuration in one pass over the dataset and fills all their response columns.
+
+    Requests are grouped by image so each image is loaded once, and (image, prompt) pairs shared by several
+    configurations (e.g. when a hint is empty) are sent only once.
+
+    Parameters:
+    csv_in (str): The path to the evaluation CSV with the split hint columns.
+    csv_out (str): The path to write the updated CSV file to.
+    hint_configs (list): The (description, direct, indirect) combinations to run. Defaults to all eight.
+    images_path (str): The directory path where images are stored.
+    journal (RunJournal): Optional; the checkpoint journal to resume from and append to.
+    batch_dir (str): Optional; if given, requests are submitted to the Batch API from this directory.
+    stream (bool): If True, stream each answer and stop reading once the count is complete.
+    samples (int): With more than one, sample this many answers per request in one call, write their aggregate
+        and add a response_<config>_spread column per configuration.
+    temperature (float): The sampling temperature when samples > 1.
+    aggregate (str): How samples are combined: 'median', 'mode' or 'trimmed_mean'.
+    variant_policy (VariantPolicy): Optional; picks the downscaled image variant and detail level of each
+        image (see image_variants).
+    **engine_kwargs: Options passed to request_engine.run_requests (or batch_mode.run_requests_batch).
+    """
+    check_sampling(stream, samples)
+    df = pd.read_csv(csv_in)
+    configs = [hint_config_name(*config) for config in hint_configs]
+    for config in configs:
+        df["response_" + config] = None
+        if samples > 1:
+            df["response_" + config + response_parser.SPREAD_SUFFIX] = None
+    done = {config: journal.responses('count_with_hint', config) if journal is not None else {} for config in configs}
+
+    # Each unique (image, detail, prompt) is one request; targets lists the (row, config) cells it fills.
+    targets = {}
+    responses = {}
     for index, row in df.iterrows():
         filename = row['filename']
-        object_name = row['class']
-        if description:
-            description_text = row['description']
-        else: 
-            description_text = ''
-
-        if direct:
-            direct_text = row['direct_hint']
-        else: 
-            direct_text = ''
-        
-        if indirect:
-            indirect_text = row['indirect_hint']
-        else: 
-            indirect_text = ''
-
-        image_path = os.path.join(images_path, filename)
-        
-        if os.path.exists(image_path):
-            # Get the object count from the model
-            count = count_with_hint(object_name, image_path, description_text, direct_text, indirect_text)
-            try:
-                # Attempt to convert count to an integer
-                int_count = int(count)
-                df.at[index, column_name] = int_count
-            except ValueError:
-                # If conversion fails, set the count to pd.NA
-                df.at[index, column_name] = pd.NA
-            print("-------------------------")
-            print(count)
-            df.to_csv(csv_out, index=False)
-        else:
+        image_path = image_path_for(images_path, row)
+        if not os.path.exists(image_path):
             print(f"Image {filename} not found at {image_path}")
-            df.to_csv(csv_out, index=False)
+            continue
+        # The variant depends only on the row, so it is chosen once for all configurations.
+        image = {'image_path': image_path, 'detail': None}
+        if variant_policy is not None:
+            variant_policy.apply(image, row)
+        for (description, direct, indirect), config in zip(hint_configs, configs):
+            if filename in done[config]:
+                responses[(index, config)] = done[config][filename]
+                continue
+            prompt = helpers.count_with_hint_prompt(row['class'],
+                                                    row['description'] if description else '',
+                                                    row['direct_hint'] if direct else '',
+                                                    row['indirect_hint'] if indirect else '')
+            targets.setdefault((image['image_path'], image['detail'], prompt), []).append((index, config))
+
+    requests = []
+    for key, cells in targets.items():
+        index, config = cells[0]
+        request = {'key': key, 'custom_id': f"{df.at[index, 'filename']}|count_with_hint|{config}",
+                   'image_path': key[0], 'prompt': key[2]}
+        if key[1] is not None:
+            request['detail'] = key[1]
+        if stream:
+            stream_count(request)
+        if samples > 1:
+            self_consistency(request, samples, temperature)
+        requests.append(request)
+    print(f"{len(requests)} requests for {sum(len(t) for t in targets.values())} (image, config) cells "
+          f"across {len(configs)} configurations")
+
+    on_result = None
+    if journal is not None:
+        def on_result(key, content):
+            if content is not None:
+                for index, config in targets[key]:
+                    journal.record(df.at[index, 'filename'], 'count_with_hint', config, content)
+
+    # Requests are ordered image by image, so a small LRU keeps each image encoded only once.
+    payload_fn = lru_cache(maxsize=64)(engine_kwargs.pop('payload_fn', helpers.image_data_url))
+    if batch_dir is not None:
+        batch_dir = os.path.join(batch_dir, "count_with_hint_ablations")
+    results = dispatch(requests, batch_dir=batch_dir, on_result=on_result, payload_fn=payload_fn, **engine_kwargs)
+    if journal is not None:
+        journal.flush()
+    for key, content in results.items():
+        for cell in targets[key]:
+            responses[cell] = content
+    for (index, config), count in responses.items():
+        set_count(df, index, "response_" + config, count, aggregate)
+    df.to_csv(csv_out, index=False)
 
 
-def count_with_hint(object_name, image_path, description, direct_hint, indirect_hint):
+def count_with_hint(object_name, image_path, description, direct_hint, indirect_hint, cache=None, stream=False,
+                    samples=1, temperature=SELF_CONSISTENCY_TEMPERATURE, call_log=None):
+    check_sampling(stream, samples)
     try:
         prompt = helpers.count_with_hint_prompt(object_name, description, direct_hint, indirect_hint)
-        base64_image = helpers.encode_image(image_path)
-
-        response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": prompt,},
-                {
-                "type": "image_url",
-                "image_url": {"url":  f"data:image/jpeg;base64,{base64_image}"},
-                },
-            ],
-            }
-        ],
-        )
-        content = response.choices[0].message.content
-        return content.strip()
+        config = hint_config_name(bool(description), bool(direct_hint), bool(indirect_hint))
+        request = {'prompt': prompt, 'image_path': image_path,
+                   'custom_id': f"{os.path.basename(image_path)}|count_with_hint|{config}"}
+        if stream:
+            stream_count(request)
+        if samples > 1:
+            self_consistency(request, samples, temperature)
+        return send_request(request, cache, call_log=call_log)
     
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
         return None
 
 
+def replay_from_cache(images_path, csv_to_read, csv_to_write, cache_path):
+    """
+    Rebuilds the evaluation CSV from cached responses only, without any network access.
+
+    Requests missing from the cache are left empty (NA).
+
+    Parameters:
+    images_path (str): The directory path where images are stored.
+    csv_to_read (str): The path to the label CSV with filenames, classes and object counts.
+    csv_to_write (str): The path of the evaluation CSV to rebuild.
+    cache_path (str): The path to the response cache database.
+    """
+    cache = response_cache.ResponseCache(cache_path, offline=True)
+    get_inital_count(images_path, csv_to_read=csv_to_read, csv_to_write=csv_to_write, cache=cache)
+    get_hints(images_path, csv_to_read=csv_to_write, csv_to_write=csv_to_write, cache=cache)
+    split_response(csv_in=csv_to_write, csv_out=csv_to_write)
+    run_hint_ablations(csv_in=csv_to_write, csv_out=csv_to_write, hint_configs=HINT_CONFIGS,
+                       images_path=images_path, cache=cache)
+    print(f"Replayed from cache: {cache.stats()}")
+
+
+def compact_journal(journal, csv_to_read, csv_to_write, aggregate='median'):
+    """
+    Builds the final wide evaluation CSV from a run journal in a single write. Columns answered with several
+    samples per request get a <column>_spread column next to them.
+
+    Parameters:
+    journal (RunJournal): The run journal.
+    csv_to_read (str): The path to the label CSV with filenames, classes and object counts.
+    csv_to_write (str): The path of the evaluation CSV to write.
+    aggregate (str): How the samples of a self-consistency response are combined.
+    """
+    labels = pd.read_csv(csv_to_read)
+    df = journal.to_wide(labels)
+    response_columns = ["response_" + hint_config_name(*config) for config in HINT_CONFIGS + ALL_HINT_CONFIGS]
+    response_columns = list(dict.fromkeys(response_columns))
+    response_columns += sorted(c for c in df.columns if c.startswith("response_") and c not in response_columns)
+    count_columns = []
+    for column in ['gpt_4_initial_answer'] + response_columns:
+        if column in df.columns:
+            count_columns.append(column)
+            spread = df[column].map(response_parser.count_spread)
+            if spread.notna().any():
+                df[column + response_parser.SPREAD_SUFFIX] = spread
+                count_columns.append(column + response_parser.SPREAD_SUFFIX)
+            df[column] = df[column].map(lambda response: to_int_count(response, aggregate))
+    if 'full_response' in df.columns:
+        split_columns(df)
+    initial = [c for c in count_columns if c.startswith('gpt_4_initial_answer')]
+    ordered = list(labels.columns) + initial + ['full_response', 'description', 'direct_hint',
+                                                'indirect_hint'] + [c for c in count_columns if c not in initial]
+    df = df[[c for c in ordered if c in df.columns]]
+    df.to_csv(csv_to_write, index=False)
+    print(f"Compacted {len(journal.records)} journal records into {csv_to_write}")
+
+
+def run_pipeline(images_path, csv_to_read, csv_to_write, journal_path, hint_configs=ALL_HINT_CONFIGS,
+                 structured_hints=False, hint_max_tokens=None, stream_counts=False, results_store_path=None,
+                 samples=1, sample_temperature=SELF_CONSISTENCY_TEMPERATURE, aggregate='median', **engine_kwargs):
+    """
+    Runs the initial count, hint and hint ablation stages with a checkpoint journal, then compacts it into
+    the wide evaluation CSV. Rerunning with the same journal resumes and skips completed requests.
+
+    Parameters:
+    images_path (str): The directory path where images are stored.
+    csv_to_read (str): The path to the label CSV with filenames, classes and object counts.
+    csv_to_write (str): The path of the evaluation CSV to write.
+    journal_path (str): The path to the journal file.
+    hint_configs (list): The (description, direct, indirect) combinations to run.
+    structured_hints (bool): If True, the hint stage requests JSON output and the split pass is skipped.
+    hint_max_tokens (int): Optional; the output token budget of the hint stage.
+    stream_counts (bool): If True, count answers are streamed and cut off as soon as the count is complete.
+    results_store_path (str): Optional; the evaluation CSV is also imported as a new run of this results store.
+    samples (int): With more than one, every count request samples this many answers in one call (e.g.
+        SELF_CONSISTENCY_SAMPLES), and each count column gets a _spread column.
+    sample_temperature (float): The sampling temperature when samples > 1.
+    aggregate (str): How samples are combined: 'median', 'mode' or 'trimmed_mean'.
+    **engine_kwargs: Options passed to the stages, e.g. concurrency and rate limits, cache, batch_dir to
+        use the Batch API, or call_log (instrumentation.CallLog) to record every model call.
+    """
+    check_sampling(stream_counts, samples)
+    journal = run_journal.RunJournal(journal_path)
+    try:
+        get_inital_count(images_path, csv_to_read=csv_to_read, csv_to_write=csv_to_write, journal=journal,
+                         stream=stream_counts, samples=samples, temperature=sample_temperature, aggregate=aggregate,
+                         **engine_kwargs)
+        get_hints(images_path, csv_to_read=csv_to_write, csv_to_write=csv_to_write, journal=journal,
+                  structured=structured_hints, max_tokens=hint_max_tokens, **engine_kwargs)
+        if not structured_hints:
+            split_response(csv_in=csv_to_write, csv_out=csv_to_write)
+        run_hint_ablations(csv_in=csv_to_write, csv_out=csv_to_write, hint_configs=hint_configs,
+                           images_path=images_path, journal=journal, stream=stream_counts, samples=samples,
+                           temperature=sample_temperature, aggregate=aggregate, **engine_kwargs)
+    finally:
+        journal.close()
+        if engine_kwargs.get('call_log') is not None:
+            engine_kwargs['call_log'].close()
+    compact_journal(journal, csv_to_read, csv_to_write, aggregate)
+    if results_store_path is not None:
+        call_log = engine_kwargs.get('call_log')
+        results_store.import_wide_csv(csv_to_write, results_store_path,
+                                      call_log_path=call_log.path if call_log is not None else None)
+
+
 if __name__ == "__main__":
     images_path = "FSC147_384_V2/selected_300_images" 
     csv_path = "FSC147_384_V2/300_image_labels.csv" 
     gpt4_evaluation_csv_path = "results/gpt4_evaluation.csv"
     gpt4_splited_response = "results/gpt4_evaluation_splited.csv"
     gpt4_experiments = "results/gpt4_experiments.csv"
+    cache_path = "results/response_cache.sqlite"
+    payload_store_path = "results/payload_store"
+    journal_path = "results/gpt4_evaluation_journal.jsonl"
+    batch_dir = "results/batches"
+    # run_pipeline(images_path, csv_to_read=csv_path, csv_to_write=gpt4_evaluation_csv_path, journal_path=journal_path)
+    # run_pipeline(images_path, csv_to_read=csv_path, csv_to_write=gpt4_evaluation_csv_path, journal_path=journal_path, batch_dir=batch_dir)
+    # run_pipeline(images_path, csv_to_read=csv_path, csv_to_write=gpt4_evaluation_csv_path, journal_path=journal_path, samples=SELF_CONSISTENCY_SAMPLES)
+    # run_pipeline(images_path, csv_to_read=csv_path, csv_to_write=gpt4_evaluation_csv_path, journal_path=journal_path, call_log=instrumentation.CallLog(instrumentation.call_log_path, instrumentation.prometheus_path))
+    # replay_from_cache(images_path, csv_to_read=csv_path, csv_to_write=gpt4_evaluation_csv_path, cache_path=cache_path)
     # get_inital_count(images_path, csv_to_read=csv_path, csv_to_write=gpt4_evaluation_csv_path)
     # get_hints(images_path, csv_to_read=csv_path, csv_to_write=gpt4_evaluation_csv_path)
     # split_response(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path)
-    get_gpt_response_with_hints(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path, description=True, direct=True, indirect=True)
-    get_gpt_response_with_hints(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path, description=True, direct=False, indirect=False)
-    get_gpt_response_with_hints(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path, description=False, direct=True, indirect=False)
-    get_gpt_response_with_hints(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path, description=False, direct=False, indirect=True)
-    # get_gpt_response_with_hints(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path, description=True, direct=True, indirect=False)
-    # get_gpt_response_with_hints(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path, description=False, direct=True, indirect=True)
-    # get_gpt_response_with_hints(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path, description=True, direct=False, indirect=True)
\ No newline at end of file
+    payload_store.build_payload_store(images_path, payload_store_path)
+    payloads = payload_store.PayloadStore(payload_store_path)
+    run_hint_ablations(csv_in=gpt4_evaluation_csv_path, csv_out=gpt4_evaluation_csv_path, hint_configs=ALL_HINT_CONFIGS, payload_fn=payloads.data_url)
@@ -7,6 +7,8 @@ Project: Improving Multi-modal Language Model on Object Counting with Self-Gener
 import base64
 import pandas as pd
 
+MODEL = "gpt-4o-mini"
+
 def encode_image(image_path):
     """
     Encodes an image to a base64 string.
@@ -19,6 +21,50 @@ def encode_image(image_path):
     """
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
+
+def image_data_url(image_path):
+    """
+    Builds the data URL used to attach a JPEG image to a chat request.
+
+    Parameters:
+    image_path (str): The path to the image file.
+
+    Returns:
+    str: The image as a base64 data URL.
+    """
+    return f"data:image/jpeg;base64,{encode_image(image_path)}"
+
+def build_messages(prompt, image_url, detail=None):
+    """
+    Builds the chat messages for a single prompt with one attached image.
+
+    Parameters:
+    prompt (str): The text prompt.
+    image_url (str): The image URL or base64 data URL, or None for a text-only request.
+    detail (str): Optional; the image detail level ('low', 'high' or 'auto').
+
+    Returns:
+    list: The messages for client.chat.completions.create.
+    """
+    content = [
+        {
+        "type": "text",
+        "text": prompt,},
+    ]
+    if image_url is not None:
+        image = {"url": image_url}
+        if detail is not None:
+            image["detail"] = detail
+        content.append({
+            "type": "image_url",
+            "image_url": image,
+            })
+    return [
+        {
+        "role": "user",
+        "content": content,
+        }
+    ]
     
 def basic_count_prompt(object_name):
     prompt = f"Please count the number of {object_name} visible in this image and respond with only the numeric answer."
@@ -36,12 +82,41 @@ def side_information_prompt(object_name):
     3. Indirect hint: Geese often travel in V-shaped formations or smaller groups, which can help you estimate their numbers more effectively. When counting, keep in mind that the number will likely reflect typical group sizes seen in nature, rather than a sparse or overly dense arrangement."""
     return prompt
 
+def image_side_information_prompt(object_name):
+    prompt = f"""
+    Please generate informations that can help someone on counting the number of {object_name} in this image. You need to provide the following:\n
+    1. Description: details of the objects in this image.\n
+    2. Direct hint: guidelines on methods to count the number of objects\n
+    For example, if you are seeing an image of geese, you should provide the following:\n
+    1. Description: The image features a group of Canada geese in flight against a clear blue sky. The geese are dispersed across the image in various flight positions, with their wings in different phases of the flapping cycle.\n
+    2. Direct hint: To count the number of geese, start from one corner of the image and move your eyes in a grid-like pattern—left to right, top to bottom—marking each bird as counted to avoid recounting the same goose."""
+    return prompt
+
+def class_indirect_hint_prompt(object_name):
+    prompt = f"""
+    Please generate information that can help someone on counting the number of {object_name} in an image. You need to provide the following:\n
+    3. Indirect hint: the contextual or background information about {object_name} that will help in counting, such as how they are usually arranged, grouped or packed and typical group sizes.\n
+    For example, for geese you should provide the following:\n
+    3. Indirect hint: Geese often travel in V-shaped formations or smaller groups, which can help you estimate their numbers more effectively. When counting, keep in mind that the number will likely reflect typical group sizes seen in nature, rather than a sparse or overly dense arrangement."""
+    return prompt
+
+def structured_side_information_prompt(object_name):
+    prompt = side_information_prompt(object_name) + """\n
+    Respond with a JSON object with the fields "description", "direct_hint" and "indirect_hint"."""
+    return prompt
+
 def count_with_hint_prompt(object_name, description, direct_hint, indirect_hint):
     base_prompt = f"""Please count the number of {object_name} visible in this image and respond with only the numeric answer.\n"""
     start = """You have the following information availiable to help you:\n"""
     prompt = start + f"""{description}""" + '\n' + f"""{direct_hint}""" + '\n' + f"""{indirect_hint}""" + '\n' + base_prompt
     return prompt
 
+def tile_count_prompt(object_name):
+    # No side information: the hints describe the whole image, and their count-related text would pull every
+    # tile towards the whole-image count.
+    base_prompt = f"""This image is one tile of a larger image. Please count the number of {object_name} whose center lies inside the red rectangle and respond with only the numeric answer. Do not count objects outside the rectangle; they are counted in the neighbouring tiles.\n"""
+    return base_prompt
+
 
 def drop_column(file_path, column_name):
     file = pd.read_csv(file_path)
@@ -1,71 +1,413 @@
+import csv
+import os
+import queue
+import threading
+import time
 import tkinter as tk
+from collections import OrderedDict
 from PIL import Image, ImageTk
 import pandas as pd
 from os.path import join
+import labeling_store
 
-def load_data(csv_path):
+# Number of upcoming images decoded ahead on the background thread.
+PREFETCH = 8
+# Number of PhotoImages kept for back/forward navigation.
+PHOTO_CACHE_SIZE = 32
+# Number of labels buffered before they are appended to the log.
+SAVE_EVERY = 10
+MAX_DISPLAY_SIZE = (1024, 768)
+
+
+def load_data(csv_path, log_path=None):
     df = pd.read_csv(csv_path)
     # Check if 'human' column exists, add it if not
     if 'human' not in df.columns:
-        df['human'] = pd.NA  
+        df['human'] = pd.NA
+    # Apply labels saved to the log by a session that did not exit cleanly
+    if log_path is not None and os.path.exists(log_path):
+        log = pd.read_csv(log_path).drop_duplicates('filename', keep='last').set_index('filename')['human']
+        df['human'] = df['filename'].map(log).combine_first(df['human'])
     return df
 
 def save_data(df, csv_path):
     # Save the DataFrame back to CSV
     df.to_csv(csv_path, index=False)
 
-def next_image():
-    global current_index, img_label, prompt_label, entry_human_guess
 
-    # Save the current guess to the DataFrame if valid and increment index
-    if current_index != -1:  # Check to ensure not first run where index is -1
+class LabelLog:
+    """
+    Append-only CSV log of labels (filename, human, time). Labels are handed to a writer thread and appended
+    in batches of flush_every, so saving never blocks the GUI.
+
+    Parameters:
+    path (str): The path to the log file.
+    flush_every (int): The number of labels buffered before they are written.
+    """
+
+    def __init__(self, path, flush_every=SAVE_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def record(self, filename, human):
+        self.queue.put((filename, human, time.time()))
+
+    def _append(self, rows):
+        new = not os.path.exists(self.path)
+        with open(self.path, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if new:
+                writer.writerow(['filename', 'human', 'time'])
+            writer.writerows(rows)
+
+    def _write(self):
+        rows = []
+        while True:
+            item = self.queue.get()
+            if item is not None:
+                rows.append(item)
+            if rows and (item is None or len(rows) >= self.flush_every):
+                self._append(rows)
+                rows = []
+            if item is None:
+                return
+
+    def close(self):
+        """
+        Writes the remaining labels and stops the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class StoreLabelLog(LabelLog):
+    """
+    LabelLog that submits labels to a shared labeling store as one annotator, with the seconds spent on each
+    image. The store is opened on the writer thread, which submits the labels; leases are taken by the
+    LeasingPrefetcher.
+
+    Parameters:
+    path (str): The path to the labeling store.
+    annotator (str): The annotator's name.
+    flush_every (int): The number of labels buffered before they are submitted.
+    """
+
+    def __init__(self, path, annotator, flush_every=1):
+        self.annotator = annotator
+        self.store = None
+        self.shown_at = {}
+        super().__init__(path, flush_every)
+
+    def shown(self, filename):
+        self.shown_at.setdefault(filename, time.time())
+
+    def record(self, filename, human):
+        started = self.shown_at.pop(filename, None)
+        self.queue.put((filename, human, time.time() - started if started is not None else None))
+
+    def _append(self, rows):
+        if self.store is None:
+            self.store = labeling_store.LabelingStore(self.path)
+        self.store.submit(self.annotator, rows)
+
+
+class ImagePrefetcher:
+    """
+    Decodes and scales images on a background thread ahead of when they are shown.
+
+    Parameters:
+    max_size (tuple): The maximum display (width, height); larger images are scaled down.
+    capacity (int): The maximum number of decoded images kept.
+    """
+
+    def __init__(self, max_size=MAX_DISPLAY_SIZE, capacity=2 * PREFETCH):
+        self.max_size = max_size
+        self.capacity = capacity
+        self.decoded = OrderedDict()
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def decode(self, path):
+        image = Image.open(path)
+        image.load()
+        image.thumbnail(self.max_size)
+        return image
+
+    def _work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            self._handle(item)
+
+    def _handle(self, path):
+        with self.lock:
+            if path in self.decoded:
+                return
+        try:
+            image = self.decode(path)
+        except OSError as e:
+            print(f"Could not load {path}: {e}")
+            return
+        with self.lock:
+            self.decoded[path] = image
+            while len(self.decoded) > self.capacity:
+                self.decoded.popitem(last=False)
+
+    def prefetch(self, paths):
+        for path in paths:
+            self.requests.put(path)
+
+    def get(self, path):
+        """
+        Returns the decoded image, decoding it now if the background thread has not reached it yet.
+        """
+        with self.lock:
+            image = self.decoded.pop(path, None)
+        return image if image is not None else self.decode(path)
+
+
+class LeasingPrefetcher(ImagePrefetcher):
+    """
+    ImagePrefetcher that also leases images from the shared labeling store on its background thread, so the
+    SQLite writes, which wait while another annotator holds the write lock, never block the GUI. The store is
+    opened on that thread. Leased images are decoded as soon as they arrive.
+
+    Parameters:
+    path (str): The path to the labeling store.
+    annotator (str): The annotator's name.
+    folder_path (str): The directory the images are read from.
+    """
+
+    def __init__(self, path, annotator, folder_path, **kwargs):
+        self.path = path
+        self.annotator = annotator
+        self.folder_path = folder_path
+        self.store = None
+        self.leased = queue.Queue()
+        self.leasing = False
+        self.exhausted = False
+        super().__init__(**kwargs)
+
+    def lease(self, pending):
+        """
+        Renews the leases of the pending filenames and leases PREFETCH more in the background; the new filenames
+        are put on `leased` as one list (empty when the queue has no more images for this annotator).
+        """
+        self.leasing = True
+        self.requests.put(('lease', list(pending)))
+
+    def take(self):
+        """
+        Returns the filenames leased since the last call. A lease that found no images marks the queue as
+        exhausted, so no further leases are requested.
+        """
+        filenames = []
+        while True:
+            try:
+                leased = self.leased.get_nowait()
+            except queue.Empty:
+                return filenames
+            self.leasing = False
+            self.exhausted = not leased
+            filenames += leased
+
+    def _handle(self, item):
+        if not isinstance(item, tuple):
+            return super()._handle(item)
+        if self.store is None:
+            self.store = labeling_store.LabelingStore(self.path)
+        if item[0] == 'lease':
+            self.store.renew(self.annotator, item[1])
+            filenames = self.store.lease(self.annotator, PREFETCH)
+            self.leased.put(filenames)
+            for filename in filenames:
+                super()._handle(join(self.folder_path, filename))
+        elif item[0] == 'release':
+            # Unlabeled leases go back to the queue for the other annotators
+            self.store.release(self.annotator)
+            self.store.close()
+
+    def close(self):
+        """
+        Releases the annotator's leases and stops the background thread.
+        """
+        self.requests.put(('release',))
+        self.requests.put(None)
+        self.thread.join()
+
+
+class PhotoCache:
+    """
+    LRU cache of PhotoImages, created on the Tk thread from prefetched images.
+    """
+
+    def __init__(self, prefetcher, capacity=PHOTO_CACHE_SIZE):
+        self.prefetcher = prefetcher
+        self.capacity = capacity
+        self.photos = OrderedDict()
+
+    def get(self, path):
+        if path in self.photos:
+            self.photos.move_to_end(path)
+        else:
+            self.photos[path] = ImageTk.PhotoImage(self.prefetcher.get(path))
+            while len(self.photos) > self.capacity:
+                self.photos.popitem(last=False)
+        return self.photos[path]
+
+
+def save_current():
+    # Save the current guess to the DataFrame and the log if valid
+    if 0 <= history_position < len(history):
+        index = history[history_position]
         try:
             human_guess = int(entry_human_guess.get())
-            df.loc[current_index, 'human'] = human_guess
-            save_data(df, csv_path)
         except ValueError:
-            pass
-
-    # Find the next image without a human guess
-    while True:
-        current_index += 1
-        if current_index >= len(df) or pd.isna(df.loc[current_index, 'human']):
-            break
-
-    if current_index < len(df):
-        # Update the image and prompt
-        img_path = join(folder_path, df.loc[current_index, 'filename'])
-        image = Image.open(img_path)
-        #image = image.resize((300, 300), Image.ANTIALIAS)
-        photo = ImageTk.PhotoImage(image)
-        img_label.config(image=photo)
-        img_label.image = photo
-        prompt_label.config(text=f"Count the number of {df.loc[current_index, 'class']} in this image.")
-        entry_human_guess.delete(0, tk.END)
+            return
+        if pd.isna(df.at[index, 'human']) or df.at[index, 'human'] != human_guess:
+            df.at[index, 'human'] = human_guess
+            label_log.record(df.at[index, 'filename'], human_guess)
+
+
+def next_unlabeled():
+    # Advance through the precomputed unlabeled index, skipping rows labeled since
+    global unlabeled_position
+    if annotator is not None:
+        unlabeled.extend(index_of[filename] for filename in prefetcher.take())
+        if unlabeled_position + PREFETCH >= len(unlabeled) and not (prefetcher.leasing or prefetcher.exhausted):
+            # Lease more images from the shared queue before the prefetched ones run out, keeping the pending ones
+            prefetcher.lease([df.at[i, 'filename'] for i in unlabeled[unlabeled_position:]])
+    while unlabeled_position < len(unlabeled):
+        index = unlabeled[unlabeled_position]
+        unlabeled_position += 1
+        if pd.isna(df.at[index, 'human']):
+            return index
+    return None
+
+
+def show(index):
+    img_path = join(folder_path, df.at[index, 'filename'])
+    photo = photos.get(img_path)
+    img_label.config(image=photo)
+    img_label.image = photo
+    prompt_label.config(text=f"Count the number of {df.at[index, 'class']} in this image.")
+    if annotator is not None:
+        label_log.shown(df.at[index, 'filename'])
+    entry_human_guess.delete(0, tk.END)
+    if not pd.isna(df.at[index, 'human']):
+        entry_human_guess.insert(0, str(int(df.at[index, 'human'])))
+    # Decode the next unlabeled images while the annotator counts
+    upcoming = unlabeled[unlabeled_position:unlabeled_position + PREFETCH]
+    prefetcher.prefetch(join(folder_path, df.at[i, 'filename']) for i in upcoming)
+
+
+def lease_arrived():
+    global waiting_for_lease
+    waiting_for_lease = False
+    next_image()
+
+
+def next_image():
+    global history_position, waiting_for_lease
+    save_current()
+    if history_position + 1 < len(history):
+        history_position += 1
+        show(history[history_position])
+        return
+    index = next_unlabeled()
+    if index is not None:
+        history.append(index)
+        history_position = len(history) - 1
+        show(index)
+    elif annotator is not None and prefetcher.leasing:
+        # Wait for the lease running in the background without blocking the window
+        history_position = len(history)
+        prompt_label.config(text="Waiting for images...")
+        img_label.config(image='')
+        if not waiting_for_lease:
+            root.after(100, lease_arrived)
+            waiting_for_lease = True
     else:
+        history_position = len(history)
         prompt_label.config(text="No more images to label.")
         img_label.config(image='')
         entry_human_guess.delete(0, tk.END)
 
-# Paths
-folder_path =  'FSC147_384_V2/selected_300_images'
-csv_path = 'results/human_evaluation.csv'
 
-df = load_data(csv_path)
+def previous_image():
+    global history_position
+    save_current()
+    if history_position > 0:
+        history_position -= 1
+        show(history[history_position])
+
+
+def close():
+    # Write the remaining labels, then fold the log into the CSV once
+    save_current()
+    label_log.close()
+    if annotator is not None:
+        prefetcher.close()
+    else:
+        save_data(df, csv_path)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+    root.destroy()
+
+
+if __name__ == "__main__":
+    # Paths
+    folder_path =  'FSC147_384_V2/selected_300_images'
+    csv_path = 'results/human_evaluation.csv'
+    log_path = 'results/human_evaluation_log.csv'
+    # Set to label with several annotators at once through the shared labeling store instead of the CSV
+    annotator = None
+    # annotator = 'leo'
+
+    if annotator is None:
+        df = load_data(csv_path, log_path)
+        unlabeled = list(df.index[df['human'].isna()])
+        label_log = LabelLog(log_path)
+        prefetcher = ImagePrefetcher()
+    else:
+        store = labeling_store.LabelingStore(labeling_store.store_path)
+        # Leases left by an earlier session of this annotator are taken up again from the queue
+        store.release(annotator)
+        df = store.images()
+        store.close()
+        df['human'] = pd.NA
+        index_of = dict(zip(df['filename'], df.index))
+        unlabeled = []
+        label_log = StoreLabelLog(labeling_store.store_path, annotator)
+        prefetcher = LeasingPrefetcher(labeling_store.store_path, annotator, folder_path)
+    unlabeled_position = 0
+    history = []
+    history_position = -1
+    waiting_for_lease = False
+    photos = PhotoCache(prefetcher)
 
-# Setup GUI
-root = tk.Tk()
-root.title("Image Labeling Tool")
-current_index = -1
-img_label = tk.Label(root)
-img_label.pack()
-prompt_label = tk.Label(root, text="", font=('Helvetica', 14))
-prompt_label.pack()
-entry_human_guess = tk.Entry(root)
-entry_human_guess.pack()
-next_button = tk.Button(root, text="Next", command=next_image)
-next_button.pack()
+    # Setup GUI
+    root = tk.Tk()
+    root.title("Image Labeling Tool")
+    img_label = tk.Label(root)
+    img_label.pack()
+    prompt_label = tk.Label(root, text="", font=('Helvetica', 14))
+    prompt_label.pack()
+    entry_human_guess = tk.Entry(root)
+    entry_human_guess.pack()
+    buttons = tk.Frame(root)
+    buttons.pack()
+    tk.Button(buttons, text="Back", command=previous_image).pack(side=tk.LEFT)
+    tk.Button(buttons, text="Next", command=next_image).pack(side=tk.LEFT)
+    root.bind('<Return>', lambda event: next_image())
+    root.protocol("WM_DELETE_WINDOW", close)
 
-next_image()
+    next_image()
 
-root.mainloop()
\ No newline at end of file
+    root.mainloop()
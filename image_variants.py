@@ -0,0 +1,189 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Downscaled / recompressed image variants to cut upload bytes and image tokens, a per-request policy that
+picks a variant, and a benchmark of cost against accuracy for each variant.
+"""
+
+import asyncio
+import math
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from PIL import Image
+from archive import data_processing
+import helpers
+import request_engine
+import gpt4_evaluation
+import rmse_evaluation
+
+# max_side None keeps the original size; quality None keeps the original JPEG bytes.
+VariantSpec = namedtuple('VariantSpec', ['name', 'max_side', 'quality', 'detail'])
+
+DEFAULT_VARIANTS = [
+    VariantSpec('original', None, None, 'auto'),
+    VariantSpec('768_q85_high', 768, 85, 'high'),
+    VariantSpec('512_q80_high', 512, 80, 'high'),
+    VariantSpec('512_q75_low', 512, 75, 'low'),
+]
+
+
+def image_tokens(width, height, detail):
+    """
+    Estimates the image tokens of an image with the GPT-4o vision tiling rules.
+
+    Parameters:
+    width (int): The image width in pixels.
+    height (int): The image height in pixels.
+    detail (str): The detail level ('low', 'high' or 'auto'; 'auto' is counted as 'high').
+
+    Returns:
+    int: The estimated number of image tokens.
+    """
+    if detail == 'low':
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def _make_variant(job):
+    """
+    Writes one variant of one image and returns its size information.
+    """
+    image_path, output_path, variant = job
+    if variant.quality is None and variant.max_side is None:
+        with Image.open(image_path) as img:
+            width, height = img.size
+        with open(image_path, "rb") as src, open(output_path, "wb") as dst:
+            dst.write(src.read())
+    else:
+        with Image.open(image_path) as img:
+            img = img.convert('RGB')
+            if variant.max_side is not None:
+                img = data_processing.scale_to_max_side(img, variant.max_side)
+            width, height = img.size
+            img.save(output_path, format='JPEG', quality=variant.quality or 95, optimize=True)
+    return {'filename': os.path.basename(image_path), 'variant': variant.name, 'width': width, 'height': height,
+            'bytes': os.path.getsize(output_path), 'image_tokens': image_tokens(width, height, variant.detail)}
+
+
+def build_variants(images_path, variants_path, variants=DEFAULT_VARIANTS, workers=None):
+    """
+    Writes every variant of every image into variants_path/<variant name>/ using a process pool, and a
+    manifest CSV of their sizes and estimated image tokens.
+
+    Parameters:
+    images_path (str): The directory containing the original images.
+    variants_path (str): The root directory of the variants.
+    variants (list): The VariantSpecs to build.
+    workers (int): Optional; the number of worker processes. Defaults to the number of cores.
+
+    Returns:
+    DataFrame: The manifest with one row per (image, variant).
+    """
+    jobs = []
+    for variant in variants:
+        os.makedirs(os.path.join(variants_path, variant.name), exist_ok=True)
+        for filename in sorted(os.listdir(images_path)):
+            if filename.lower().endswith(('.jpg', '.jpeg')):
+                jobs.append((os.path.join(images_path, filename),
+                             os.path.join(variants_path, variant.name, filename), variant))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        manifest = pd.DataFrame(list(pool.map(_make_variant, jobs, chunksize=16)))
+    manifest.to_csv(os.path.join(variants_path, "manifest.csv"), index=False)
+    print(manifest.groupby('variant')[['bytes', 'image_tokens']].mean())
+    return manifest
+
+
+class VariantPolicy:
+    """
+    Picks the image variant sent with each request.
+
+    Parameters:
+    variants_path (str): The root directory written by build_variants.
+    choose (callable): Maps a label/evaluation row to the VariantSpec to send.
+    """
+
+    def __init__(self, variants_path, choose):
+        self.variants_path = variants_path
+        self.choose = choose
+
+    def apply(self, request, row):
+        """
+        Points a request at the chosen variant of its image and sets its detail level.
+        """
+        variant = self.choose(row)
+        request['image_path'] = os.path.join(self.variants_path, variant.name, os.path.basename(request['image_path']))
+        request['detail'] = variant.detail
+        return request
+
+
+def fixed_policy(variants_path, variant):
+    """
+    Returns a policy that always sends the same variant.
+    """
+    return VariantPolicy(variants_path, lambda row: variant)
+
+
+def estimate_policy(variants_path, small_variant, large_variant, estimate_column='gpt_4_initial_answer',
+                    threshold=20):
+    """
+    Returns a policy that sends small_variant for images whose coarse estimate (e.g. the initial count) is
+    below threshold, and large_variant otherwise or when there is no estimate.
+    """
+    def choose(row):
+        estimate = pd.to_numeric(row.get(estimate_column), errors='coerce')
+        if pd.notna(estimate) and estimate < threshold:
+            return small_variant
+        return large_variant
+    return VariantPolicy(variants_path, choose)
+
+
+def benchmark_variants(labels_csv, variants_path, variants=DEFAULT_VARIANTS, output_csv=None, **engine_kwargs):
+    """
+    Runs the initial count prompt on every variant and reports bytes, image tokens, latency and RMSE per
+    count bin for each one.
+
+    Parameters:
+    labels_csv (str): The label CSV with filenames, classes and object counts.
+    variants_path (str): The root directory written by build_variants.
+    variants (list): The VariantSpecs to benchmark.
+    output_csv (str): Optional; the path to write the report to.
+    **engine_kwargs: Options passed to request_engine.run_requests_async.
+
+    Returns:
+    DataFrame: One row per variant.
+    """
+    labels = pd.read_csv(labels_csv)
+    manifest = pd.read_csv(os.path.join(variants_path, "manifest.csv"))
+    rows = []
+    for variant in variants:
+        policy = fixed_policy(variants_path, variant)
+        requests = [policy.apply({'key': index, 'image_path': row['filename'],
+                                  'prompt': helpers.basic_count_prompt(row['class'])}, row)
+                    for index, row in labels.iterrows()]
+        results, report = asyncio.run(request_engine.run_requests_async(requests, **engine_kwargs))
+        df = labels.copy()
+        df['answer'] = pd.to_numeric(pd.Series(results).reindex(df.index).map(gpt4_evaluation.to_int_count))
+        sizes = manifest[manifest['variant'] == variant.name]
+        rows.append({'Variant': variant.name, 'Mean bytes': sizes['bytes'].mean(),
+                     'Mean image tokens': sizes['image_tokens'].mean(),
+                     'Requests per s': report['requests_per_s'], 'p50 latency (s)': report['p50_latency_s'],
+                     'p95 latency (s)': report['p95_latency_s'],
+                     **rmse_evaluation.calculate_rmse_for_ranges(df, 'object_count', 'answer')})
+    benchmark = pd.DataFrame(rows)
+    print(benchmark.to_string(index=False))
+    if output_csv is not None:
+        benchmark.to_csv(output_csv, index=False)
+    return benchmark
+
+
+if __name__ == "__main__":
+    images_path = "FSC147_384_V2/selected_300_images"
+    variants_path = "results/image_variants"
+    build_variants(images_path, variants_path)
+    # benchmark_variants("FSC147_384_V2/300_image_labels.csv", variants_path, output_csv="results/variant_benchmark.csv")
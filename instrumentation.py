@@ -0,0 +1,398 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Instrumentation of model calls. A CallLog passed as call_log to the request engine, batch mode or
+gpt4_evaluation.send_request appends one JSONL record per model call (stage, config, image, model,
+prompt/completion/cached tokens, latency, attempts and error class) and can keep a Prometheus textfile
+up to date while a run is going.
+
+    python instrumentation.py summary results/calls.jsonl
+    python instrumentation.py prometheus results/calls.jsonl results/metrics.prom --watch 15
+"""
+
+import argparse
+import atexit
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import helpers
+
+call_log_path = 'results/calls.jsonl'
+prometheus_path = 'results/metrics.prom'
+
+# USD per 1M tokens: (input, cached input, output).
+PRICES = {
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+}
+# Batch API requests are billed at half price.
+BATCH_DISCOUNT = 0.5
+# Upper edges (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64]
+METRIC_PREFIX = 'visionclue_model'
+
+
+def call_labels(request):
+    """
+    Returns the (image, stage, config) of a request, read from its custom_id ("filename|stage|config").
+    A 'stage' key in the request takes precedence over the custom_id stage.
+    """
+    if request.get('custom_id'):
+        image, stage, config = (request['custom_id'].split('|') + ['', ''])[:3]
+    else:
+        image = os.path.basename(request['image_path']) if request.get('image_path') else ''
+        stage, config = '', ''
+    return image, request.get('stage', stage) or 'unknown', config
+
+
+def usage_tokens(usage):
+    """
+    Reads (prompt, completion, cached prompt) tokens from the usage of a response, an object or a dict
+    (Batch API output). Returns Nones if there is no usage, e.g. for a stream closed early.
+    """
+    if usage is None:
+        return None, None, None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    details = usage.get('prompt_tokens_details') or {}
+    return usage.get('prompt_tokens'), usage.get('completion_tokens'), details.get('cached_tokens') or 0
+
+
+def call_cost(model, prompt_tokens, completion_tokens, cached_tokens=0, batch=False):
+    """
+    Returns the cost of a call in USD, or None for a model without a price or a call without usage.
+    """
+    prices = PRICES.get(model)
+    if prices is None or prompt_tokens is None:
+        return None
+    input_price, cached_price, output_price = prices
+    cost = ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price +
+            (completion_tokens or 0) * output_price) / 1e6
+    return cost * BATCH_DISCOUNT if batch else cost
+
+
+def attempts_for_error(error, max_retries):
+    """
+    Returns the number of attempts behind a failed call: the client retries connection errors, timeouts,
+    429s and 5xx responses max_retries times before raising; other errors fail on the first attempt.
+    """
+    status = getattr(error, 'status_code', None)
+    retried = status is None and type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+    retried = retried or status in (408, 409, 429) or (status is not None and status >= 500)
+    return max_retries + 1 if retried else 1
+
+
+def label_value(value):
+    """
+    Escapes a Prometheus label value: backslash, double quote and newline, as the text exposition format requires.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class CallMetrics:
+    """
+    Running per-stage totals and latency histograms of the calls, as exported to Prometheus.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.calls = {}
+        self.totals = {}
+        self.histograms = {}
+
+    def add(self, record):
+        key = (record['stage'], record['model'], record['error'] or '')
+        self.calls[key] = self.calls.get(key, 0) + 1
+        totals = self.totals.setdefault((record['stage'], record['model']), {
+            'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0, 'retries': 0, 'cost_usd': 0.0})
+        for name in ['prompt_tokens', 'completion_tokens', 'cached_tokens', 'cost_usd']:
+            totals[name] += record[name] or 0
+        totals['retries'] += record['attempts'] - 1
+        if record['latency_s'] is not None:
+            histogram = self.histograms.setdefault(record['stage'], [0] * len(self.buckets) + [0, 0.0])
+            for i, edge in enumerate(self.buckets):
+                if record['latency_s'] <= edge:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += record['latency_s']
+
+    def prometheus_text(self):
+        """
+        Returns the metrics in the Prometheus text exposition format, with escaped label values.
+        """
+        lines = [f"# HELP {METRIC_PREFIX}_calls_total Model calls by stage, model and error class.",
+                 f"# TYPE {METRIC_PREFIX}_calls_total counter"]
+        for (stage, model, error), count in sorted(self.calls.items()):
+            labels = f'stage="{label_value(stage)}",model="{label_value(model)}",error="{label_value(error)}"'
+            lines.append(f'{METRIC_PREFIX}_calls_total{{{labels}}} {count}')
+        lines += [f"# HELP {METRIC_PREFIX}_tokens_total Tokens by stage, model and kind.",
+                  f"# TYPE {METRIC_PREFIX}_tokens_total counter"]
+        for (stage, model), totals in sorted(self.totals.items()):
+            labels = f'stage="{label_value(stage)}",model="{label_value(model)}"'
+            for kind in ['prompt', 'completion', 'cached']:
+                lines.append(f'{METRIC_PREFIX}_tokens_total{{{labels},kind="{kind}"}} {totals[kind + "_tokens"]}')
+        lines += [f"# HELP {METRIC_PREFIX}_retries_total Retried attempts by stage and model.",
+                  f"# TYPE {METRIC_PREFIX}_retries_total counter"]
+        for (stage, model), totals in sorted(self.totals.items()):
+            labels = f'stage="{label_value(stage)}",model="{label_value(model)}"'
+            lines.append(f'{METRIC_PREFIX}_retries_total{{{labels}}} {totals["retries"]}')
+        lines += [f"# HELP {METRIC_PREFIX}_cost_usd_total Estimated cost in USD by stage and model.",
+                  f"# TYPE {METRIC_PREFIX}_cost_usd_total counter"]
+        for (stage, model), totals in sorted(self.totals.items()):
+            labels = f'stage="{label_value(stage)}",model="{label_value(model)}"'
+            lines.append(f'{METRIC_PREFIX}_cost_usd_total{{{labels}}} {totals["cost_usd"]:.6f}')
+        lines += [f"# HELP {METRIC_PREFIX}_latency_seconds Latency of model calls by stage.",
+                  f"# TYPE {METRIC_PREFIX}_latency_seconds histogram"]
+        for stage, histogram in sorted(self.histograms.items()):
+            labels = f'stage="{label_value(stage)}"'
+            for edge, count in zip(self.buckets, histogram):
+                lines.append(f'{METRIC_PREFIX}_latency_seconds_bucket{{{labels},le="{edge}"}} {count}')
+            lines.append(f'{METRIC_PREFIX}_latency_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}')
+            lines.append(f'{METRIC_PREFIX}_latency_seconds_sum{{{labels}}} {histogram[-1]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_latency_seconds_count{{{labels}}} {histogram[-2]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics as a Prometheus textfile (for the node exporter textfile collector), atomically,
+        so a scrape never reads a partly written file.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            file.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+
+class CallLog:
+    """
+    Append-only JSONL log of model calls, one record per call. Records are buffered and written once
+    flush_every have built up or flush_seconds have passed, and the rest are written at exit (the log is
+    registered with atexit while it holds records and unregistered by close); with a prometheus_path the
+    textfile is rewritten at most every export_every seconds. A closed log reopens its file when the next call
+    is recorded.
+
+    Parameters:
+    path (str): The path to the log file.
+    prometheus_path (str): Optional; the Prometheus textfile kept up to date while calls are recorded.
+    export_every (float): The minimum seconds between textfile writes.
+    flush_every (int): The number of records buffered before they are written.
+    flush_seconds (float): The maximum seconds a record stays buffered while calls are being recorded.
+    """
+
+    def __init__(self, path=call_log_path, prometheus_path=None, export_every=15, flush_every=32, flush_seconds=5):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.export_every = export_every
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.metrics = CallMetrics()
+        self.lock = threading.Lock()
+        self._buffer = []
+        self._exported = 0.0
+        self._flushed = time.time()
+        self._file = None
+        self._at_exit = False
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def record(self, request, latency_s, usage=None, attempts=1, error=None, batch=False):
+        """
+        Records one model call.
+
+        Parameters:
+        request (dict): The request, see request_engine.run_requests_async.
+        latency_s (float): The wall-clock latency including retries, or None (Batch API).
+        usage: The usage of the response (object or dict), or None.
+        attempts (int): The number of attempts, 1 if the call was not retried.
+        error (Exception): Optional; the error the call failed with.
+        batch (bool): If True, the call went through the Batch API and is billed at the batch price.
+        """
+        image, stage, config = call_labels(request)
+        model = request.get('model', helpers.MODEL)
+        prompt_tokens, completion_tokens, cached_tokens = usage_tokens(usage)
+        record = {'time': time.time(), 'stage': stage, 'config': config, 'image': image, 'model': model,
+                  'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'cached_tokens': cached_tokens, 'latency_s': latency_s, 'attempts': attempts,
+                  'error': type(error).__name__ if error is not None else None,
+                  'cost_usd': call_cost(model, prompt_tokens, completion_tokens, cached_tokens, batch),
+                  'stream': bool(request.get('stream')), 'batch': batch}
+        with self.lock:
+            if not self._at_exit:
+                atexit.register(self.close)
+                self._at_exit = True
+            self.metrics.add(record)
+            self._buffer.append(json.dumps(record))
+            if len(self._buffer) >= self.flush_every or time.time() - self._flushed >= self.flush_seconds:
+                self._flush()
+            if self.prometheus_path is not None and time.time() - self._exported >= self.export_every:
+                self._export()
+
+    def _flush(self):
+        if self._buffer:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write("\n".join(self._buffer) + "\n")
+            self._file.flush()
+            self._buffer = []
+        self._flushed = time.time()
+
+    def _export(self):
+        self.metrics.write_prometheus(self.prometheus_path)
+        self._exported = time.time()
+
+    def flush(self):
+        """
+        Writes the buffered records and the Prometheus textfile.
+        """
+        with self.lock:
+            self._flush()
+            if self.prometheus_path is not None:
+                self._export()
+
+    def close(self):
+        """
+        Writes the buffered records, closes the file and unregisters the log from atexit.
+        """
+        self.flush()
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._at_exit:
+                atexit.unregister(self.close)
+                self._at_exit = False
+
+
+def read_calls(path=call_log_path):
+    """
+    Reads a call log into a DataFrame, skipping a torn last line.
+    """
+    records = []
+    with open(path) as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return pd.DataFrame(records)
+
+
+def summarize(calls):
+    """
+    Summarizes a call log per stage and overall.
+
+    Parameters:
+    calls (DataFrame): The output of read_calls.
+
+    Returns:
+    DataFrame: Stage, Calls, Errors, Retries, p50/p95/p99 latency (s), Calls/s (over the stage's wall time),
+        prompt, completion and cached tokens, and Cost (USD).
+    """
+    rows = []
+    groups = list(calls.groupby('stage', sort=False)) + [('Overall', calls)]
+    for stage, group in groups:
+        latencies = group['latency_s'].dropna().to_numpy(dtype=float)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (math.nan,) * 3
+        # Records are written at the end of each call, so a stage starts at its first end minus that latency
+        started = (group['time'] - group['latency_s'].fillna(0)).min()
+        wall_time = group['time'].max() - started
+        rows.append({'Stage': stage, 'Calls': len(group), 'Errors': int(group['error'].notna().sum()),
+                     'Retries': int((group['attempts'] - 1).sum()),
+                     'p50 latency (s)': p50, 'p95 latency (s)': p95, 'p99 latency (s)': p99,
+                     'Calls/s': len(group) / wall_time if wall_time > 0 else math.nan,
+                     'Prompt tokens': int(group['prompt_tokens'].fillna(0).sum()),
+                     'Completion tokens': int(group['completion_tokens'].fillna(0).sum()),
+                     'Cached tokens': int(group['cached_tokens'].fillna(0).sum()),
+                     'Cost (USD)': group['cost_usd'].fillna(0).sum()})
+    return pd.DataFrame(rows)
+
+
+def latency_histogram(calls, buckets=LATENCY_BUCKETS):
+    """
+    Returns the number of calls per stage in each latency bucket (non-cumulative), one column per bucket.
+    """
+    edges = [0] + list(buckets) + [math.inf]
+    labels = [f"<= {edge}s" for edge in buckets] + [f"> {buckets[-1]}s"]
+    timed = calls.dropna(subset=['latency_s'])
+    binned = pd.cut(timed['latency_s'], edges, labels=labels, include_lowest=True)
+    return pd.crosstab(timed['stage'], binned).reindex(columns=labels, fill_value=0)
+
+
+def error_counts(calls):
+    """
+    Returns the number of failed calls per stage and error class.
+    """
+    failed = calls.dropna(subset=['error'])
+    return failed.groupby(['stage', 'error']).size().rename('Calls').reset_index()
+
+
+def _read_new(log_path, offset, metrics):
+    # Adds the complete lines after offset to metrics and returns the new offset
+    if not os.path.exists(log_path):
+        return offset
+    with open(log_path, "rb") as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            metrics.add(json.loads(line))
+    return offset
+
+
+def watch(log_path, textfile_path, interval=15):
+    """
+    Follows a call log written by another process and rewrites the Prometheus textfile every interval
+    seconds, reading only the lines added since the last pass.
+    """
+    metrics = CallMetrics()
+    offset = 0
+    while True:
+        offset = _read_new(log_path, offset, metrics)
+        metrics.write_prometheus(textfile_path)
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize and export the model call log.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    summary = commands.add_parser('summary', help="per-stage latency percentiles, histograms, throughput and cost")
+    summary.add_argument("log", nargs='?', default=call_log_path)
+    summary.add_argument("--csv", help="also write the per-stage summary to this CSV")
+    export = commands.add_parser('prometheus', help="write the call metrics as a Prometheus textfile")
+    export.add_argument("log", nargs='?', default=call_log_path)
+    export.add_argument("textfile", nargs='?', default=prometheus_path)
+    export.add_argument("--watch", type=float, metavar="SECONDS", help="keep following the log")
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        calls = read_calls(args.log)
+        report = summarize(calls)
+        print(report.to_string(index=False, float_format=lambda x: f"{x:.4g}"))
+        print("\nLatency histogram (calls per bucket):")
+        print(latency_histogram(calls).to_string())
+        errors = error_counts(calls)
+        if len(errors):
+            print("\nErrors:")
+            print(errors.to_string(index=False))
+        if args.csv:
+            report.to_csv(args.csv, index=False)
+    elif args.watch:
+        watch(args.log, args.textfile, args.watch)
+    else:
+        metrics = CallMetrics()
+        _read_new(args.log, 0, metrics)
+        metrics.write_prometheus(args.textfile)
+        print(f"Wrote {args.textfile}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Shared SQLite store for human labeling by several annotators at once. Annotators lease distinct unlabeled
+images from a work queue (leases expire, so images held by a closed session go back to the queue), submit
+one row per label with the time spent, and aggregate combines the labels into the `human` column (median
+across annotators) read by rmse_evaluation.py.
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+import pandas as pd
+
+store_path = 'results/labeling.sqlite'
+labels_csv_path = 'FSC147_384_V2/300_image_labels.csv'
+human_csv_path = 'results/human_evaluation.csv'
+
+# Seconds an image stays reserved for an annotator without a label being submitted.
+LEASE_SECONDS = 900
+
+
+class LabelingStore:
+    """
+    SQLite labeling store in WAL mode, so annotators write concurrently without rewriting any file. Every
+    process opens its own LabelingStore.
+
+    Parameters:
+    path (str): The path to the SQLite database file.
+    replicas (int): Optional; the number of annotators that should label each image. It is saved in the store,
+        so later sessions (e.g. the GUI) read it back; when None, the saved value is used (1 for a new store).
+    lease_seconds (float): How long a leased image is reserved for an annotator.
+    """
+
+    def __init__(self, path=store_path, replicas=None, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Transactions are opened explicitly; writers wait up to 30 s for each other.
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                position INTEGER PRIMARY KEY,
+                filename TEXT NOT NULL UNIQUE,
+                class TEXT,
+                object_count INTEGER
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                filename TEXT NOT NULL,
+                annotator TEXT NOT NULL,
+                leased_at REAL NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (filename, annotator)
+            ) WITHOUT ROWID""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS leases_expires ON leases (expires)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS labels (
+                filename TEXT NOT NULL,
+                annotator TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                seconds REAL,
+                labeled_at REAL NOT NULL,
+                PRIMARY KEY (filename, annotator)
+            ) WITHOUT ROWID""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS labels_annotator ON labels (annotator)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'replicas'").fetchone()
+        self.replicas = int(row[0]) if row is not None else 1
+        if replicas is not None:
+            self.set_replicas(replicas)
+
+    def set_replicas(self, replicas):
+        """
+        Sets and saves the number of annotators that should label each image.
+        """
+        if replicas < 1:
+            raise ValueError(f"replicas must be at least 1, got {replicas}")
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('replicas', ?)", (str(replicas),))
+        self.replicas = replicas
+
+    def add_images(self, labels):
+        """
+        Adds images to the work queue in the given order; images already in the store are kept as they are.
+        The store's replicas setting is saved with them.
+
+        Parameters:
+        labels (DataFrame): filename, class and object_count, e.g. FSC147_384_V2/300_image_labels.csv.
+
+        Returns:
+        int: The number of images added.
+        """
+        rows = labels[['filename', 'class', 'object_count']].itertuples(index=False, name=None)
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO images (filename, class, object_count) VALUES (?, ?, ?)",
+                                  rows)
+            self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('replicas', ?)", (str(self.replicas),))
+            return self.conn.total_changes - before
+
+    def images(self):
+        """
+        Returns filename, class and object_count of every image, in queue order.
+        """
+        return pd.read_sql_query("SELECT filename, class, object_count FROM images ORDER BY position", self.conn)
+
+    def lease(self, annotator, n=1):
+        """
+        Reserves up to n images for an annotator: images the annotator has not labeled that still need labels,
+        least-labeled first, then in queue order. An image is handed to at most `replicas` annotators at a time,
+        counting both labels and unexpired leases, so concurrent annotators receive distinct images.
+
+        Parameters:
+        annotator (str): The annotator's name.
+        n (int): The number of images to reserve.
+
+        Returns:
+        list: The leased filenames.
+        """
+        now = time.time()
+        with self.conn:
+            # BEGIN IMMEDIATE takes the write lock first, so two annotators cannot select the same images.
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            filenames = [row[0] for row in self.conn.execute("""
+                SELECT filename FROM (
+                    SELECT i.filename, i.position,
+                           (SELECT COUNT(*) FROM labels l WHERE l.filename = i.filename) +
+                           (SELECT COUNT(*) FROM leases s WHERE s.filename = i.filename) AS taken
+                    FROM images i
+                    WHERE NOT EXISTS (SELECT 1 FROM labels l WHERE l.filename = i.filename AND l.annotator = ?)
+                      AND NOT EXISTS (SELECT 1 FROM leases s WHERE s.filename = i.filename AND s.annotator = ?))
+                WHERE taken < ?
+                ORDER BY taken, position
+                LIMIT ?""", (annotator, annotator, self.replicas, n))]
+            self.conn.executemany("INSERT INTO leases (filename, annotator, leased_at, expires) VALUES (?, ?, ?, ?)",
+                                  [(filename, annotator, now, now + self.lease_seconds) for filename in filenames])
+        return filenames
+
+    def renew(self, annotator, filenames):
+        """
+        Extends the leases of an annotator that is still working on the given images.
+        """
+        expires = time.time() + self.lease_seconds
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany("UPDATE leases SET expires = ? WHERE filename = ? AND annotator = ?",
+                                  [(expires, filename, annotator) for filename in filenames])
+
+    def release(self, annotator, filenames=None):
+        """
+        Returns leased images to the queue, e.g. when an annotator closes their session.
+
+        Parameters:
+        annotator (str): The annotator's name.
+        filenames (list): Optional; the images to release. Defaults to all of the annotator's leases.
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if filenames is None:
+                self.conn.execute("DELETE FROM leases WHERE annotator = ?", (annotator,))
+            else:
+                self.conn.executemany("DELETE FROM leases WHERE filename = ? AND annotator = ?",
+                                      [(filename, annotator) for filename in filenames])
+
+    def submit(self, annotator, labels):
+        """
+        Records labels of one annotator in a single transaction and ends their leases. A later label of the same
+        annotator for the same image replaces the earlier one. Labels are accepted even if the lease expired.
+
+        Parameters:
+        annotator (str): The annotator's name.
+        labels (list): (filename, count, seconds) tuples; seconds is the time spent on the image, or None.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany("""
+                INSERT INTO labels (filename, annotator, count, seconds, labeled_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (filename, annotator) DO UPDATE SET
+                    count = excluded.count, seconds = COALESCE(excluded.seconds, seconds),
+                    labeled_at = excluded.labeled_at""",
+                                  [(filename, annotator, int(count), seconds, now) for filename, count, seconds in labels])
+            self.conn.executemany("DELETE FROM leases WHERE filename = ? AND annotator = ?",
+                                  [(filename, annotator) for filename, _, _ in labels])
+
+    def labels(self, annotator=None):
+        """
+        Returns every label (filename, annotator, count, seconds, labeled_at), optionally of one annotator.
+        """
+        sql = "SELECT filename, annotator, count, seconds, labeled_at FROM labels"
+        params = []
+        if annotator is not None:
+            sql += " WHERE annotator = ?"
+            params.append(annotator)
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def progress(self):
+        """
+        Returns the number of images, of images with at least one and with `replicas` labels, of active leases, and
+        the replicas setting.
+        """
+        row = self.conn.execute("""
+            SELECT (SELECT COUNT(*) FROM images),
+                   (SELECT COUNT(DISTINCT filename) FROM labels),
+                   (SELECT COUNT(*) FROM (SELECT filename FROM labels GROUP BY filename HAVING COUNT(*) >= ?)),
+                   (SELECT COUNT(*) FROM leases WHERE expires >= ?)""", (self.replicas, time.time())).fetchone()
+        return dict(zip(['images', 'labeled', 'complete', 'leased'], row), replicas=self.replicas)
+
+    def annotator_stats(self):
+        """
+        Returns per-annotator label counts and timing: median and 90th percentile seconds per image, and
+        labels per hour of labeling time.
+
+        Returns:
+        DataFrame: annotator, labels, median_seconds, p90_seconds, labels_per_hour.
+        """
+        labels = self.labels()
+        stats = labels.groupby('annotator')['seconds'].agg(
+            labels='size', median_seconds='median', p90_seconds=lambda s: s.quantile(0.9), total_seconds='sum')
+        stats['labels_per_hour'] = 3600 * stats['labels'] / stats['total_seconds'].where(stats['total_seconds'] > 0)
+        return stats.drop(columns='total_seconds').reset_index()
+
+    def aggregate(self, min_labels=1):
+        """
+        Combines the labels of every image into one human count: the median across annotators.
+
+        Parameters:
+        min_labels (int): Images with fewer labels get no human count (NA).
+
+        Returns:
+        DataFrame: filename, class, object_count, human (median), human_labels (the number of labels) and
+            human_spread (max - min across annotators), in queue order.
+        """
+        grouped = self.labels().groupby('filename')['count']
+        combined = pd.DataFrame({'human': grouped.median(), 'human_labels': grouped.size(),
+                                 'human_spread': grouped.max() - grouped.min()})
+        result = self.images().merge(combined, left_on='filename', right_index=True, how='left')
+        result['human_labels'] = result['human_labels'].fillna(0).astype(int)
+        result.loc[result['human_labels'] < min_labels, ['human', 'human_spread']] = pd.NA
+        return result
+
+    def export_human_csv(self, csv_path=human_csv_path, min_labels=1):
+        """
+        Writes the aggregated labels in the layout of results/human_evaluation.csv, the human_file of
+        rmse_evaluation.process_human_and_gpt_rmse.
+        """
+        aggregated = self.aggregate(min_labels)
+        aggregated.to_csv(csv_path, index=False)
+        print(f"Wrote {aggregated['human'].notna().sum()} aggregated human counts to {csv_path}")
+        return aggregated
+
+    def import_csv(self, csv_path, annotator):
+        """
+        Imports the human column of a single-annotator CSV (e.g. results/human_evaluation.csv) as the labels
+        of one annotator, without timing. The CSV's images are added to the queue.
+        """
+        df = pd.read_csv(csv_path)
+        self.add_images(df)
+        labeled = df.dropna(subset=['human'])
+        self.submit(annotator, [(filename, count, None) for filename, count in zip(labeled['filename'], labeled['human'])])
+        print(f"Imported {len(labeled)} labels of {annotator} from {csv_path}")
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the shared human labeling store.")
+    parser.add_argument("--store", default=store_path, help="the SQLite store")
+    parser.add_argument("--replicas", type=int, help="annotators per image, saved in the store (default: the saved "
+                                                     "value, 1 for a new store)")
+    parser.add_argument("--add", metavar="CSV", help="add the images of a label CSV to the queue")
+    parser.add_argument("--import-csv", nargs=2, metavar=("CSV", "ANNOTATOR"),
+                        help="import the human column of a CSV as one annotator's labels")
+    parser.add_argument("--export", metavar="CSV", help="write the median human counts for rmse_evaluation.py")
+    parser.add_argument("--min-labels", type=int, default=1, help="labels required for an exported human count")
+    args = parser.parse_args()
+
+    store = LabelingStore(args.store, replicas=args.replicas)
+    if args.add:
+        print(f"Added {store.add_images(pd.read_csv(args.add))} images to {args.store}")
+    if args.import_csv:
+        store.import_csv(*args.import_csv)
+    if args.export:
+        store.export_human_csv(args.export, args.min_labels)
+    print(store.progress())
+    print(store.annotator_stats().to_string(index=False))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Local stand-in for the parts of the OpenAI API used by this project, so the pipeline can run offline.
+Point the client at it with OPENAI_BASE_URL=<server.base_url> and any OPENAI_API_KEY.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+
+CANNED_HINTS = ("1. **Description:** The image shows several objects spread across the frame.\n"
+                "2. **Direct hint:** Count row by row from the top left corner.\n"
+                "3. **Indirect hint:** Objects of this kind are usually arranged in small groups.")
+
+
+def default_responder(body):
+    """
+    Returns a canned answer for a chat completion request body: hints for the side information prompt, the
+    indirect hint for the class-level hint prompt and a fixed count for counting prompts.
+    """
+    prompt = body['messages'][0]['content'][0]['text']
+    if "Indirect hint" in prompt and "Direct hint" not in prompt:
+        return CANNED_HINTS.splitlines()[-1]
+    if "Direct hint" in prompt:
+        if body.get('response_format', {}).get('type') == 'json_schema':
+            sections = re.findall(r'\*\*[^*]+\*\* (.*)', CANNED_HINTS)
+            return json.dumps(dict(zip(['description', 'direct_hint', 'indirect_hint'], sections)))
+        return CANNED_HINTS
+    return "10"
+
+
+def label_responder(labels_csv, images_path, fallback=default_responder):
+    """
+    Returns a responder that answers counting prompts with the true object_count of the attached image,
+    matched by image content hash, so runs against the mock are deterministic and scoreable.
+
+    Parameters:
+    labels_csv (str): The label CSV with 'filename' and 'object_count' columns.
+    images_path (str): The directory containing the labelled images.
+    fallback (callable): The responder used for other prompts and unknown images.
+
+    Returns:
+    callable: The responder.
+    """
+    labels = pd.read_csv(labels_csv)
+    counts = {}
+    for filename, count in zip(labels['filename'], labels['object_count']):
+        path = os.path.join(images_path, filename)
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                counts[hashlib.sha256(file.read()).hexdigest()] = int(count)
+
+    def responder(body):
+        prompt = body['messages'][0]['content'][0]['text']
+        if "Direct hint" not in prompt and len(body['messages'][0]['content']) > 1:
+            url = body['messages'][0]['content'][1]['image_url']['url']
+            digest = hashlib.sha256(base64.b64decode(url.split(",", 1)[1])).hexdigest()
+            if digest in counts:
+                return str(counts[digest])
+        return fallback(body)
+    return responder
+
+
+def latency_sampler(kind='fixed', median=0.0, sigma=0.5, low=0.0, high=0.0, seed=0):
+    """
+    Returns a function that samples per-request latencies in seconds.
+
+    Parameters:
+    kind (str): 'fixed' (always median), 'uniform' (between low and high) or 'lognormal' (given median and sigma).
+    median (float): The median latency for 'fixed' and 'lognormal'.
+    sigma (float): The log-space standard deviation for 'lognormal'.
+    low (float): The lower bound for 'uniform'.
+    high (float): The upper bound for 'uniform'.
+    seed (int): The random seed.
+
+    Returns:
+    callable: A function of no arguments returning a latency.
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def sample():
+        with lock:
+            if kind == 'uniform':
+                return rng.uniform(low, high)
+            if kind == 'lognormal':
+                return rng.lognormvariate(0.0, sigma) * median if median > 0 else 0.0
+            return median
+    return sample
+
+
+def chat_completion(body, content):
+    """
+    Builds a chat completion response object with one choice per answer (content is an answer or a list of
+    answers, for requests with n > 1).
+    """
+    contents = [content] if isinstance(content, str) else list(content)
+    prompt_tokens = sum(len(part.get('text', '')) // 4 for message in body['messages']
+                        for part in message['content'] if isinstance(part, dict))
+    completion_tokens = sum(max(1, len(text) // 4) for text in contents)
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model'),
+        'choices': [{'index': i, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': text}} for i, text in enumerate(contents)],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+def stream_chunks(body, content):
+    """
+    Splits an answer into the chat.completion.chunk objects of a streamed response, one per word.
+    """
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    def chunk(delta, finish_reason=None):
+        return {'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                'model': body.get('model'), 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+    yield chunk({'role': 'assistant', 'content': ''})
+    for piece in re.findall(r'\S+\s*|\s+', content):
+        yield chunk({'content': piece})
+    yield chunk({}, 'stop')
+
+
+def truncate(body, content):
+    """
+    Cuts an answer to the request's max_tokens, at about four characters per token.
+    """
+    max_tokens = body.get('max_tokens')
+    return content if max_tokens is None else content[:max_tokens * 4]
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """
+    HTTP server holding the state of the mock API.
+
+    Parameters:
+    address (tuple): The (host, port) to bind; port 0 picks a free port.
+    responder (callable): Maps a chat completion request body to the answer text.
+    batch_delay (float): Seconds a batch stays in progress before it completes.
+    latency (callable): Optional; returns the delay in seconds before each chat completion is answered.
+    error_rate (float): The fraction of chat completions answered with a 500 error (batch requests: error file lines).
+    rate_limit_rate (float): The fraction of chat completions answered with a 429 rate limit error.
+    seed (int): The random seed for error injection.
+    token_delay (float): Seconds between the chunks of a streamed response.
+    sample_spread (float): Log-space sigma of the noise applied to numeric answers sampled at a temperature
+        above 0, so the choices of an n > 1 request differ as they would from the model.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address=('127.0.0.1', 0), responder=default_responder, batch_delay=0.0, latency=None,
+                 error_rate=0.0, rate_limit_rate=0.0, seed=0, token_delay=0.0, sample_spread=0.0):
+        super().__init__(address, MockHandler)
+        self.responder = responder
+        self.batch_delay = batch_delay
+        self.latency = latency or latency_sampler()
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.token_delay = token_delay
+        self.sample_spread = sample_spread
+        self.random = random.Random(seed)
+        self.counters = {'requests': 0, 'errors': 0, 'rate_limited': 0, 'streams_closed_early': 0}
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def roll(self):
+        """
+        Decides the outcome of a chat completion: 'rate_limited', 'error' or 'ok'.
+        """
+        with self.lock:
+            self.counters['requests'] += 1
+            value = self.random.random()
+            if value < self.rate_limit_rate:
+                self.counters['rate_limited'] += 1
+                return 'rate_limited'
+            if value < self.rate_limit_rate + self.error_rate:
+                self.counters['errors'] += 1
+                return 'error'
+            return 'ok'
+
+    def answers(self, body):
+        """
+        Returns the n answers of a chat completion request, truncated to max_tokens.
+        """
+        answers = []
+        for _ in range(body.get('n') or 1):
+            answer = truncate(body, self.responder(body))
+            if self.sample_spread and body.get('temperature', 1) > 0 and answer.strip().isdigit():
+                with self.lock:
+                    noise = self.random.lognormvariate(0, self.sample_spread)
+                answer = str(max(0, round(int(answer) * noise)))
+            answers.append(answer)
+        return answers
+
+    def add_file(self, filename, purpose, data):
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        record = {'id': file_id, 'object': 'file', 'bytes': len(data), 'created_at': int(time.time()),
+                  'filename': filename, 'purpose': purpose, 'status': 'processed'}
+        with self.lock:
+            self.files[file_id] = (record, data)
+        return record
+
+    def create_batch(self, request):
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        batch = {'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'],
+                 'input_file_id': request['input_file_id'], 'completion_window': request['completion_window'],
+                 'status': 'in_progress', 'created_at': int(time.time()), 'output_file_id': None,
+                 'error_file_id': None, 'metadata': request.get('metadata'),
+                 'request_counts': {'total': 0, 'completed': 0, 'failed': 0}}
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._run_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def _run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        _, data = self.files[batch['input_file_id']]
+        outputs = []
+        errors = []
+        for line in data.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            # Injected errors of a batch request go to the error file, as failed requests of a real batch do
+            outcome = self.roll()
+            if outcome != 'ok':
+                response = {'status_code': 429, 'body': {'error': {'message': 'Rate limit reached', 'type': 'requests'}}}
+                if outcome == 'error':
+                    response = {'status_code': 500, 'body': {'error': {'message': 'Injected server error',
+                                                                        'type': 'server_error'}}}
+                errors.append(json.dumps({'id': f"batch_req_{uuid.uuid4().hex[:12]}",
+                                          'custom_id': request['custom_id'], 'response': response, 'error': None}))
+                continue
+            response = chat_completion(request['body'], self.answers(request['body']))
+            outputs.append(json.dumps({'id': f"batch_req_{uuid.uuid4().hex[:12]}", 'custom_id': request['custom_id'],
+                                       'response': {'status_code': 200, 'body': response}, 'error': None}))
+        time.sleep(self.batch_delay)
+        output = self.add_file(f"{batch_id}_output.jsonl", 'batch_output', ("\n".join(outputs) + "\n").encode('utf-8'))
+        error = None
+        if errors:
+            error = self.add_file(f"{batch_id}_error.jsonl", 'batch_output', ("\n".join(errors) + "\n").encode('utf-8'))
+        with self.lock:
+            batch.update(status='completed', output_file_id=output['id'], completed_at=int(time.time()),
+                         error_file_id=error['id'] if error else None,
+                         request_counts={'total': len(outputs) + len(errors), 'completed': len(outputs),
+                                         'failed': len(errors)})
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send_json(self, obj, status=200, headers=None):
+        self._send_bytes(json.dumps(obj).encode('utf-8'), status, 'application/json', headers)
+
+    def _send_bytes(self, data, status=200, content_type='application/octet-stream', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self):
+        self._send_json({'error': {'message': f"Unknown path {self.path}", 'type': 'invalid_request_error'}}, 404)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path == '/v1/chat/completions':
+            self._chat_completion(json.loads(body))
+        elif self.path == '/v1/files':
+            message = BytesParser(policy=policy.default).parsebytes(
+                b"Content-Type: " + self.headers['Content-Type'].encode() + b"\r\n\r\n" + body)
+            fields = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                fields[name] = (part.get_filename(), part.get_payload(decode=True))
+            filename, data = fields['file']
+            self._send_json(self.server.add_file(filename, fields['purpose'][1].decode(), data))
+        elif self.path == '/v1/batches':
+            self._send_json(self.server.create_batch(json.loads(body)))
+        else:
+            self._not_found()
+
+    def _chat_completion(self, body):
+        time.sleep(self.server.latency())
+        outcome = self.server.roll()
+        if outcome == 'rate_limited':
+            self._send_json({'error': {'message': 'Rate limit reached', 'type': 'requests',
+                                       'code': 'rate_limit_exceeded'}}, 429, {'Retry-After': '1'})
+        elif outcome == 'error':
+            self._send_json({'error': {'message': 'Injected server error', 'type': 'server_error'}}, 500)
+        elif body.get('stream'):
+            self._stream_completion(body, self.server.answers(body)[0])
+        else:
+            self._send_json(chat_completion(body, self.server.answers(body)))
+
+    def _stream_completion(self, body, content):
+        """
+        Sends a streamed (server-sent events) chat completion; a client that closes the stream early is counted.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in stream_chunks(body, content):
+                event = f"data: {json.dumps(chunk)}\n\n".encode('utf-8')
+                self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                self.wfile.flush()
+                time.sleep(self.server.token_delay)
+            event = b"data: [DONE]\n\n"
+            self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            with self.server.lock:
+                self.server.counters['streams_closed_early'] += 1
+            self.close_connection = True
+
+    def do_GET(self):
+        if self.path == '/v1/_mock/stats':
+            with self.server.lock:
+                self._send_json(dict(self.server.counters))
+            return
+        match = re.fullmatch(r'/v1/batches/([\w-]+)', self.path)
+        if match and match.group(1) in self.server.batches:
+            with self.server.lock:
+                self._send_json(dict(self.server.batches[match.group(1)]))
+            return
+        match = re.fullmatch(r'/v1/files/([\w-]+)/content', self.path)
+        if match and match.group(1) in self.server.files:
+            self._send_bytes(self.server.files[match.group(1)][1])
+            return
+        self._not_found()
+
+
+def start_server(port=0, **kwargs):
+    """
+    Starts the mock server on a background thread.
+
+    Parameters:
+    port (int): The port to listen on; 0 picks a free port.
+    **kwargs: Passed to MockOpenAIServer.
+
+    Returns:
+    MockOpenAIServer: The running server; call shutdown() to stop it.
+    """
+    server = MockOpenAIServer(('127.0.0.1', port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI chat completions, files and batches API.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", choices=['fixed', 'uniform', 'lognormal'], default='lognormal')
+    parser.add_argument("--median", type=float, default=0.5, help="median latency in seconds")
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-space sigma for lognormal latency")
+    parser.add_argument("--low", type=float, default=0.0, help="lower bound for uniform latency")
+    parser.add_argument("--high", type=float, default=1.0, help="upper bound for uniform latency")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--sample-spread", type=float, default=0.0,
+                        help="log-space sigma of the noise on sampled numeric answers (temperature > 0)")
+    parser.add_argument("--labels", default="FSC147_384_V2/300_image_labels.csv")
+    parser.add_argument("--images", default="FSC147_384_V2/selected_300_images")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(('127.0.0.1', args.port),
+                              responder=label_responder(args.labels, args.images),
+                              latency=latency_sampler(args.latency, args.median, args.sigma, args.low, args.high),
+                              error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                              token_delay=args.token_delay, sample_spread=args.sample_spread)
+    print(f"Mock OpenAI API listening on {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,162 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+"""
+
+import base64
+import hashlib
+import json
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+import helpers
+
+INDEX_FILE = "index.json"
+BLOB_FILE = "payloads.bin"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def _encode_file(image_path):
+    """
+    Reads an image once and returns its content hash and data URL.
+    """
+    with open(image_path, "rb") as image_file:
+        data = image_file.read()
+    data_url = "data:image/jpeg;base64," + base64.b64encode(data).decode('ascii')
+    return hashlib.sha256(data).hexdigest(), data_url
+
+
+def build_payload_store(images_path, store_path, workers=None):
+    """
+    Encodes every JPEG in a directory into a blob file of data URLs plus an offset index.
+
+    The build is incremental: files whose size and modification time match the existing index are not
+    re-read, and payloads are stored once per content hash, so renamed or duplicate images share a payload.
+
+    Parameters:
+    images_path (str): The directory containing the images.
+    store_path (str): The directory to write the index and blob files to.
+    workers (int): Optional; the number of encoding processes. Defaults to the number of cores.
+
+    Returns:
+    dict: The number of images, newly encoded images and the blob size in bytes.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    index_path = os.path.join(store_path, INDEX_FILE)
+    blob_path = os.path.join(store_path, BLOB_FILE)
+
+    old_index = {'files': {}, 'payloads': {}}
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            old_index = json.load(file)
+
+    files = {}
+    to_encode = []
+    for filename in sorted(os.listdir(images_path)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        stat = os.stat(os.path.join(images_path, filename))
+        entry = old_index['files'].get(filename)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            files[filename] = entry
+        else:
+            files[filename] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            to_encode.append(filename)
+
+    encoded = {}
+    if to_encode:
+        paths = [os.path.join(images_path, filename) for filename in to_encode]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for filename, (digest, data_url) in zip(to_encode, pool.map(_encode_file, paths, chunksize=8)):
+                files[filename]['hash'] = digest
+                encoded[digest] = data_url
+
+    # Rewrite the blob with only the payloads still referenced, copying unchanged ones from the old blob.
+    old_blob = None
+    if os.path.exists(blob_path) and os.path.getsize(blob_path) > 0:
+        with open(blob_path, "rb") as file:
+            old_blob = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    payloads = {}
+    tmp_path = blob_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as out:
+            for digest in sorted({entry['hash'] for entry in files.values()}):
+                if digest in encoded:
+                    data = encoded[digest].encode('ascii')
+                else:
+                    offset, length = old_index['payloads'][digest]
+                    data = old_blob[offset:offset + length]
+                payloads[digest] = (out.tell(), len(data))
+                out.write(data)
+    finally:
+        if old_blob is not None:
+            old_blob.close()
+    os.replace(tmp_path, blob_path)
+
+    with open(index_path + ".tmp", "w") as file:
+        json.dump({'files': files, 'payloads': payloads}, file)
+    os.replace(index_path + ".tmp", index_path)
+
+    summary = {'images': len(files), 'encoded': len(to_encode), 'bytes': os.path.getsize(blob_path)}
+    print(f"Payload store {store_path}: {summary}")
+    return summary
+
+
+class PayloadStore:
+    """
+    Read-only view of a payload store that serves data URLs from a memory-mapped blob file.
+
+    Parameters:
+    store_path (str): The directory containing the index and blob files.
+    """
+
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, INDEX_FILE)) as file:
+            index = json.load(file)
+        self.files = index['files']
+        self.payloads = index['payloads']
+        self._file = open(os.path.join(store_path, BLOB_FILE), "rb")
+        self.blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.payloads else b""
+
+    def _entry(self, image_path):
+        entry = self.files.get(os.path.basename(image_path))
+        if entry is None:
+            return None
+        stat = os.stat(image_path)
+        if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return entry
+
+    def content_hash(self, image_path):
+        """
+        Returns the stored content hash of an image, or None if it is not in the store or has changed.
+        """
+        entry = self._entry(image_path)
+        return entry['hash'] if entry else None
+
+    def data_url(self, image_path):
+        """
+        Returns the data URL of an image from the store.
+
+        Images that are missing from the store or changed since it was built are encoded from disk instead.
+
+        Parameters:
+        image_path (str): The path to the image file.
+
+        Returns:
+        str: The image as a base64 data URL.
+        """
+        entry = self._entry(image_path)
+        if entry is None:
+            print(f"Image {image_path} is not in the payload store or has changed; encoding from disk")
+            return helpers.image_data_url(image_path)
+        offset, length = self.payloads[entry['hash']]
+        return self.blob[offset:offset + length].decode('ascii')
+
+    def close(self):
+        if self.payloads:
+            self.blob.close()
+        self._file.close()
+
+
+if __name__ == "__main__":
+    build_payload_store("FSC147_384_V2/selected_300_images", "results/payload_store")
@@ -6,10 +6,10 @@ Project: Improving Multi-modal Language Model on Object Counting with Self-Gener
 
 import random
 import os
-import shutil
 import csv
-import json
 import pandas as pd
+import fsc147_annotations
+import dataset_manifest
 
 source_folder = 'FSC147_384_V2/images_384_VarV2'
 destination_folder = 'FSC147_384_V2/selected_300_images'
@@ -29,11 +29,8 @@ def select_random_300_images():
 
     selected_filenames = random.sample(valid_images, 300)
 
-    if not os.path.exists(destination_folder):
-        os.makedirs(destination_folder)
-
-    for filename in selected_filenames:
-        shutil.copy(os.path.join(source_folder, filename), os.path.join(destination_folder, filename))
+    # Hardlinks/reflinks instead of copies, and only the files that differ are touched.
+    dataset_manifest.materialize_subset(selected_filenames, source_folder, destination_folder)
 
     return selected_filenames
 
@@ -55,10 +52,10 @@ def create_class_file_for_selected_images(selected_filenames):
 
 def update_csv_with_object_counts(selected_filenames):
 
-    with open(annotation_json_path, 'r') as file:
-        annotations = json.load(file)
-    
-    image_object_counts = {filename: len(annotations[filename]['points']) if filename in annotations else 0 for filename in selected_filenames}
+    # Stream the annotations instead of loading the whole JSON; only the point counts are kept.
+    summary = fsc147_annotations.extract_annotations(annotation_json_path, filenames=selected_filenames)
+    counts = dict(zip(summary['filename'], summary['object_count']))
+    image_object_counts = {filename: counts.get(filename, 0) for filename in selected_filenames}
 
     with open(destination_csv_path, newline='') as infile:
         reader = csv.reader(infile)
@@ -79,23 +76,14 @@ def cleaning():
 
     df = pd.read_csv(destination_csv_path)
 
-    filenames_in_csv = set(df['filename'].tolist())
-
-    # Directory containing the images
-    image_directory = destination_folder
-
-    # Iterate over files in the image directory
-    for filename in os.listdir(image_directory):
-        if filename not in filenames_in_csv:
-            file_path = os.path.join(image_directory, filename)
-            if os.path.isfile(file_path):
-                print(f"Removing {file_path}")  # For logging purposes
-                os.remove(file_path)  # Remove the file
+    # Sync the image directory with the CSV: strays are removed, missing images linked from the source folder.
+    dataset_manifest.materialize_subset(df['filename'], source_folder, destination_folder)
 
-    print("Cleaning up complete.")   
+    print("Cleaning up complete.")
 
 if __name__ == "__main__":
     # selected_filenames = select_random_300_images()
     # create_class_file_for_selected_images(selected_filenames)
     # update_csv_with_object_counts(selected_filenames)
-    cleaning()
\ No newline at end of file
+    cleaning()
+    # fsc147_annotations.extract_annotations(annotation_json_path).to_csv('FSC147_384_V2/annotation_summary.csv', index=False)
\ No newline at end of file
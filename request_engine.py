@@ -0,0 +1,266 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+"""
+
+import asyncio
+import time
+import httpx
+import numpy as np
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import helpers
+import instrumentation
+import response_parser
+
+# Rough per-request token estimates used for the tokens/min limiter.
+IMAGE_TOKEN_ESTIMATE = 765
+LOW_DETAIL_IMAGE_TOKENS = 85
+COMPLETION_TOKEN_ESTIMATE = 300
+
+
+class TokenBucket:
+    """
+    Token bucket limiter that refills continuously at a per-minute rate.
+
+    Parameters:
+    rate_per_minute (float): The number of tokens added to the bucket per minute; also the bucket capacity.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        """
+        Waits until `amount` tokens are available and takes them from the bucket.
+
+        Parameters:
+        amount (float): The number of tokens to take.
+        """
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+def estimate_tokens(request):
+    """
+    Estimates the tokens a request counts against the tokens/min limit.
+
+    Parameters:
+    request (dict): A request with a 'prompt' and optional 'image_path' (text-only without), 'params' and 'detail'.
+
+    Returns:
+    int: The estimated prompt plus completion tokens.
+    """
+    params = request.get('params', {})
+    completion = params.get('max_tokens', COMPLETION_TOKEN_ESTIMATE) * params.get('n', 1)
+    if not request.get('image_path'):
+        image = 0
+    elif request.get('detail') == 'low':
+        image = LOW_DETAIL_IMAGE_TOKENS
+    else:
+        image = IMAGE_TOKEN_ESTIMATE
+    return len(request['prompt']) // 4 + image + completion
+
+
+def make_client(concurrency, max_retries=2):
+    """
+    Creates one async client whose connection pool is sized to the concurrency limit.
+
+    Parameters:
+    concurrency (int): The maximum number of requests in flight.
+    max_retries (int): Retries (with backoff) on 429 and transient errors.
+
+    Returns:
+    AsyncOpenAI: The shared client.
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return AsyncOpenAI(max_retries=max_retries, http_client=DefaultAsyncHttpxClient(limits=limits))
+
+
+def throughput_report(latencies, wall_time):
+    """
+    Summarizes the throughput of a run.
+
+    Parameters:
+    latencies (list): Per-request latencies in seconds.
+    wall_time (float): Wall-clock duration of the run in seconds.
+
+    Returns:
+    dict: Request count, wall time, requests/s and p50/p95 latency.
+    """
+    n = len(latencies)
+    p50, p95 = np.percentile(latencies, [50, 95]) if n else (float('nan'), float('nan'))
+    return {
+        'requests': n,
+        'wall_time_s': wall_time,
+        'requests_per_s': n / wall_time if wall_time > 0 else float('nan'),
+        'p50_latency_s': float(p50),
+        'p95_latency_s': float(p95),
+    }
+
+
+def print_throughput_report(report):
+    if report['requests'] == 0:
+        print("Requests: 0 sent")
+        return
+    print(f"Requests: {report['requests']} in {report['wall_time_s']:.1f}s "
+          f"({report['requests_per_s']:.2f} req/s), "
+          f"p50 latency {report['p50_latency_s']:.2f}s, p95 latency {report['p95_latency_s']:.2f}s")
+
+
+async def _send(client, request, payload_fn):
+    """
+    Sends one request.
+
+    Returns:
+    tuple: (response text, usage or None, number of attempts).
+    """
+    image_url = payload_fn(request['image_path']) if request.get('image_path') else None
+    messages = helpers.build_messages(request['prompt'], image_url, request.get('detail'))
+    raw = await client.chat.completions.with_raw_response.create(
+        model=request.get('model', helpers.MODEL),
+        messages=messages,
+        stream=bool(request.get('stream')),
+        **request.get('params', {}),
+    )
+    if request.get('stream'):
+        return await _read_stream(raw.parse()), None, raw.retries_taken + 1
+    response = raw.parse()
+    # With n > 1 every choice is kept, see response_parser.join_samples.
+    content = response_parser.join_samples([choice.message.content.strip() for choice in response.choices])
+    return content, response.usage, raw.retries_taken + 1
+
+
+async def _read_stream(stream):
+    """
+    Reads a streamed count response and closes the stream as soon as a complete count has arrived.
+    """
+    content = ""
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                content += chunk.choices[0].delta.content
+                if response_parser.complete_count(content) is not None:
+                    break
+    finally:
+        await stream.close()
+    return content.strip()
+
+
+async def run_requests_async(requests, concurrency=16, requests_per_minute=500, tokens_per_minute=200000,
+                             client=None, on_result=None, payload_fn=helpers.image_data_url, max_retries=2,
+                             cache=None, call_log=None):
+    """
+    Sends chat requests concurrently under a concurrency limit and requests/min and tokens/min limits. A fixed
+    pool of `concurrency` workers pulls the requests one at a time, so memory does not grow with the number of
+    requests beyond their results.
+
+    Parameters:
+    requests (iterable): Dicts with 'key', 'prompt', 'image_path' (None for a text-only request) and optional 'model', 'params', 'detail' and
+        'stream' (stream a count response and stop reading once the count is complete).
+    concurrency (int): The maximum number of requests in flight.
+    requests_per_minute (float): The requests/min limit.
+    tokens_per_minute (float): The tokens/min limit.
+    client (AsyncOpenAI): Optional; a client to reuse. A pooled client is created if None.
+    on_result (callable): Optional; called as on_result(key, content) as each request finishes.
+    payload_fn (callable): Maps an image path to the image URL sent with the prompt.
+    max_retries (int): Retries per request when the client is created here.
+    cache (ResponseCache): Optional; responses are served from and stored in this cache. In offline
+        mode no client is created and misses return None.
+    call_log (CallLog): Optional; every call sent to the model is recorded in this instrumentation log.
+
+    Returns:
+    tuple: (dict mapping each key to the response text or None, throughput report dict).
+    """
+    offline = cache is not None and cache.offline
+    owns_client = client is None and not offline
+    if owns_client:
+        client = make_client(concurrency, max_retries)
+    request_bucket = TokenBucket(requests_per_minute)
+    token_bucket = TokenBucket(tokens_per_minute)
+    results = {}
+    latencies = []
+
+    def finish(request, content):
+        results[request['key']] = content
+        if on_result is not None:
+            on_result(request['key'], content)
+
+    async def handle(request):
+        if cache is not None:
+            content = cache.get(request)
+            if content is not None or offline:
+                finish(request, content)
+                return
+        await request_bucket.acquire(1)
+        await token_bucket.acquire(estimate_tokens(request))
+        start = time.perf_counter()
+        try:
+            content, usage, attempts = await _send(client, request, payload_fn)
+            error = None
+        except Exception as e:
+            print(f"Error processing {request.get('image_path') or request['key']}: {e}")
+            content, usage, error = None, None, e
+            attempts = instrumentation.attempts_for_error(e, client.max_retries)
+        latencies.append(time.perf_counter() - start)
+        if call_log is not None:
+            call_log.record(request, latencies[-1], usage, attempts, error)
+        if cache is not None:
+            cache.put(request, content)
+        finish(request, content)
+
+    # The workers share one iterator; next() never awaits, so each request is taken by exactly one worker.
+    queued = iter(requests)
+
+    async def worker():
+        for request in queued:
+            await handle(request)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        if owns_client:
+            await client.close()
+    return results, throughput_report(latencies, time.perf_counter() - start)
+
+
+def run_requests(requests, **kwargs):
+    """
+    Synchronous wrapper around run_requests_async; prints the throughput report. It starts its own event loop,
+    so it cannot be called from a running one (e.g. a Jupyter notebook); await run_requests_async there.
+
+    Parameters:
+    requests (iterable): See run_requests_async.
+    **kwargs: Passed to run_requests_async.
+
+    Returns:
+    dict: Mapping of each request key to the response text or None.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError("run_requests was called from a running event loop (e.g. a Jupyter notebook). Await "
+                           "request_engine.run_requests_async(requests, ...) instead, or run the whole call in a "
+                           "thread, e.g. `await asyncio.to_thread(gpt4_evaluation.run_pipeline, ...)`")
+    results, report = asyncio.run(run_requests_async(requests, **kwargs))
+    print_throughput_report(report)
+    if kwargs.get('cache') is not None:
+        print(f"Cache: {kwargs['cache'].stats()}")
+    if kwargs.get('call_log') is not None:
+        kwargs['call_log'].flush()
+    return results
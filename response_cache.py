@@ -0,0 +1,180 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import helpers
+
+
+def file_hash(path):
+    """
+    Computes the SHA-256 hex digest of a file's contents.
+
+    Parameters:
+    path (str): The path to the file.
+
+    Returns:
+    str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk SQLite cache of model responses keyed on model, prompt, image content, sampling parameters and
+    whether the response was streamed (streamed counts stop early).
+
+    Parameters:
+    path (str): The path to the SQLite database file.
+    offline (bool): If True, the cache is used in cache-only replay mode and misses are never sent to the model.
+    """
+
+    def __init__(self, path, offline=False):
+        self.path = path
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._image_hashes = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+
+    def image_hash(self, image_path):
+        """
+        Returns the content hash of an image, memoized on path, size and modification time.
+        """
+        stat = os.stat(image_path)
+        memo_key = (image_path, stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._image_hashes:
+            self._image_hashes[memo_key] = file_hash(image_path)
+        return self._image_hashes[memo_key]
+
+    def key_for(self, request):
+        """
+        Builds the cache key of a request.
+
+        Parameters:
+        request (dict): A request with 'prompt', optional 'image_path', 'model', 'params', 'detail' and 'stream'.
+
+        Returns:
+        str: The hex digest identifying the request.
+        """
+        parts = {
+            'model': request.get('model', helpers.MODEL),
+            'prompt': hashlib.sha256(request['prompt'].encode('utf-8')).hexdigest(),
+            'image': self.image_hash(request['image_path']) if request.get('image_path') else None,
+            'params': request.get('params', {}),
+        }
+        if request.get('detail') is not None:
+            parts['detail'] = request['detail']
+        # A streamed count is cut off once the count is complete, so it is never served for a full response.
+        if request.get('stream'):
+            parts['stream'] = True
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, request):
+        """
+        Looks up the cached response of a request, updating the hit/miss statistics.
+
+        Returns:
+        str or None: The cached response text, or None on a miss.
+        """
+        key = self.key_for(request)
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, request, response):
+        """
+        Stores the response of a request. None responses (failed calls) and empty responses (e.g. a stream
+        that ended before any content) are not cached.
+        """
+        if response is None or not response.strip():
+            return
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.key_for(request), request.get('model', helpers.MODEL), response,
+             len(response.encode('utf-8')), now, now))
+        self.conn.commit()
+
+    def evict(self, max_bytes=None, max_age_days=None):
+        """
+        Evicts entries older than max_age_days, then least recently used entries until the cache is under max_bytes.
+
+        Parameters:
+        max_bytes (int): Optional; the maximum total size of the cached responses.
+        max_age_days (float): Optional; the maximum age of an entry since it was created.
+
+        Returns:
+        int: The number of evicted entries.
+        """
+        evicted = 0
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 86400
+            evicted += self.conn.execute("DELETE FROM responses WHERE created < ?", (cutoff,)).rowcount
+        if max_bytes is not None:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > max_bytes:
+                stale = []
+                for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+                    if total <= max_bytes:
+                        break
+                    stale.append((key,))
+                    total -= size
+                self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+                evicted += len(stale)
+        self.conn.commit()
+        return evicted
+
+    def stats(self):
+        """
+        Returns the hit/miss statistics of this session and the size of the cache.
+
+        Returns:
+        dict: Hits, misses, hit rate, number of entries and total response bytes.
+        """
+        entries, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': total,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    cache = ResponseCache("results/response_cache.sqlite")
+    print(cache.stats())
+    # print(f"Evicted {cache.evict(max_bytes=50_000_000, max_age_days=90)} entries")
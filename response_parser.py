@@ -0,0 +1,443 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Parsing of model responses: splitting side information into its description / direct hint / indirect hint
+sections, and reading counts from count responses.
+"""
+
+import json
+import math
+import random
+import re
+import time
+from collections import Counter
+from functools import lru_cache
+import pandas as pd
+
+SECTIONS = ['description', 'direct_hint', 'indirect_hint']
+# Appended to the heading variant of a section whose heading appears more than once.
+REPEATED_SUFFIX = ' (repeated)'
+
+# A section heading at the start of a line, in any of the markdown variants the model produces, e.g.
+# "1. **Description:**", "### 2. Direct Hint:", "**3. Indirect hint**", "Description -".
+# The pattern starts with a literal newline (the text is prefixed with one), which lets the regex engine
+# jump between line starts instead of trying a MULTILINE ^ at every position. re.split returns
+# [preamble, heading, name, body, heading, name, body, ...].
+HEADING = re.compile(r"""
+    \n
+    (?P<heading>
+    [ \t]*
+    (?:\#{1,6}[ \t]*)?
+    (?:\*\*[ \t]*)?
+    (?:[1-3][.)][ \t]*)?
+    (?:\*\*[ \t]*)?
+    (?P<name>description|direct[ \t]+hints?|indirect[ \t]+hints?)
+    (?:[ \t]*(?:\*\*)?[ \t]*[:\-–][ \t]*(?:\*\*)?|[ \t]*\*\*(?:[ \t]*:)?|[ \t]*(?=\n|$))
+    )
+    """, re.IGNORECASE | re.VERBOSE)
+
+
+@lru_cache(maxsize=None)
+def _section_name(name):
+    name = name.lower()
+    if name.startswith('description'):
+        return 'description'
+    return 'indirect_hint' if name.startswith('indirect') else 'direct_hint'
+
+
+@lru_cache(maxsize=4096)
+def _heading_variant(heading):
+    """
+    Normalizes a matched heading to its markdown variant, e.g. '1. **Direct Hint**:' -> 'N. **<name>**:'.
+    """
+    variant = re.sub(r'(?i)description|indirect[ \t]+hints?|direct[ \t]+hints?', '<name>', heading.strip())
+    return re.sub(r'\d', 'N', variant)
+
+
+def parse_side_information(full_response):
+    """
+    Splits a side information response into its three sections in a single scan.
+
+    Parameters:
+    full_response (str): The model response.
+
+    Returns:
+    tuple: (description, direct_hint, indirect_hint, variants) where each section is a string or None if
+    it was not found, and variants maps each found section to its heading variant. A section whose heading
+    appears more than once gets the bodies of all its headings, joined by a blank line, and the variant of its
+    first heading with REPEATED_SUFFIX, so repeats show up in the variant statistics.
+    """
+    if not isinstance(full_response, str):
+        return None, None, None, {}
+    if full_response.lstrip().startswith('{'):
+        return parse_structured_side_information(full_response)
+    parts = HEADING.split("\n" + full_response)
+    found = {}
+    variants = {}
+    for i in range(1, len(parts), 3):
+        section = _section_name(parts[i + 1])
+        body = parts[i + 2].strip()
+        if section in found:
+            found[section] = "\n\n".join(filter(None, [found[section], body]))
+            if not variants[section].endswith(REPEATED_SUFFIX):
+                variants[section] += REPEATED_SUFFIX
+            continue
+        found[section] = body
+        variants[section] = _heading_variant(parts[i])
+    return found.get('description'), found.get('direct_hint'), found.get('indirect_hint'), variants
+
+
+def parse_structured_side_information(full_response):
+    """
+    Reads the three sections from a JSON structured side information response.
+
+    Parameters:
+    full_response (str): The JSON response.
+
+    Returns:
+    tuple: Same as parse_side_information; sections are None if the JSON is invalid (e.g. cut off by
+    max_tokens) or the field is missing or empty.
+    """
+    try:
+        fields = json.loads(full_response)
+    except json.JSONDecodeError:
+        return None, None, None, {}
+    if not isinstance(fields, dict):
+        return None, None, None, {}
+    found = {section: fields[section].strip() for section in SECTIONS
+             if isinstance(fields.get(section), str) and fields[section].strip()}
+    return (found.get('description'), found.get('direct_hint'), found.get('indirect_hint'),
+            {section: 'json' for section in found})
+
+
+def split_sections(responses):
+    """
+    Parses a column of side information responses into description, direct hint and indirect hint columns
+    in one pass.
+
+    Parameters:
+    responses (Series): The full responses.
+
+    Returns:
+    tuple: (DataFrame with the three section columns, Counter of (section, heading variant) matches).
+    """
+    parsed = [parse_side_information(response) for response in responses]
+    sections = pd.DataFrame([p[:3] for p in parsed], columns=SECTIONS, index=responses.index)
+    statistics = Counter((section, variant) for p in parsed for section, variant in p[3].items())
+    return sections, statistics
+
+
+def print_variant_statistics(statistics):
+    for (section, variant), count in sorted(statistics.items(), key=lambda item: (item[0][0], -item[1])):
+        print(f"{section:>14}  {count:>7}  {variant}")
+
+
+def extract_section(full_response, section):
+    # Check if the response exists and is not NaN
+    if pd.isna(full_response):
+        return None
+
+    # Define possible start and stop strings for each section
+    if section == "description":
+        starts = ["1. **Description:**", "### 1. Description:", "1. **Description**:",
+                  "### 1. Description:", "1. **Description:**", "1. **Description**:"]
+        stops = ["2. **Direct hint:**", "### 2. Direct Hint:", "2. **Direct hint**:",
+                 "### 2. Direct hint:", "2. **Direct Hint:**", "2. **Direct Hint**:"]
+    elif section == "direct_hint":
+        starts = ["2. **Direct hint:**", "### 2. Direct Hint:", "2. **Direct hint**:",
+                  "### 2. Direct hint:", "2. **Direct Hint:**", "2. **Direct Hint**:"]
+        stops = ["3. **Indirect hint:**", "### 3. Indirect Hint:", "3. **Indirect hint**:",
+                 "### 3. Indirect hint:", "3. **Indirect Hint:**", "3. **Indirect Hint**:"]
+    elif section == "indirect_hint":
+        starts = ["3. **Indirect hint:**", "### 3. Indirect Hint:", "3. **Indirect hint**:",
+                  "### 3. Indirect hint:", "3. **Indirect Hint:**", "3. **Indirect Hint**:"]
+        stops = [None]  # Last section has no stop
+
+    # Find the start and stop indices of the sections
+    start_idx = -1
+    stop_idx = len(full_response)
+    for start in starts:
+        index = full_response.find(start)
+        if index != -1:
+            start_idx = index + len(start)
+            break
+
+    if start_idx == -1:  # No start found
+        return None
+
+    for stop in stops:
+        if stop is not None:
+            index = full_response.find(stop, start_idx)
+            if index != -1:
+                stop_idx = index
+                break
+
+    # Extract and return the section, if the start is found
+    return full_response[start_idx:stop_idx].strip()
+
+
+UNITS = {word: value for value, word in enumerate(
+    "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen "
+    "seventeen eighteen nineteen".split())}
+TENS = {word: 10 * (value + 2) for value, word in enumerate(
+    "twenty thirty forty fifty sixty seventy eighty ninety".split())}
+SCALES = {'hundred': 100, 'thousand': 1000}
+RANGE_CONNECTORS = {'-', '–', 'to', 'or'}
+
+# Digits (with optional thousands separators and decimals), words, and single punctuation characters.
+COUNT_TOKEN = re.compile(r"\d+(?:,\d{3})*(?:\.\d+)?|[a-z]+|\S")
+
+
+def _parse_number(tokens, i):
+    """
+    Parses the number starting at tokens[i], either digits or a run of number words
+    (e.g. 'one hundred and twenty-three').
+
+    Returns:
+    tuple: (value, index of the first token after the number), or (None, i) if tokens[i] is not a number.
+    """
+    token = tokens[i].group()
+    if token[0].isdigit():
+        return float(token.replace(',', '')), i + 1
+    # The words each kind of token may be followed by, e.g. 'twenty' by 'three', '-' or 'hundred'.
+    follows = {None: ('units', 'tens'), 'units': ('hundred', 'thousand'),
+               'tens': ('digit', '-', 'hundred', 'thousand'), '-': ('digit',),
+               'hundred': ('and', 'units', 'tens', 'thousand'), 'thousand': ('and', 'units', 'tens'),
+               'and': ('units', 'tens')}
+    total, current, last, j = 0, 0, None, i
+    end = i
+    while j < len(tokens):
+        word = tokens[j].group()
+        if word in UNITS:
+            kind = 'digit' if 'digit' in follows[last] and 0 < UNITS[word] < 10 else 'units'
+        elif word in TENS:
+            kind = 'tens'
+        elif word in ('hundred', 'thousand', 'and', '-'):
+            kind = word
+        else:
+            break
+        if kind not in follows[last]:
+            break
+        if kind in ('units', 'digit'):
+            current += UNITS[word]
+        elif kind == 'tens':
+            current += TENS[word]
+        elif kind == 'hundred':
+            current *= 100
+        elif kind == 'thousand':
+            total, current = total + current * 1000, 0
+        last = kind
+        j += 1
+        if kind not in ('and', '-'):
+            end = j
+    if end == i:
+        return None, i
+    return float(total + current), end
+
+
+def _parse_count(text):
+    """
+    Finds the first count in text: a number, or a range whose midpoint is used.
+
+    Returns:
+    tuple: (count or None, index of the token after the count, the tokens).
+    """
+    tokens = list(COUNT_TOKEN.finditer(text.lower()))
+    for i in range(len(tokens)):
+        value, j = _parse_number(tokens, i)
+        if value is None:
+            continue
+        connectors = RANGE_CONNECTORS | ({'and'} if i > 0 and tokens[i - 1].group() == 'between' else set())
+        if j + 1 < len(tokens) and tokens[j].group() in connectors:
+            high, k = _parse_number(tokens, j + 1)
+            if high is not None:
+                value, j = (value + high) / 2, k
+        return math.floor(value + 0.5), j, tokens
+    return None, len(tokens), tokens
+
+
+def extract_count(response):
+    """
+    Reads an object count from a count response, e.g. '18', '18.', 'There are 20 apples', 'twenty-three',
+    'about 1,200', or a range such as '20-25' or 'between 20 and 25' (read as its rounded midpoint).
+
+    Parameters:
+    response (str): The model response.
+
+    Returns:
+    int or None: The count, or None if the response contains no number.
+    """
+    if not isinstance(response, str):
+        if isinstance(response, (int, float)) and not pd.isna(response):
+            return math.floor(response + 0.5)
+        return None
+    return _parse_count(response)[0]
+
+
+def complete_count(partial_response):
+    """
+    Returns the count of a response that is still being streamed, once the count can no longer change.
+
+    The count is complete when the first number (or range) is followed by a token that cannot continue it,
+    and that token is itself followed by more text, so a half-received word or digit group (e.g. 'seven'
+    of 'seventeen', '1,2' of '1,200' or '18.' of '18.5') is never taken as final.
+
+    Parameters:
+    partial_response (str): The text received so far.
+
+    Returns:
+    int or None: The count, or None if more text is needed.
+    """
+    count, j, tokens = _parse_count(partial_response)
+    if count is None or j >= len(tokens) or tokens[j].end() >= len(partial_response):
+        return None
+    following = tokens[j].group()
+    if following in RANGE_CONNECTORS or following in ('and', ',', '.'):
+        # Possibly '20 to 2|5', 'one hundred and fi|ve' or '1,2|00'; wait until the next token is complete.
+        if j + 1 >= len(tokens) or tokens[j + 1].end() >= len(partial_response):
+            return None
+    return count
+
+
+# Aggregates of the counts of several samples (choices) of one request.
+SAMPLE_AGGREGATES = ['median', 'mode', 'trimmed_mean']
+# The fraction of samples dropped at each end by the trimmed mean.
+TRIM_FRACTION = 0.2
+# Suffix of the column holding the spread of a count column's samples, e.g. gpt_4_initial_answer_spread.
+SPREAD_SUFFIX = '_spread'
+
+
+def join_samples(texts):
+    """
+    Stores the choices of one response as one text: a single choice as it is, several as a JSON list of strings,
+    so the cache, the journal and the Batch API paths keep handling plain strings.
+    """
+    return texts[0] if len(texts) == 1 else json.dumps(texts)
+
+
+def split_samples(response):
+    """
+    Returns the choices stored by join_samples, e.g. '["18", "20", "19"]' -> ['18', '20', '19'] and '18' -> ['18'].
+    """
+    if isinstance(response, str) and response.startswith('["'):
+        try:
+            texts = json.loads(response)
+        except ValueError:
+            return [response]
+        if isinstance(texts, list) and all(isinstance(text, str) for text in texts):
+            return texts
+    return [response]
+
+
+def sample_counts(response):
+    """
+    Returns the counts read from every sample of a response, skipping samples without a number.
+    """
+    counts = (extract_count(text) for text in split_samples(response))
+    return [count for count in counts if count is not None]
+
+
+def aggregate_counts(counts, method='median', trim=TRIM_FRACTION):
+    """
+    Combines the counts of several samples into one.
+
+    Parameters:
+    counts (list): The sample counts.
+    method (str): 'median', 'mode' (most frequent count; ties go to the median of the tied counts) or
+        'trimmed_mean' (mean after dropping the trim fraction of samples at each end).
+    trim (float): The fraction trimmed at each end for 'trimmed_mean'.
+
+    Returns:
+    int or None: The rounded aggregate, or None if there are no counts.
+    """
+    if not counts:
+        return None
+    ordered = sorted(counts)
+    if method == 'median':
+        middle = len(ordered) // 2
+        value = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+    elif method == 'mode':
+        frequencies = Counter(ordered)
+        top = max(frequencies.values())
+        return aggregate_counts([count for count in frequencies if frequencies[count] == top], 'median')
+    elif method == 'trimmed_mean':
+        cut = int(len(ordered) * trim)
+        kept = ordered[cut:len(ordered) - cut] or ordered
+        value = sum(kept) / len(kept)
+    else:
+        raise ValueError(f"Unknown aggregate {method!r}; expected one of {SAMPLE_AGGREGATES}")
+    return math.floor(value + 0.5)
+
+
+def count_spread(response):
+    """
+    Returns the disagreement between the samples of a response: the interquartile range of their counts divided
+    by their median (at least 1), so 0 means all samples agree and 0.2 means the middle half spans 20% of the
+    count. None for responses with fewer than two counted samples.
+    """
+    counts = sorted(sample_counts(response))
+    if len(counts) < 2:
+        return None
+
+    def quantile(q):
+        position = q * (len(counts) - 1)
+        low = math.floor(position)
+        high = min(low + 1, len(counts) - 1)
+        return counts[low] + (counts[high] - counts[low]) * (position - low)
+
+    return (quantile(0.75) - quantile(0.25)) / max(quantile(0.5), 1)
+
+
+# Heading templates for synthetic responses: the ones extract_section knows, and other variants seen from the model.
+LEGACY_TEMPLATES = ["{n}. **{name}:**", "{n}. **{name}**:", "### {n}. {name}:"]
+OTHER_TEMPLATES = ["**{n}. {name}**", "**{n}. {name}:**", "{n}. {name}:", "## {name}\n", "**{name}:**"]
+
+
+def synthetic_responses(n, templates=LEGACY_TEMPLATES + OTHER_TEMPLATES, seed=0):
+    """
+    Generates n synthetic side information responses using a mix of heading variants.
+    """
+    names = [["Description", "description", "DESCRIPTION"], ["Direct hint", "Direct Hint", "direct hint"],
+             ["Indirect hint", "Indirect Hint", "indirect hints"]]
+    if templates == LEGACY_TEMPLATES:
+        names = [["Description"], ["Direct hint", "Direct Hint"], ["Indirect hint", "Indirect Hint"]]
+    filler = ("The image shows a number of objects arranged across the frame, some partially occluded. "
+              "Scan the image in a grid, left to right and top to bottom, marking each object once. ")
+    rng = random.Random(seed)
+    responses = []
+    for _ in range(n):
+        template = rng.choice(templates)
+        parts = [template.format(n=i + 1, name=rng.choice(names[i])) + " " + filler * rng.randint(1, 3)
+                 for i in range(3)]
+        responses.append("\n\n".join(parts))
+    return pd.Series(responses)
+
+
+def benchmark(n=100000, templates=LEGACY_TEMPLATES + OTHER_TEMPLATES):
+    """
+    Compares split_sections with three extract_section apply passes on n synthetic responses.
+
+    Returns:
+    dict: Run time and number of NAs of both implementations.
+    """
+    responses = synthetic_responses(n, templates)
+
+    start = time.perf_counter()
+    legacy = pd.DataFrame({section: responses.apply(lambda x: extract_section(x, section)) for section in SECTIONS})
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sections, statistics = split_sections(responses)
+    compiled_time = time.perf_counter() - start
+
+    result = {'responses': n, 'legacy_s': legacy_time, 'compiled_s': compiled_time,
+              'legacy_na': int(legacy.isna().sum().sum()), 'compiled_na': int(sections.isna().sum().sum())}
+    print(result)
+    print_variant_statistics(statistics)
+    return result
+
+
+if __name__ == "__main__":
+    # Only the headings extract_section knows, then the full mix of variants.
+    benchmark(templates=LEGACY_TEMPLATES)
+    benchmark()
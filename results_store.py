@@ -0,0 +1,257 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Long-format columnar results store. Numeric answers (one row per image, method and run) and response texts
+are kept in separate Parquet datasets partitioned by run ID, so analyses read only the columns and runs
+they need, memory-mapped, and never parse the text blobs. export_wide_csv rebuilds the wide evaluation CSV.
+
+Requires pyarrow (pip install pyarrow).
+"""
+
+import os
+import time
+import uuid
+import pandas as pd
+import instrumentation
+import response_parser
+import run_journal
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Columns of the wide evaluation CSV holding response texts; every other non-label column is a numeric answer.
+TEXT_COLUMNS = ['full_response', 'description', 'direct_hint', 'indirect_hint']
+LABEL_COLUMNS = ['filename', 'class', 'object_count']
+
+ANSWER_SCHEMA = None if pa is None else pa.schema([
+    ('filename', pa.string()),
+    ('method', pa.string()),
+    ('answer', pa.float64()),
+    ('latency_s', pa.float64()),
+    ('prompt_tokens', pa.int64()),
+    ('completion_tokens', pa.int64()),
+])
+TEXT_SCHEMA = None if pa is None else pa.schema([
+    ('filename', pa.string()),
+    ('field', pa.string()),
+    ('text', pa.string()),
+])
+
+
+def new_run_id():
+    """
+    Returns a run ID that sorts by creation time, e.g. '20261017-142501'.
+    """
+    return time.strftime('%Y%m%d-%H%M%S')
+
+
+def is_answer_column(column):
+    # Includes the _spread columns of self-consistency runs, which are stored as methods of their own.
+    return column.startswith('gpt_4_initial_answer') or column == 'human' or column.startswith('response_')
+
+
+class ResultsStore:
+    """
+    Results store rooted at a directory with answers/, texts/ (both partitioned by run_id) and labels.parquet.
+
+    Parameters:
+    path (str): The root directory of the store.
+    """
+
+    def __init__(self, path):
+        if pa is None:
+            raise ImportError("results_store requires pyarrow: pip install pyarrow")
+        self.path = path
+        self.answers_path = os.path.join(path, "answers")
+        self.texts_path = os.path.join(path, "texts")
+        self.labels_path = os.path.join(path, "labels.parquet")
+        os.makedirs(path, exist_ok=True)
+
+    def _append(self, path, frame, schema, run_id):
+        table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+        table = table.append_column('run_id', pa.array([run_id] * len(table), pa.string()))
+        # A unique file name per write, so appends to the same run never overwrite each other.
+        pq.write_to_dataset(table, path, partition_cols=['run_id'],
+                            basename_template=f"part-{uuid.uuid4().hex[:12]}-{{i}}.parquet")
+
+    def write_labels(self, labels):
+        """
+        Writes the label table (filename, class, object_count), replacing any previous one.
+        """
+        pq.write_table(pa.Table.from_pandas(labels[LABEL_COLUMNS], preserve_index=False), self.labels_path)
+
+    def write_answers(self, answers, run_id):
+        """
+        Appends numeric answers to a run.
+
+        Parameters:
+        answers (DataFrame): Long-format rows with 'filename', 'method', 'answer' and optional 'latency_s',
+            'prompt_tokens' and 'completion_tokens'.
+        run_id (str): The run the answers belong to.
+        """
+        answers = answers.reindex(columns=ANSWER_SCHEMA.names)
+        answers['answer'] = pd.to_numeric(answers['answer'], errors='coerce')
+        self._append(self.answers_path, answers, ANSWER_SCHEMA, run_id)
+
+    def write_texts(self, texts, run_id):
+        """
+        Appends response texts to a run.
+
+        Parameters:
+        texts (DataFrame): Long-format rows with 'filename', 'field' (e.g. 'full_response') and 'text'.
+        run_id (str): The run the texts belong to.
+        """
+        self._append(self.texts_path, texts.reindex(columns=TEXT_SCHEMA.names), TEXT_SCHEMA, run_id)
+
+    def runs(self):
+        """
+        Returns the run IDs in the store, oldest first.
+        """
+        if not os.path.isdir(self.answers_path):
+            return []
+        return sorted(name.split('=', 1)[1] for name in os.listdir(self.answers_path) if name.startswith('run_id='))
+
+    def _read(self, path, columns, filters, run_id):
+        if run_id is None:
+            runs = self.runs()
+            if not runs:
+                raise FileNotFoundError(f"No runs in results store {self.path}")
+            run_id = runs[-1]
+        filters = [('run_id', '=', run_id)] + (filters or [])
+        table = pq.read_table(path, columns=columns, filters=filters, memory_map=True, partitioning='hive')
+        return table.to_pandas()
+
+    def answers(self, columns=None, methods=None, run_id=None):
+        """
+        Reads answers with column projection, e.g. columns=['filename', 'method', 'answer'].
+
+        Parameters:
+        columns (list): Optional; the columns to read. Defaults to all.
+        methods (list): Optional; only read these methods.
+        run_id (str): Optional; the run to read. Defaults to the latest run.
+
+        Returns:
+        DataFrame: The long-format answers.
+        """
+        filters = [('method', 'in', list(methods))] if methods is not None else None
+        return self._read(self.answers_path, columns, filters, run_id)
+
+    def texts(self, fields=None, run_id=None):
+        """
+        Reads response texts, optionally only some fields (e.g. ['direct_hint']).
+        """
+        filters = [('field', 'in', list(fields))] if fields is not None else None
+        return self._read(self.texts_path, ['filename', 'field', 'text'], filters, run_id)
+
+    def labels(self, columns=None):
+        return pq.read_table(self.labels_path, columns=columns, memory_map=True).to_pandas()
+
+    def method_frame(self, methods=None, run_id=None):
+        """
+        Returns the correct counts and the answers of the given methods, one column per method, reading only
+        the filename, method and answer columns.
+
+        Parameters:
+        methods (list): Optional; the methods to load. Defaults to all methods of the run.
+        run_id (str): Optional; the run to read. Defaults to the latest run.
+
+        Returns:
+        DataFrame: filename, object_count and one answer column per method.
+        """
+        answers = self.answers(['filename', 'method', 'answer'], methods, run_id)
+        wide = answers.pivot_table(index='filename', columns='method', values='answer', aggfunc='last',
+                                   dropna=False)
+        if methods is not None:
+            wide = wide.reindex(columns=list(methods))
+        labels = self.labels(['filename', 'object_count'])
+        return labels.merge(wide.reset_index(), on='filename', how='left')
+
+    def to_wide(self, run_id=None):
+        """
+        Rebuilds the wide evaluation layout of a run: labels, the initial answer, the response texts and the
+        response columns, in the order of results/gpt4_evaluation.csv.
+        """
+        answers = self.answers(['filename', 'method', 'answer'], run_id=run_id)
+        methods = list(dict.fromkeys(answers['method']))
+        wide = self.labels()
+        numeric = answers.pivot_table(index='filename', columns='method', values='answer', aggfunc='last')
+        wide = wide.merge(numeric.reset_index(), on='filename', how='left')
+        try:
+            texts = self.texts(run_id=run_id)
+        except (FileNotFoundError, OSError):
+            texts = pd.DataFrame(columns=['filename', 'field', 'text'])
+        if len(texts):
+            text_wide = texts.pivot_table(index='filename', columns='field', values='text', aggfunc='last')
+            wide = wide.merge(text_wide.reset_index(), on='filename', how='left')
+        for method in methods:
+            if not method.endswith(response_parser.SPREAD_SUFFIX):
+                wide[method] = wide[method].astype('Int64')
+        ordered = LABEL_COLUMNS + [m for m in methods if not m.startswith('response_')] + TEXT_COLUMNS + \
+            [m for m in methods if m.startswith('response_')]
+        return wide[[c for c in ordered if c in wide.columns]]
+
+    def export_wide_csv(self, csv_path, run_id=None):
+        """
+        Writes a run in the wide evaluation CSV layout for existing consumers.
+        """
+        self.to_wide(run_id).to_csv(csv_path, index=False)
+
+
+def call_log_answers(call_log_path):
+    """
+    Reads the latency and tokens of the successful calls in a call log (see instrumentation.CallLog) per
+    filename and answer column; for a call made more than once, the last one.
+
+    Returns:
+    DataFrame: filename, method, latency_s, prompt_tokens and completion_tokens.
+    """
+    columns = ['filename', 'method', 'latency_s', 'prompt_tokens', 'completion_tokens']
+    calls = instrumentation.read_calls(call_log_path)
+    if calls.empty:
+        return pd.DataFrame(columns=columns)
+    calls = calls[calls['error'].isna() & calls['stage'].isin(list(run_journal.STAGE_COLUMNS))]
+    calls = calls.assign(filename=calls['image'],
+                         method=[run_journal.column_for(s, c) for s, c in zip(calls['stage'], calls['config'])])
+    return calls.drop_duplicates(['filename', 'method'], keep='last')[columns]
+
+
+def import_wide_csv(csv_path, store_path, run_id=None, call_log_path=None):
+    """
+    Imports a wide evaluation CSV (e.g. results/gpt4_evaluation.csv) into the store: labels, numeric answer
+    columns as long-format answers, and the text columns as texts.
+
+    Parameters:
+    csv_path (str): The wide CSV to import.
+    store_path (str): The root directory of the store.
+    run_id (str): Optional; the run ID to import into. Defaults to a new time-based ID.
+    call_log_path (str): Optional; the call log of the run, whose latency and tokens fill the latency_s,
+        prompt_tokens and completion_tokens of the answers.
+
+    Returns:
+    str: The run ID.
+    """
+    run_id = run_id or new_run_id()
+    df = pd.read_csv(csv_path)
+    store = ResultsStore(store_path)
+    store.write_labels(df)
+    answer_columns = [c for c in df.columns if is_answer_column(c)]
+    answers = df.melt(id_vars=['filename'], value_vars=answer_columns, var_name='method', value_name='answer')
+    if call_log_path is not None:
+        answers = answers.merge(call_log_answers(call_log_path), on=['filename', 'method'], how='left')
+    store.write_answers(answers, run_id)
+    text_columns = [c for c in TEXT_COLUMNS if c in df.columns]
+    if text_columns:
+        texts = df.melt(id_vars=['filename'], value_vars=text_columns, var_name='field', value_name='text')
+        store.write_texts(texts.dropna(subset=['text']), run_id)
+    print(f"Imported {len(answers)} answers for {len(answer_columns)} methods into run {run_id} of {store_path}")
+    return run_id
+
+
+if __name__ == "__main__":
+    store_path = "results/results_store"
+    run_id = import_wide_csv("results/gpt4_evaluation.csv", store_path)
+    # ResultsStore(store_path).export_wide_csv("results/gpt4_evaluation_export.csv", run_id)
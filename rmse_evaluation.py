@@ -6,6 +6,8 @@ Project: Improving Multi-modal Language Model on Object Counting with Self-Gener
 
 import pandas as pd
 import numpy as np
+import results_store
+import response_parser
 
 
 def calculate_rmse(df, correct_counts_column, method_column):
@@ -25,36 +27,155 @@ def calculate_rmse(df, correct_counts_column, method_column):
     return np.sqrt(((correct_counts - method_counts) ** 2).mean())
 
 
-def calculate_rmse_for_ranges(df, correct_counts_column, method_column=None):
+# Upper edges of the count bins: Count < 20, 20 <= Count < 100 and Count >= 100.
+COUNT_BINS = [20, 100]
+# Upper edges of the bins of sample spread (response_parser.count_spread) of self-consistency runs.
+SPREAD_BINS = [0.05, 0.2]
+
+# The GPT method names used in the report and their evaluation CSV columns.
+GPT_METHODS = {
+    'GPT initial': 'gpt_4_initial_answer',
+    'GPT all hints': 'response_desc_true_direct_true_indirect_true',
+    'GPT description': 'response_desc_true_direct_false_indirect_false',
+    'GPT direct': 'response_desc_false_direct_true_indirect_false',
+    'GPT indirect': 'response_desc_false_direct_false_indirect_true'
+}
+
+NA_LABEL = 'Number of NA (cannot count)'
+
+
+def bin_labels(bins=COUNT_BINS, name='Count'):
     """
-    Calculates RMSE for different object count ranges from the DataFrame.
+    Returns the labels of the count bins defined by the given edges, e.g. [20, 100] ->
+    ['Count < 20', '20 <= Count < 100', 'Count >= 100'].
+    """
+    labels = [f"{name} < {bins[0]}"]
+    labels += [f"{low} <= {name} < {high}" for low, high in zip(bins, bins[1:])]
+    labels.append(f"{name} >= {bins[-1]}")
+    return labels
+
+
+def _to_float_matrix(df):
+    try:
+        return df.to_numpy(dtype=float, na_value=np.nan)
+    except (TypeError, ValueError):
+        return df.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+
+def compute_metrics(df, correct_counts_column, method_columns, bins=COUNT_BINS, chunk_columns=128, bin_column=None,
+                    bin_name='Count'):
+    """
+    Calculates RMSE, MAE, MAPE, bias and NA counts for every method column and every count bin.
+
+    Rows are assigned to bins once, and the per-bin sums of all method columns are computed as matrix products
+    with the bin membership matrix, so there is no Python loop over columns or bins. Columns are processed in
+    chunks of chunk_columns to bound memory.
 
     Parameters:
-    df (DataFrame): The DataFrame containing human or GPT counts.
+    df (DataFrame): The DataFrame containing the correct counts and the method columns.
     correct_counts_column (str): The column name containing the correct object counts.
-    method_column (str): Optional; the method column to calculate RMSE for specific methods.
+    method_columns (list): The method columns to evaluate.
+    bins (list): The increasing upper edges of the count bins.
+    chunk_columns (int): The number of method columns evaluated per matrix product.
+    bin_column (str): Optional; bin rows by this column (e.g. a _spread column) instead of the correct count.
+        Rows where it is missing are only in the overall bin.
+    bin_name (str): The name used in the bin labels, e.g. 'Spread'.
 
     Returns:
-    dict: A dictionary with RMSE values for each range and overall performance.
+    DataFrame: One row per (method column, bin), with 'Overall' as the last bin of each method, and the
+    columns Method, Bin, N, NA, RMSE, MAE, MAPE (in percent) and Bias (mean of predicted - correct).
     """
-    rmse_results = {}
-    conditions = [
-        (df[correct_counts_column] < 20),
-        (df[correct_counts_column] >= 20) & (df[correct_counts_column] < 100),
-        (df[correct_counts_column] >= 100)
-    ]
-    range_labels = ['Count < 20 performance', '20 <= Count < 100 performance', 'Count >= 100 performance']
+    method_columns = list(method_columns)
+    labels = bin_labels(bins, bin_name) + ['Overall']
+    truth = pd.to_numeric(df[correct_counts_column], errors='coerce').to_numpy(dtype=float)
+    known = ~np.isnan(truth)
+    rows = np.flatnonzero(known)
+    if bin_column is None:
+        values, binned = truth, rows
+    else:
+        values = pd.to_numeric(df[bin_column], errors='coerce').to_numpy(dtype=float)
+        binned = np.flatnonzero(known & ~np.isnan(values))
 
-    for i, condition in enumerate(conditions):
-        range_data = df[condition]
-        rmse_results[range_labels[i]] = calculate_rmse(range_data, correct_counts_column, method_column)
+    # Bin membership (bins + overall) x rows. Rows without a correct count are in no bin.
+    membership = np.zeros((len(labels), len(truth)))
+    membership[np.searchsorted(np.asarray(bins, dtype=float), values[binned], side='right'), binned] = 1
+    membership[-1, rows] = 1
+    with np.errstate(divide='ignore'):
+        inverse_truth = np.where(known & (truth > 0), 1 / truth, 0)
+    percent_membership = membership * (inverse_truth > 0)
+    # NAs are counted over all rows for the overall bin.
+    na_membership = membership.copy()
+    na_membership[-1] = 1
 
-    # Overall performance
-    rmse_results['Overall performance'] = calculate_rmse(df, correct_counts_column, method_column)
+    frames = []
+    for start in range(0, len(method_columns), chunk_columns):
+        columns = method_columns[start:start + chunk_columns]
+        predictions = _to_float_matrix(df[columns])
+        missing = np.isnan(predictions)
+        valid = ~missing & known[:, None]
+        error = np.where(valid, predictions - np.where(known, truth, 0)[:, None], 0)
+        absolute = np.abs(error)
+        n = membership @ valid
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = {
+                'N': n,
+                'NA': na_membership @ missing,
+                'RMSE': np.sqrt((membership @ error ** 2) / n),
+                'MAE': (membership @ absolute) / n,
+                'MAPE': 100 * (percent_membership @ (absolute * inverse_truth[:, None])) / (percent_membership @ valid),
+                'Bias': (membership @ error) / n,
+            }
+        # Method-major order: each method's bins together, in bin order.
+        frames.append(pd.DataFrame({
+            'Method': np.repeat(columns, len(labels)),
+            'Bin': np.tile(labels, len(columns)),
+            **{name: values.T.ravel() for name, values in metrics.items()},
+        }))
+    metrics = pd.concat(frames, ignore_index=True)
+    metrics[['N', 'NA']] = metrics[['N', 'NA']].astype(int)
+    return metrics
 
-    # Count of NAs
-    rmse_results['Number of NA (cannot count)'] = df[method_column].isna().sum() if method_column else 0
 
+def rmse_table(metrics, method_names=None, bins=COUNT_BINS):
+    """
+    Reshapes compute_metrics output into the rmse_evaluation.csv layout: one row per method with the overall
+    and per-bin RMSE and the number of NAs.
+
+    Parameters:
+    metrics (DataFrame): The output of compute_metrics.
+    method_names (dict): Optional; maps method columns to the names written in the Method column.
+    bins (list): The bin edges metrics was computed with.
+
+    Returns:
+    DataFrame: The RMSE table.
+    """
+    table = metrics.pivot(index='Method', columns='Bin', values='RMSE')
+    table = table[['Overall'] + bin_labels(bins)]
+    table.columns = [f"{label} performance" for label in table.columns]
+    table[NA_LABEL] = metrics[metrics['Bin'] == 'Overall'].set_index('Method')['NA'].astype(float)
+    table = table.loc[metrics['Method'].unique()]
+    if method_names is not None:
+        table = table.rename(index=method_names)
+    return table.rename_axis('Method').reset_index()
+
+
+def calculate_rmse_for_ranges(df, correct_counts_column, method_column=None, bins=COUNT_BINS):
+    """
+    Calculates RMSE for different object count ranges from the DataFrame.
+
+    Parameters:
+    df (DataFrame): The DataFrame containing human or GPT counts.
+    correct_counts_column (str): The column name containing the correct object counts.
+    method_column (str): The method column to calculate RMSE for.
+    bins (list): The increasing upper edges of the count bins.
+
+    Returns:
+    dict: A dictionary with RMSE values for each range and overall performance.
+    """
+    metrics = compute_metrics(df, correct_counts_column, [method_column], bins).set_index('Bin')
+    rmse_results = {f"{label} performance": metrics.at[label, 'RMSE'] for label in bin_labels(bins)}
+    rmse_results['Overall performance'] = metrics.at['Overall', 'RMSE']
+    rmse_results[NA_LABEL] = metrics.at['Overall', 'NA']
     return rmse_results
 
 
@@ -77,35 +198,97 @@ def update_rmse_in_output_file(output_file, rmse_results):
     print(f"Updated the output file with RMSE values: {rmse_results}")
 
 
-def process_human_and_gpt_rmse(human_file, gpt4_file, output_file):
+def process_human_and_gpt_rmse(human_file, gpt4_file, output_file, bins=COUNT_BINS, metrics_file=None):
     """
-    Calculates and updates RMSE for both human and GPT methods in the output file.
+    Calculates RMSE for the human and GPT methods and writes the RMSE table once.
 
     Parameters:
     human_file (str): Path to the CSV file with human evaluation data.
     gpt4_file (str): Path to the CSV file with GPT evaluation data.
-    output_file (str): Path to the CSV file to update.
+    output_file (str): Path to the CSV file to write.
+    bins (list): The increasing upper edges of the count bins.
+    metrics_file (str): Optional; path to write all metrics (RMSE, MAE, MAPE, bias, NA) per method and bin.
+    """
+    human_metrics = compute_metrics(pd.read_csv(human_file), 'object_count', ['human'], bins)
+    gpt_metrics = compute_metrics(pd.read_csv(gpt4_file), 'object_count', list(GPT_METHODS.values()), bins)
+    method_names = {'human': 'Human', **{column: method for method, column in GPT_METHODS.items()}}
+    metrics = pd.concat([human_metrics, gpt_metrics], ignore_index=True)
+
+    rmse_table(metrics, method_names, bins).to_csv(output_file, index=False)
+    print(f"Wrote RMSE values to {output_file}")
+    if metrics_file is not None:
+        metrics.assign(Method=metrics['Method'].map(method_names)).to_csv(metrics_file, index=False)
+
+
+def evaluate_all_methods(gpt4_file, output_file, bins=COUNT_BINS, correct_counts_column='object_count'):
+    """
+    Calculates all metrics for every count column of an evaluation CSV (the initial answer and every
+    response_* column) and writes them once, one row per (column, bin).
+
+    Parameters:
+    gpt4_file (str): Path to the evaluation CSV.
+    output_file (str): Path to the CSV file to write.
+    bins (list): The increasing upper edges of the count bins.
+    correct_counts_column (str): The column name containing the correct object counts.
+
+    Returns:
+    DataFrame: The metrics.
     """
-    # Calculate and update RMSE for human
-    human_df = pd.read_csv(human_file)
-    human_rmse_results = calculate_rmse_for_ranges(human_df, 'object_count', 'human')
-    update_rmse_in_output_file(output_file, {'Human': human_rmse_results})
+    df = pd.read_csv(gpt4_file)
+    columns = [c for c in df.columns if (c == 'gpt_4_initial_answer' or c.startswith('response_'))
+               and not c.endswith(response_parser.SPREAD_SUFFIX)]
+    metrics = compute_metrics(df, correct_counts_column, columns, bins)
+    metrics.to_csv(output_file, index=False)
+    return metrics
 
-    # Calculate and update RMSE for GPT methods
-    gpt4_df = pd.read_csv(gpt4_file)
-    gpt_methods = {
-        'GPT initial': 'gpt_4_initial_answer',
-        'GPT all hints': 'response_desc_true_direct_true_indirect_true',
-        'GPT description': 'response_desc_true_direct_false_indirect_false',
-        'GPT direct': 'response_desc_false_direct_true_indirect_false',
-        'GPT indirect': 'response_desc_false_direct_false_indirect_true'
-    }
 
-    gpt_rmse_results = {}
-    for method, column in gpt_methods.items():
-        gpt_rmse_results[method] = calculate_rmse_for_ranges(gpt4_df, 'object_count', column)
+def evaluate_by_spread(gpt4_file, output_file, spread_bins=SPREAD_BINS, correct_counts_column='object_count'):
+    """
+    Calculates all metrics of every count column that has a _spread column (a self-consistency run), binned by
+    the spread of its samples instead of the true count, to show whether disagreement between samples flags
+    the wrong answers.
+
+    Parameters:
+    gpt4_file (str): Path to the evaluation CSV.
+    output_file (str): Path to the CSV file to write.
+    spread_bins (list): The increasing upper edges of the spread bins.
+    correct_counts_column (str): The column name containing the correct object counts.
+
+    Returns:
+    DataFrame: One row per (column, spread bin).
+    """
+    df = pd.read_csv(gpt4_file)
+    suffix = response_parser.SPREAD_SUFFIX
+    columns = [c[:-len(suffix)] for c in df.columns if c.endswith(suffix) and c[:-len(suffix)] in df.columns]
+    metrics = pd.concat([compute_metrics(df, correct_counts_column, [column], spread_bins,
+                                         bin_column=column + suffix, bin_name='Spread') for column in columns],
+                        ignore_index=True)
+    metrics.to_csv(output_file, index=False)
+    print(metrics.to_string(index=False))
+    return metrics
 
-    update_rmse_in_output_file(output_file, gpt_rmse_results)
+
+def evaluate_results_store(store_path, output_file, method_columns=None, run_id=None, bins=COUNT_BINS):
+    """
+    Calculates all metrics from a results store, reading only the filename, method and answer columns of
+    the requested methods (no response texts).
+
+    Parameters:
+    store_path (str): The root directory of the results store.
+    output_file (str): Path to the CSV file to write.
+    method_columns (list): Optional; the methods to evaluate. Defaults to all methods of the run.
+    run_id (str): Optional; the run to evaluate. Defaults to the latest run.
+    bins (list): The increasing upper edges of the count bins.
+
+    Returns:
+    DataFrame: The metrics.
+    """
+    df = results_store.ResultsStore(store_path).method_frame(method_columns, run_id)
+    columns = [c for c in df.columns if c not in ('filename', 'object_count')
+               and not c.endswith(response_parser.SPREAD_SUFFIX)]
+    metrics = compute_metrics(df, 'object_count', columns, bins)
+    metrics.to_csv(output_file, index=False)
+    return metrics
 
 
 if __name__ == "__main__":
@@ -114,3 +297,7 @@ if __name__ == "__main__":
     output_file = "results/rmse_evaluation.csv"
 
     process_human_and_gpt_rmse(human_file, gpt4_file, output_file)
+    # process_human_and_gpt_rmse(human_file, gpt4_file, output_file, metrics_file="results/metrics_evaluation.csv")
+    # evaluate_by_spread(gpt4_file, "results/rmse_by_spread.csv")
+    # evaluate_all_methods(gpt4_file, "results/metrics_all_methods.csv", bins=[10, 20, 50, 100, 500])
+    # evaluate_results_store("results/results_store", "results/metrics_all_methods.csv")
@@ -0,0 +1,114 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+"""
+
+import json
+import os
+import time
+
+# Stages written to the journal and the wide CSV column each one fills.
+STAGE_COLUMNS = {
+    'initial_count': lambda config: 'gpt_4_initial_answer',
+    'hints': lambda config: 'full_response',
+    # The hint stage of class_hints.get_hints: per-image description and direct hint, split like 'hints'.
+    'image_hints': lambda config: 'full_response',
+    'count_with_hint': lambda config: 'response_' + config,
+}
+
+
+def column_for(stage, config):
+    """
+    Returns the wide CSV column filled by a (stage, config) pair.
+    """
+    return STAGE_COLUMNS[stage](config)
+
+
+class RunJournal:
+    """
+    Append-only JSONL journal of model responses, one record per (image, stage, config).
+
+    Records are buffered and fsynced in batches. Reopening an existing journal loads its records, so a
+    crashed run can resume by skipping every (image, stage, config) that already has a response.
+
+    Parameters:
+    path (str): The path to the journal file.
+    fsync_every (int): The number of records buffered before they are written and fsynced.
+    """
+
+    def __init__(self, path, fsync_every=32):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.records = {}
+        self._buffer = []
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                data = file.read()
+            # A torn last line from a crash mid-write is cut off, so the next record starts on a line of its
+            # own; the torn record is simply redone.
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data):
+                with open(path, "r+b") as file:
+                    file.truncate(complete)
+            for line in data[:complete].decode('utf-8').splitlines():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.records[(record['filename'], record['stage'], record['config'])] = record['response']
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a")
+
+    def responses(self, stage, config=''):
+        """
+        Returns the completed responses of one stage and config.
+
+        Returns:
+        dict: Mapping of filename to response text.
+        """
+        return {filename: response for (filename, s, c), response in self.records.items()
+                if s == stage and c == config}
+
+    def record(self, filename, stage, config, response):
+        """
+        Appends a completed response to the journal.
+        """
+        self.records[(filename, stage, config)] = response
+        self._buffer.append(json.dumps({'filename': filename, 'stage': stage, 'config': config,
+                                        'response': response, 'time': time.time()}))
+        if len(self._buffer) >= self.fsync_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered records and fsyncs the journal file.
+        """
+        if not self._buffer:
+            return
+        self._file.write("\n".join(self._buffer) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def to_wide(self, df):
+        """
+        Adds one column per journaled (stage, config) to a label DataFrame, filled with the raw responses.
+
+        Parameters:
+        df (DataFrame): The label DataFrame with a 'filename' column.
+
+        Returns:
+        DataFrame: A copy of df with the response columns added.
+        """
+        df = df.copy()
+        columns = {}
+        for (filename, stage, config), response in self.records.items():
+            columns.setdefault(column_for(stage, config), {})[filename] = response
+        for column, values in columns.items():
+            df[column] = df['filename'].map(values)
+        return df
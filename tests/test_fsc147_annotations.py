@@ -0,0 +1,43 @@
+import json
+import numpy as np
+import pytest
+import fsc147_annotations
+
+
+@pytest.fixture
+def annotation_json(tmp_path):
+    annotations = {
+        f'{i}.jpg': {'H': 384, 'W': 500 + i, 'points': [[j + 0.5, 2.0 * j] for j in range(i * 7)],
+                     'box_examples_coordinates': [[[0, 0], [0, 1], [1, 1], [1, 0]]] * 3, 'density_path': f'{i}.npy'}
+        for i in range(20)
+    }
+    path = tmp_path / 'annotation.json'
+    path.write_text(json.dumps(annotations, indent=1))
+    return str(path), annotations
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1 << 20])
+def test_iter_annotations_matches_json_load(annotation_json, chunk_size):
+    path, annotations = annotation_json
+    assert dict(fsc147_annotations.iter_annotations(path, chunk_size)) == annotations
+
+
+def test_iter_annotations_rejects_non_object(tmp_path):
+    path = tmp_path / 'annotation.json'
+    path.write_text('[1, 2]')
+    with pytest.raises(ValueError):
+        list(fsc147_annotations.iter_annotations(str(path)))
+
+
+def test_extract_annotations_and_points(annotation_json, tmp_path):
+    path, annotations = annotation_json
+    points_path = str(tmp_path / 'points.npy')
+    wanted = ['3.jpg', '0.jpg', '12.jpg']
+    summary = fsc147_annotations.extract_annotations(path, wanted, points_path=points_path, chunk_size=50)
+    assert list(summary['filename']) == ['0.jpg', '3.jpg', '12.jpg']
+    assert list(summary['object_count']) == [0, 21, 84]
+    assert list(summary['exemplar_count']) == [3, 3, 3]
+    assert list(summary['width']) == [500, 503, 512]
+    for filename in wanted:
+        points = fsc147_annotations.load_points(points_path, summary, filename)
+        np.testing.assert_array_equal(points, np.asarray(annotations[filename]['points'], dtype=np.float32).reshape(-1, 2))
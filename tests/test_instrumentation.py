@@ -0,0 +1,40 @@
+import gc
+import weakref
+import instrumentation
+
+
+def test_label_value_escapes_prometheus_specials():
+    assert instrumentation.label_value('plain') == 'plain'
+    assert instrumentation.label_value('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+
+def test_prometheus_text_escapes_labels(tmp_path):
+    log = instrumentation.CallLog(str(tmp_path / 'calls.jsonl'))
+    log.record({'prompt': 'p', 'custom_id': '1.jpg|say "hi"\n|'}, 0.2)
+    text = log.metrics.prometheus_text()
+    assert 'stage="say \\"hi\\"\\n"' in text
+    assert all(line.count('"') % 2 == 0 for line in text.splitlines() if not line.startswith('#'))
+    log.close()
+
+
+def test_records_are_written_on_close_and_reread(tmp_path):
+    path = str(tmp_path / 'calls.jsonl')
+    log = instrumentation.CallLog(path, flush_every=100)
+    log.record({'prompt': 'p', 'custom_id': '1.jpg|initial_count|'}, 0.5, attempts=2)
+    log.record({'prompt': 'p', 'custom_id': '2.jpg|initial_count|'}, None, error=TimeoutError())
+    log.close()
+    calls = instrumentation.read_calls(path)
+    assert list(calls['image']) == ['1.jpg', '2.jpg']
+    assert list(calls['attempts']) == [2, 1]
+    assert calls['error'].isna().tolist() == [True, False]
+    assert calls.at[1, 'error'] == 'TimeoutError'
+
+
+def test_closed_log_is_not_kept_alive_by_atexit(tmp_path):
+    log = instrumentation.CallLog(str(tmp_path / 'calls.jsonl'))
+    log.record({'prompt': 'p', 'custom_id': '1.jpg|initial_count|'}, 0.5)
+    log.close()
+    reference = weakref.ref(log)
+    del log
+    gc.collect()
+    assert reference() is None
@@ -0,0 +1,92 @@
+import time
+import pandas as pd
+import pytest
+import labeling_store
+
+
+def make_store(path, **kwargs):
+    store = labeling_store.LabelingStore(str(path), **kwargs)
+    store.add_images(pd.DataFrame({'filename': [f'{i}.jpg' for i in range(4)], 'class': 'apples',
+                                   'object_count': range(4)}))
+    return store
+
+
+def test_concurrent_annotators_receive_distinct_images(tmp_path):
+    first = make_store(tmp_path / 'store.sqlite')
+    second = labeling_store.LabelingStore(str(tmp_path / 'store.sqlite'))
+    a = first.lease('a', 2)
+    b = second.lease('b', 2)
+    assert a == ['0.jpg', '1.jpg']
+    assert b == ['2.jpg', '3.jpg']
+    assert first.lease('c', 2) == []
+    first.close()
+    second.close()
+
+
+def test_expired_lease_returns_to_queue(tmp_path):
+    store = make_store(tmp_path / 'store.sqlite', lease_seconds=0.05)
+    assert store.lease('a', 4) == ['0.jpg', '1.jpg', '2.jpg', '3.jpg']
+    assert store.lease('b', 4) == []
+    time.sleep(0.1)
+    assert store.lease('b', 1) == ['0.jpg']
+    store.close()
+
+
+def test_renew_and_release(tmp_path):
+    store = make_store(tmp_path / 'store.sqlite', lease_seconds=0.05)
+    leased = store.lease('a', 2)
+    store.lease_seconds = 60
+    store.renew('a', leased[:1])
+    time.sleep(0.1)
+    assert store.lease('b', 4) == ['1.jpg', '2.jpg', '3.jpg']
+    store.release('b')
+    assert store.lease('c', 4) == ['1.jpg', '2.jpg', '3.jpg']
+    store.close()
+
+
+def test_submit_ends_lease_and_excludes_own_images(tmp_path):
+    store = make_store(tmp_path / 'store.sqlite', replicas=2)
+    store.lease('a', 1)
+    store.submit('a', [('0.jpg', 7, 3.5)])
+    assert store.lease('a', 4) == ['1.jpg', '2.jpg', '3.jpg']
+    # 0.jpg has one label and needs a second annotator, ahead of the images leased by a.
+    assert store.lease('b', 1) == ['0.jpg']
+    assert store.progress() == {'images': 4, 'labeled': 1, 'complete': 0, 'leased': 4, 'replicas': 2}
+    store.close()
+
+
+def test_replicas_are_saved_in_the_store(tmp_path):
+    path = tmp_path / 'store.sqlite'
+    make_store(path, replicas=2).close()
+    # A later session opened without replicas, like the GUI, must hand each image to two annotators.
+    first = labeling_store.LabelingStore(str(path))
+    second = labeling_store.LabelingStore(str(path))
+    assert first.replicas == second.replicas == 2
+    filenames = ['0.jpg', '1.jpg', '2.jpg', '3.jpg']
+    assert first.lease('a', 4) == filenames
+    assert second.lease('b', 4) == filenames
+    assert second.lease('c', 4) == []
+    first.close()
+    second.close()
+
+
+def test_replicas_default_and_validation(tmp_path):
+    store = make_store(tmp_path / 'store.sqlite')
+    assert store.replicas == 1
+    with pytest.raises(ValueError):
+        store.set_replicas(0)
+    store.close()
+    assert labeling_store.LabelingStore(str(tmp_path / 'store.sqlite')).replicas == 1
+
+
+def test_aggregate_takes_median_across_annotators(tmp_path):
+    store = make_store(tmp_path / 'store.sqlite', replicas=3)
+    store.submit('a', [('0.jpg', 10, None), ('1.jpg', 4, None)])
+    store.submit('b', [('0.jpg', 12, None)])
+    store.submit('c', [('0.jpg', 20, None)])
+    aggregated = store.aggregate(min_labels=2).set_index('filename')
+    assert aggregated.loc['0.jpg', 'human'] == 12
+    assert aggregated.loc['0.jpg', 'human_spread'] == 10
+    assert aggregated.loc['0.jpg', 'human_labels'] == 3
+    assert pd.isna(aggregated.loc['1.jpg', 'human'])
+    store.close()
@@ -0,0 +1,46 @@
+import asyncio
+import time
+import request_engine
+
+
+def test_token_bucket_allows_a_burst_up_to_capacity():
+    async def take(bucket, n):
+        for _ in range(n):
+            await bucket.acquire()
+
+    bucket = request_engine.TokenBucket(600)
+    start = time.monotonic()
+    asyncio.run(take(bucket, 600))
+    assert time.monotonic() - start < 0.5
+    assert bucket.tokens < 1
+
+
+def test_token_bucket_waits_for_refill():
+    async def take(bucket):
+        await bucket.acquire(6)
+        await bucket.acquire(3)
+
+    # 600 per minute refills 10 tokens per second, so the second acquire waits about 0.3 s.
+    bucket = request_engine.TokenBucket(600)
+    bucket.tokens = 6
+    start = time.monotonic()
+    asyncio.run(take(bucket))
+    assert 0.25 < time.monotonic() - start < 1.0
+
+
+def test_token_bucket_clips_requests_above_capacity():
+    bucket = request_engine.TokenBucket(60)
+    asyncio.run(bucket.acquire(1000))
+    assert bucket.tokens < 1
+
+
+def test_run_requests_refuses_a_running_loop():
+    async def call():
+        request_engine.run_requests([])
+
+    try:
+        asyncio.run(call())
+    except RuntimeError as e:
+        assert 'run_requests_async' in str(e)
+    else:
+        raise AssertionError("run_requests did not raise inside a running loop")
@@ -0,0 +1,39 @@
+import response_cache
+
+
+def test_key_depends_on_prompt_params_detail_and_stream(tmp_path):
+    cache = response_cache.ResponseCache(str(tmp_path / 'cache.sqlite'))
+    request = {'prompt': 'How many apples?', 'params': {'temperature': 0}}
+    key = cache.key_for(request)
+    assert cache.key_for(dict(request)) == key
+    assert cache.key_for(dict(request, prompt='How many pears?')) != key
+    assert cache.key_for(dict(request, params={'temperature': 1})) != key
+    assert cache.key_for(dict(request, detail='low')) != key
+    assert cache.key_for(dict(request, stream=True)) != key
+    # Options that do not change the response keep the key.
+    assert cache.key_for(dict(request, detail=None, stream=False, custom_id='a|b|c')) == key
+    cache.close()
+
+
+def test_image_content_not_path_is_hashed(tmp_path):
+    cache = response_cache.ResponseCache(str(tmp_path / 'cache.sqlite'))
+    for name, content in [('a.jpg', b'one'), ('b.jpg', b'one'), ('c.jpg', b'two')]:
+        (tmp_path / name).write_bytes(content)
+    keys = [cache.key_for({'prompt': 'p', 'image_path': str(tmp_path / name)}) for name in ['a.jpg', 'b.jpg', 'c.jpg']]
+    assert keys[0] == keys[1] != keys[2]
+    cache.close()
+
+
+def test_put_get_and_failed_responses_are_not_stored(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = response_cache.ResponseCache(path)
+    for response in [None, '', '  \n']:
+        cache.put({'prompt': repr(response)}, response)
+        assert cache.get({'prompt': repr(response)}) is None
+    cache.put({'prompt': 'p'}, '18')
+    cache.close()
+    cache = response_cache.ResponseCache(path)
+    assert cache.get({'prompt': 'p'}) == '18'
+    assert cache.get({'prompt': 'p', 'stream': True}) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
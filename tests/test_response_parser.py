@@ -0,0 +1,87 @@
+import json
+import pytest
+import response_parser
+
+
+def test_parse_side_information_heading_variants():
+    response = ("Intro\n1. **Description:** Red apples in a crate.\n"
+                "### 2. Direct Hint:\nAbout 30 apples.\n"
+                "**3. Indirect hint**\nApples are packed in rows.")
+    description, direct, indirect, variants = response_parser.parse_side_information(response)
+    assert description == "Red apples in a crate."
+    assert direct == "About 30 apples."
+    assert indirect == "Apples are packed in rows."
+    assert variants == {'description': 'N. **<name>:**', 'direct_hint': '### N. <name>:',
+                        'indirect_hint': '**N. <name>**'}
+
+
+def test_parse_side_information_missing_section_and_non_string():
+    description, direct, indirect, _ = response_parser.parse_side_information("Description: only this")
+    assert (description, direct, indirect) == ("only this", None, None)
+    assert response_parser.parse_side_information(float('nan')) == (None, None, None, {})
+
+
+def test_parse_side_information_repeated_heading_keeps_both_bodies():
+    response = "Description: a\nDirect hint: b\nIndirect hint: c\nDirect hint: d"
+    description, direct, indirect, variants = response_parser.parse_side_information(response)
+    assert (description, direct, indirect) == ("a", "b\n\nd", "c")
+    assert variants['direct_hint'].endswith(response_parser.REPEATED_SUFFIX)
+    assert not variants['description'].endswith(response_parser.REPEATED_SUFFIX)
+
+
+def test_parse_side_information_matches_extract_section_on_legacy_headings():
+    for response in response_parser.synthetic_responses(200, response_parser.LEGACY_TEMPLATES):
+        parsed = response_parser.parse_side_information(response)[:3]
+        legacy = tuple(response_parser.extract_section(response, section) for section in response_parser.SECTIONS)
+        assert parsed == legacy
+
+
+def test_parse_structured_side_information():
+    response = json.dumps({'description': ' d ', 'direct_hint': 'h', 'indirect_hint': ''})
+    assert response_parser.parse_side_information(response) == ('d', 'h', None,
+                                                                {'description': 'json', 'direct_hint': 'json'})
+    assert response_parser.parse_side_information('{"description": "cut off') == (None, None, None, {})
+
+
+@pytest.mark.parametrize('response, count', [
+    ("18", 18), ("18.", 18), ("There are 20 apples.", 20), ("twenty-three", 23), ("about 1,200", 1200),
+    ("20-25", 23), ("between 20 and 25", 23), ("one hundred and five", 105), ("2.5", 3), (12.4, 12),
+    ("I cannot count them.", None), (None, None), (float('nan'), None),
+])
+def test_extract_count(response, count):
+    assert response_parser.extract_count(response) == count
+
+
+@pytest.mark.parametrize('partial, count', [
+    ("1", None), ("18", None), ("18 ", None), ("18 a", None), ("18 apples ", 18), ("seven", None),
+    ("seventeen apples.", 17), ("1,2", None), ("1,200 of them", 1200), ("20 to 2", None), ("20 to 25 apples.", 23),
+    ("18.", None), ("18.5 apples.", 19),
+])
+def test_complete_count(partial, count):
+    assert response_parser.complete_count(partial) == count
+
+
+def test_complete_count_agrees_with_extract_count_on_every_prefix():
+    response = "There are about one hundred and twenty-three apples in the image."
+    final = response_parser.extract_count(response)
+    for end in range(len(response) + 1):
+        count = response_parser.complete_count(response[:end])
+        assert count is None or count == final
+
+
+def test_aggregate_counts():
+    assert response_parser.aggregate_counts([]) is None
+    assert response_parser.aggregate_counts([3, 1, 2]) == 2
+    assert response_parser.aggregate_counts([1, 2, 3, 4]) == 3
+    assert response_parser.aggregate_counts([5, 5, 9, 9, 1], 'mode') == 7
+    assert response_parser.aggregate_counts([10, 11, 12, 13, 100], 'trimmed_mean') == 12
+    with pytest.raises(ValueError):
+        response_parser.aggregate_counts([1], 'mean')
+
+
+def test_samples_round_trip_and_spread():
+    response = response_parser.join_samples(["18", "20", "about 19"])
+    assert response_parser.split_samples(response) == ["18", "20", "about 19"]
+    assert response_parser.sample_counts(response) == [18, 20, 19]
+    assert response_parser.count_spread(response) == pytest.approx(1 / 19)
+    assert response_parser.count_spread("18") is None
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rmse_evaluation
+
+
+def loop_rmse_for_ranges(df, correct_counts_column, method_column):
+    # The per-method, per-range loop compute_metrics replaced.
+    truth = df[correct_counts_column]
+    conditions = [truth < 20, (truth >= 20) & (truth < 100), truth >= 100]
+    labels = ['Count < 20 performance', '20 <= Count < 100 performance', 'Count >= 100 performance']
+    results = {label: rmse_evaluation.calculate_rmse(df[condition], correct_counts_column, method_column)
+               for label, condition in zip(labels, conditions)}
+    results['Overall performance'] = rmse_evaluation.calculate_rmse(df, correct_counts_column, method_column)
+    results[rmse_evaluation.NA_LABEL] = df[method_column].isna().sum()
+    return results
+
+
+@pytest.fixture
+def counts():
+    rng = np.random.default_rng(0)
+    truth = rng.integers(1, 400, 500)
+    df = pd.DataFrame({'object_count': truth})
+    for i in range(5):
+        predictions = truth + rng.normal(0, 5 + 10 * i, len(truth)).round()
+        predictions[rng.random(len(truth)) < 0.1] = np.nan
+        df[f'method_{i}'] = predictions
+    return df
+
+
+def test_rmse_for_ranges_matches_loop(counts):
+    for column in counts.columns[1:]:
+        expected = loop_rmse_for_ranges(counts, 'object_count', column)
+        assert rmse_evaluation.calculate_rmse_for_ranges(counts, 'object_count', column) == pytest.approx(expected)
+
+
+def test_compute_metrics_is_independent_of_chunking(counts):
+    columns = list(counts.columns[1:])
+    whole = rmse_evaluation.compute_metrics(counts, 'object_count', columns)
+    chunked = rmse_evaluation.compute_metrics(counts, 'object_count', columns, chunk_columns=2)
+    pd.testing.assert_frame_equal(whole, chunked)
+    assert list(whole['Bin'].unique()) == rmse_evaluation.bin_labels() + ['Overall']
+
+
+def test_compute_metrics_mae_mape_and_bias():
+    df = pd.DataFrame({'object_count': [10, 50, 200, np.nan], 'method': [12, 40, np.nan, 5]})
+    metrics = rmse_evaluation.compute_metrics(df, 'object_count', ['method']).set_index('Bin')
+    overall = metrics.loc['Overall']
+    assert overall['N'] == 2
+    assert overall['NA'] == 1
+    assert overall['MAE'] == pytest.approx(6)
+    assert overall['MAPE'] == pytest.approx(100 * (2 / 10 + 10 / 50) / 2)
+    assert overall['Bias'] == pytest.approx(-4)
+    assert metrics.loc['Count >= 100', 'N'] == 0
+    assert np.isnan(metrics.loc['Count >= 100', 'RMSE'])
+
+
+def test_bin_labels():
+    assert rmse_evaluation.bin_labels() == ['Count < 20', '20 <= Count < 100', 'Count >= 100']
+    assert rmse_evaluation.bin_labels([0.1], 'Spread') == ['Spread < 0.1', 'Spread >= 0.1']
@@ -0,0 +1,44 @@
+import pandas as pd
+import run_journal
+
+
+def test_resume_after_torn_last_line(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = run_journal.RunJournal(path, fsync_every=2)
+    journal.record('1.jpg', 'initial_count', '', '18')
+    journal.record('1.jpg', 'count_with_hint', 'all_hints', '20')
+    journal.close()
+    with open(path, 'a') as file:
+        file.write('{"filename": "2.jpg", "stage": "initial_count", "con')
+
+    journal = run_journal.RunJournal(path)
+    assert journal.responses('initial_count') == {'1.jpg': '18'}
+    assert journal.responses('count_with_hint', 'all_hints') == {'1.jpg': '20'}
+    journal.record('2.jpg', 'initial_count', '', '7')
+    journal.close()
+
+    journal = run_journal.RunJournal(path)
+    assert journal.responses('initial_count') == {'1.jpg': '18', '2.jpg': '7'}
+    journal.close()
+
+
+def test_records_are_buffered_until_flush(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = run_journal.RunJournal(path, fsync_every=3)
+    journal.record('1.jpg', 'initial_count', '', '18')
+    assert run_journal.RunJournal(path).records == {}
+    journal.flush()
+    assert run_journal.RunJournal(path).records == {('1.jpg', 'initial_count', ''): '18'}
+    journal.close()
+
+
+def test_to_wide_fills_stage_columns(tmp_path):
+    journal = run_journal.RunJournal(str(tmp_path / 'journal.jsonl'))
+    journal.record('1.jpg', 'initial_count', '', '18')
+    journal.record('2.jpg', 'image_hints', '', 'Description: d')
+    journal.record('1.jpg', 'count_with_hint', 'description', '19')
+    wide = journal.to_wide(pd.DataFrame({'filename': ['1.jpg', '2.jpg']}))
+    assert list(wide['gpt_4_initial_answer'].fillna('')) == ['18', '']
+    assert list(wide['full_response'].fillna('')) == ['', 'Description: d']
+    assert list(wide['response_description'].fillna('')) == ['19', '']
+    journal.close()
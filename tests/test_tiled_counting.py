@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import tiled_counting
+
+
+def test_threshold_answers_tile_from_threshold_on():
+    coarse = pd.Series([10, 40, 80, np.nan])
+    tiled = pd.Series([11, 45, 90, 30])
+    answers = tiled_counting.threshold_answers(coarse, tiled, 40)
+    assert answers.tolist()[:3] == [10, 45, 90]
+    assert np.isnan(answers.iloc[3])
+
+
+def test_choose_threshold_picks_lowest_rmse():
+    # Tiling helps only from a coarse count of 60 on.
+    df = pd.DataFrame({'object_count': [10, 35, 50, 150], 'coarse': [10, 35, 50, 80]})
+    tiled = pd.Series([14, 45, 62, 150])
+    threshold, table = tiled_counting.choose_threshold(df, 'coarse', tiled, [20, 40, 60, 100])
+    assert threshold == 60
+    assert table['Tiled images'].tolist() == [3, 2, 1, 0]
+    assert table.set_index('Threshold').at[60, 'RMSE'] == 0
+
+
+def test_choose_threshold_prefers_fewer_tiled_images_on_ties():
+    df = pd.DataFrame({'object_count': [10, 50], 'coarse': [10, 50]})
+    threshold, _ = tiled_counting.choose_threshold(df, 'coarse', pd.Series([10, 50]), [20, 40, 60, 100])
+    assert threshold == 100
@@ -0,0 +1,373 @@
+"""
+Project: Improving Multi-modal Language Model on Object Counting with Self-Generated Side Information
+
+Tiled counting for dense images. Images whose coarse count (the whole-image answer) is at or above a threshold
+are split into an adaptive grid of overlapping tiles; each tile marks its own cell with a red rectangle and the
+model counts only objects centered inside it, so objects cut by a tile border are seen whole but counted once.
+The tile requests are sent concurrently and their counts summed. Images below the threshold keep their single
+whole-image answer.
+
+Tile requests carry no side information, even when the whole-image answer was made with hints: the hints are
+generated for the whole image, and their count-related text would pull each tile towards the whole-image count.
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+import pandas as pd
+from PIL import Image, ImageDraw
+import helpers
+import dataset_manifest
+import request_engine
+import response_cache
+import gpt4_evaluation
+import rmse_evaluation
+
+# Tile only images whose coarse count is at least this. The whole-image answer undercounts dense images, so the
+# threshold sits well below the lower edge of the densest count bin (100). It was chosen on the 69 val split images
+# of results/gpt4_evaluation.csv only: a coarse count of 40 catches 5 of their 10 images with at least 100 objects
+# (100 catches 4) and no image under 20; 30 adds 1 dense image for 7 more mid-range ones. run_tiled_evaluation
+# reports on the other images, and with threshold=None picks the threshold by RMSE on the tuning split.
+TILE_THRESHOLD = 40
+# Thresholds compared by choose_threshold.
+THRESHOLD_CANDIDATES = [20, 30, 40, 60, 100]
+# The split the threshold is chosen on; it is left out of the reported results.
+TUNE_SPLIT = 'val'
+# The grid is sized so that each tile holds about this many objects by the coarse count.
+OBJECTS_PER_TILE = 40
+MAX_TILES = 16
+# Context around each cell, as a fraction of the cell size on every side.
+TILE_OVERLAP = 0.15
+# Tiles are upscaled so their shorter side is at least this many pixels.
+TILE_SIDE = 512
+
+
+def grid_shape(width, height, estimate, objects_per_tile=OBJECTS_PER_TILE, max_tiles=MAX_TILES):
+    """
+    Chooses the (rows, columns) of the tile grid: about estimate / objects_per_tile cells, at most max_tiles,
+    shaped so the cells are close to square.
+
+    Parameters:
+    width (int): The image width in pixels.
+    height (int): The image height in pixels.
+    estimate (float): The coarse count of the image.
+    objects_per_tile (int): The target number of objects per tile.
+    max_tiles (int): The maximum number of tiles.
+
+    Returns:
+    tuple: (rows, columns).
+    """
+    tiles = min(max_tiles, max(1, math.ceil(estimate / objects_per_tile)))
+    columns = max(1, min(tiles, round(math.sqrt(tiles * width / height))))
+    rows = max(1, min(math.ceil(tiles / columns), max_tiles // columns))
+    return rows, columns
+
+
+def tile_boxes(width, height, rows, columns, overlap=TILE_OVERLAP):
+    """
+    Splits an image into rows x columns cells and returns, for each cell, the tile box (the cell grown by overlap
+    on every side, clipped to the image) and the cell's box inside that tile.
+
+    Returns:
+    list: ((left, top, right, bottom) of the tile, (left, top, right, bottom) of the cell in tile coordinates).
+    """
+    boxes = []
+    for row in range(rows):
+        for column in range(columns):
+            cell = (round(column * width / columns), round(row * height / rows),
+                    round((column + 1) * width / columns), round((row + 1) * height / rows))
+            margin_x = round(overlap * (cell[2] - cell[0]))
+            margin_y = round(overlap * (cell[3] - cell[1]))
+            tile = (max(0, cell[0] - margin_x), max(0, cell[1] - margin_y),
+                    min(width, cell[2] + margin_x), min(height, cell[3] + margin_y))
+            boxes.append((tile, (cell[0] - tile[0], cell[1] - tile[1], cell[2] - tile[0], cell[3] - tile[1])))
+    return boxes
+
+
+def make_tiles(image_path, tiles_path, estimate, objects_per_tile=OBJECTS_PER_TILE, max_tiles=MAX_TILES,
+               overlap=TILE_OVERLAP, tile_side=TILE_SIDE):
+    """
+    Writes the tiles of an image, each with its cell outlined in red, and returns their paths. Tile names
+    carry a hash of the image content, grid, overlap and tile side, so tiles on disk are reused only if all
+    of these are unchanged.
+
+    Parameters:
+    image_path (str): The image to tile.
+    tiles_path (str): The directory the tiles are written to.
+    estimate (float): The coarse count of the image, which sets the grid size.
+    objects_per_tile (int): The target number of objects per tile.
+    max_tiles (int): The maximum number of tiles.
+    overlap (float): Context around each cell, as a fraction of the cell size.
+    tile_side (int): Tiles are upscaled so their shorter side is at least this many pixels.
+
+    Returns:
+    list: The tile paths, row by row.
+    """
+    os.makedirs(tiles_path, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    with Image.open(image_path) as img:
+        width, height = img.size
+        rows, columns = grid_shape(width, height, estimate, objects_per_tile, max_tiles)
+        key = hashlib.sha256(json.dumps([response_cache.file_hash(image_path), rows, columns, overlap, tile_side])
+                             .encode('utf-8')).hexdigest()[:16]
+        paths = [os.path.join(tiles_path, f"{stem}_{rows}x{columns}_{key}_{i}.jpg") for i in range(rows * columns)]
+        if all(os.path.exists(path) for path in paths):
+            return paths
+        img = img.convert('RGB')
+        for path, (tile, cell) in zip(paths, tile_boxes(width, height, rows, columns, overlap)):
+            crop = img.crop(tile)
+            scale = max(1.0, tile_side / min(crop.size))
+            if scale > 1:
+                crop = crop.resize((round(crop.width * scale), round(crop.height * scale)), Image.LANCZOS)
+            draw = ImageDraw.Draw(crop)
+            draw.rectangle([round(v * scale) for v in cell], outline=(255, 0, 0), width=max(2, round(2 * scale)))
+            crop.save(path, quality=95)
+    return paths
+
+
+def tiled_counts(df, images_path, tiles_path, coarse_column, threshold=TILE_THRESHOLD,
+                 objects_per_tile=OBJECTS_PER_TILE, max_tiles=MAX_TILES, **engine_kwargs):
+    """
+    Recounts the images whose coarse count is at least threshold by tiles, sending all tile requests of all
+    images concurrently.
+
+    Parameters:
+    df (DataFrame): The evaluation rows, with 'filename', 'class' and the coarse column.
+    images_path (str): The directory path where images are stored.
+    tiles_path (str): The directory the tiles are written to.
+    coarse_column (str): The whole-image answers, e.g. 'gpt_4_initial_answer'.
+    threshold (float): Images with a coarse count below this are not tiled.
+    objects_per_tile (int): The target number of objects per tile.
+    max_tiles (int): The maximum number of tiles per image.
+    **engine_kwargs: Options passed to gpt4_evaluation.dispatch, e.g. concurrency, cache or batch_dir.
+
+    Returns:
+    DataFrame: Per row: tiled (the count used: the tile sum, or the coarse count for untiled images and images
+        with a failed tile), tiles (extra calls) and tile_latency_s (wall time from the first tile request
+        sent to the last answer received).
+    """
+    coarse = pd.to_numeric(df[coarse_column], errors='coerce')
+    requests = []
+    tiles_of = {}
+    for index, row in df.iterrows():
+        if pd.isna(coarse[index]) or coarse[index] < threshold:
+            continue
+        image_path = gpt4_evaluation.image_path_for(images_path, row)
+        if not os.path.exists(image_path):
+            print(f"Image {row['filename']} not found at {image_path}")
+            continue
+        prompt = helpers.tile_count_prompt(row['class'])
+        paths = make_tiles(image_path, tiles_path, coarse[index], objects_per_tile, max_tiles)
+        tiles_of[index] = paths
+        for i, path in enumerate(paths):
+            requests.append({'key': (index, i), 'custom_id': f"{row['filename']}|tile_{i}|{coarse_column}",
+                             'stage': 'tiles', 'image_path': path, 'prompt': prompt})
+    print(f"Tiling {len(tiles_of)} of {len(df)} images into {len(requests)} tile requests")
+
+    # The payload function is called as each request is sent, so it marks the send time of every tile.
+    sent = {}
+    received = {}
+    payload_fn = engine_kwargs.pop('payload_fn', helpers.image_data_url)
+
+    def timed_payload(image_path):
+        sent.setdefault(image_path, time.perf_counter())
+        return payload_fn(image_path)
+
+    def on_result(key, content):
+        received[key] = time.perf_counter()
+
+    batch_dir = engine_kwargs.pop('batch_dir', None)
+    if batch_dir is not None:
+        batch_dir = os.path.join(batch_dir, "tiles_" + coarse_column)
+    results = gpt4_evaluation.dispatch(requests, batch_dir=batch_dir, payload_fn=timed_payload, on_result=on_result,
+                                       **engine_kwargs)
+
+    counts = {}
+    for (index, i), content in results.items():
+        counts.setdefault(index, {})[i] = gpt4_evaluation.to_int_count(content)
+    output = pd.DataFrame({'tiled': coarse, 'tiles': 0, 'tile_latency_s': 0.0}, index=df.index)
+    for index, paths in tiles_of.items():
+        output.at[index, 'tiles'] = len(paths)
+        answers = counts.get(index, {})
+        if len(answers) == len(paths) and not any(pd.isna(a) for a in answers.values()):
+            output.at[index, 'tiled'] = sum(answers.values())
+        starts = [sent[path] for path in paths if path in sent]
+        ends = [received[(index, i)] for i in range(len(paths)) if (index, i) in received]
+        if starts and ends:
+            output.at[index, 'tile_latency_s'] = max(ends) - min(starts)
+    return output
+
+
+def count_tiled(image_path, object_name, tiles_path, description='', direct_hint='', indirect_hint='',
+                threshold=TILE_THRESHOLD, cache=None, **engine_kwargs):
+    """
+    Tiled counterpart of count_objects / count_with_hint for one image: one whole-image request, then, if its
+    count is at least threshold, concurrent tile requests whose counts are summed. The hints are used for the
+    whole-image request only.
+
+    Parameters:
+    image_path (str): The path to the image file.
+    object_name (str): The name of the object to be counted in the image.
+    tiles_path (str): The directory the tiles are written to.
+    description, direct_hint, indirect_hint (str): Optional; hints as in count_with_hint.
+    threshold (float): Whole-image counts below this are returned as they are.
+    cache (ResponseCache): Optional; the response cache to read from and write to.
+    **engine_kwargs: Options passed to request_engine.run_requests.
+
+    Returns:
+    str or None: The count as a string; the whole-image answer if it is below threshold or a tile failed.
+    """
+    hints = [description, direct_hint, indirect_hint]
+    call_log = engine_kwargs.get('call_log')
+    if any(hints):
+        coarse = gpt4_evaluation.count_with_hint(object_name, image_path, *hints, cache=cache, call_log=call_log)
+    else:
+        coarse = gpt4_evaluation.count_objects(image_path, object_name, cache=cache, call_log=call_log)
+    estimate = gpt4_evaluation.to_int_count(coarse)
+    if pd.isna(estimate) or estimate < threshold:
+        return coarse
+    prompt = helpers.tile_count_prompt(object_name)
+    requests = [{'key': i, 'stage': 'tiles', 'image_path': path, 'prompt': prompt}
+                for i, path in enumerate(make_tiles(image_path, tiles_path, estimate))]
+    results = request_engine.run_requests(requests, cache=cache, **engine_kwargs)
+    counts = [gpt4_evaluation.to_int_count(results.get(i)) for i in range(len(requests))]
+    if any(pd.isna(count) for count in counts):
+        return coarse
+    return str(sum(counts))
+
+
+def tiling_report(df, coarse_column, tiled_column, bins=rmse_evaluation.COUNT_BINS):
+    """
+    Reports, per count bin of the true count, the extra calls and latency of tiling next to the RMSE of the
+    whole-image and tiled answers.
+
+    Parameters:
+    df (DataFrame): Rows with 'object_count', the two answer columns, 'tiles' and 'tile_latency_s'.
+    coarse_column (str): The whole-image answers.
+    tiled_column (str): The tiled answers.
+    bins (list): The increasing upper edges of the count bins.
+
+    Returns:
+    DataFrame: Bin, Images, Tiled images, Extra calls per image, Mean extra latency (s) of tiled images,
+        RMSE whole image, RMSE tiled.
+    """
+    labels = rmse_evaluation.bin_labels(bins)
+    bin_of = pd.Series(pd.cut(df['object_count'], [-math.inf] + list(bins) + [math.inf], right=False,
+                              labels=labels), index=df.index)
+    metrics = rmse_evaluation.compute_metrics(df, 'object_count', [coarse_column, tiled_column], bins)
+    rmse = metrics.pivot(index='Bin', columns='Method', values='RMSE')
+    rows = []
+    for label in labels + ['Overall']:
+        rows_in_bin = df if label == 'Overall' else df[bin_of == label]
+        tiled = rows_in_bin[rows_in_bin['tiles'] > 0]
+        rows.append({'Bin': label, 'Images': len(rows_in_bin), 'Tiled images': len(tiled),
+                     'Extra calls per image': rows_in_bin['tiles'].mean() if len(rows_in_bin) else 0.0,
+                     'Mean extra latency (s)': tiled['tile_latency_s'].mean() if len(tiled) else 0.0,
+                     'RMSE whole image': rmse.at[label, coarse_column],
+                     'RMSE tiled': rmse.at[label, tiled_column]})
+    return pd.DataFrame(rows)
+
+
+def threshold_answers(coarse, tiled, threshold):
+    """
+    Returns the answers with tiling from threshold on: the tile sum where the coarse count is at least threshold,
+    the coarse count elsewhere.
+    """
+    coarse = pd.to_numeric(coarse, errors='coerce')
+    return coarse.where(~(coarse >= threshold), tiled)
+
+
+def choose_threshold(df, coarse_column, tiled, candidates=THRESHOLD_CANDIDATES):
+    """
+    Picks the threshold with the lowest overall RMSE, the highest one (fewest extra calls) on ties.
+
+    Parameters:
+    df (DataFrame): The tuning rows, with 'object_count' and the coarse column.
+    coarse_column (str): The whole-image answers.
+    tiled (Series): The tiled answers of the rows, tiled from the lowest candidate on.
+    candidates (list): The thresholds to compare.
+
+    Returns:
+    tuple: (the chosen threshold, DataFrame of Threshold, Tiled images and RMSE per candidate).
+    """
+    answers = pd.DataFrame({f"threshold_{t}": threshold_answers(df[coarse_column], tiled, t) for t in candidates})
+    answers['object_count'] = df['object_count']
+    metrics = rmse_evaluation.compute_metrics(answers, 'object_count', [f"threshold_{t}" for t in candidates])
+    rmse = metrics[metrics['Bin'] == 'Overall'].set_index('Method')['RMSE']
+    coarse = pd.to_numeric(df[coarse_column], errors='coerce')
+    table = pd.DataFrame({'Threshold': candidates, 'Tiled images': [int((coarse >= t).sum()) for t in candidates],
+                          'RMSE': [rmse[f"threshold_{t}"] for t in candidates]})
+    best = table[table['RMSE'] == table['RMSE'].min()]
+    return (int(best['Threshold'].max()) if len(best) else TILE_THRESHOLD), table
+
+
+def run_tiled_evaluation(csv_in, csv_out, images_path, tiles_path, coarse_columns=None, report_csv=None,
+                         threshold=TILE_THRESHOLD, tune_split=TUNE_SPLIT, split_path=dataset_manifest.split_path,
+                         candidates=THRESHOLD_CANDIDATES, **engine_kwargs):
+    """
+    Adds a tiled_<column> answer column for each whole-image answer column of an evaluation CSV and reports
+    the cost and accuracy of tiling per count bin, on the images outside tune_split only, since the threshold
+    is chosen on the tune_split images.
+
+    Parameters:
+    csv_in (str): The evaluation CSV, e.g. results/gpt4_evaluation.csv.
+    csv_out (str): The path to write the CSV with the tiled columns to.
+    images_path (str): The directory path where images are stored.
+    tiles_path (str): The directory the tiles are written to.
+    coarse_columns (list): Optional; the whole-image columns to tile, 'gpt_4_initial_answer' (basic prompt) or
+        response_<config> columns (the tile prompts carry no hints). Defaults to the initial answer.
+    report_csv (str): Optional; the path to write the report to.
+    threshold (float): Images with a coarse count below this are not tiled. None picks the threshold per
+        column with choose_threshold on the tune_split images, tiling from the lowest candidate on.
+    tune_split (str): The split of the FSC147 split JSON the threshold is chosen on, left out of the report.
+    split_path (str): The FSC147 train/val/test split JSON.
+    candidates (list): The thresholds compared when threshold is None.
+    **engine_kwargs: Options passed to tiled_counts.
+
+    Returns:
+    DataFrame: The report, one row per (column, bin).
+    """
+    df = pd.read_csv(csv_in)
+    coarse_columns = coarse_columns or ['gpt_4_initial_answer']
+    tune = df['filename'].map(dataset_manifest.read_splits(split_path)) == tune_split
+    print(f"Reporting on {int((~tune).sum())} held-out images; {int(tune.sum())} {tune_split} images are left out")
+    reports = []
+    for column in coarse_columns:
+        output = tiled_counts(df, images_path, tiles_path, column,
+                              min(candidates) if threshold is None else threshold, **engine_kwargs)
+        chosen = threshold
+        if threshold is None:
+            chosen, table = choose_threshold(df[tune], column, output.loc[tune, 'tiled'], candidates)
+            print(f"Thresholds of {column} on the {tune_split} split:")
+            print(table.to_string(index=False))
+            print(f"Chose threshold {chosen}")
+            untiled = ~(pd.to_numeric(df[column], errors='coerce') >= chosen)
+            output.loc[untiled, ['tiles', 'tile_latency_s']] = 0
+            output['tiled'] = threshold_answers(df[column], output['tiled'], chosen)
+        tiled_column = "tiled_" + column
+        df[tiled_column] = output['tiled'].astype('Int64')
+        held_out = df.assign(tiles=output['tiles'], tile_latency_s=output['tile_latency_s'])[~tune]
+        report = tiling_report(held_out, column, tiled_column)
+        reports.append(report.assign(Column=column, Threshold=chosen))
+    df.to_csv(csv_out, index=False)
+    report = pd.concat(reports, ignore_index=True)
+    report = report[['Column', 'Threshold'] + [c for c in report.columns if c not in ('Column', 'Threshold')]]
+    print(report.to_string(index=False))
+    if report_csv is not None:
+        report.to_csv(report_csv, index=False)
+    return report
+
+
+if __name__ == "__main__":
+    images_path = "FSC147_384_V2/selected_300_images"
+    gpt4_evaluation_csv_path = "results/gpt4_evaluation.csv"
+    tiles_path = "results/tiles"
+    run_tiled_evaluation(gpt4_evaluation_csv_path, "results/gpt4_evaluation_tiled.csv", images_path, tiles_path,
+                         report_csv="results/tiling_report.csv")
+    # run_tiled_evaluation(gpt4_evaluation_csv_path, "results/gpt4_evaluation_tiled.csv", images_path, tiles_path,
+    #                      coarse_columns=['gpt_4_initial_answer', 'response_desc_true_direct_true_indirect_true'],
+    #                      report_csv="results/tiling_report.csv")
+    # run_tiled_evaluation(gpt4_evaluation_csv_path, "results/gpt4_evaluation_tiled.csv", images_path, tiles_path,
+    #                      threshold=None, report_csv="results/tiling_report.csv")